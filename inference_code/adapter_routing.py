@@ -0,0 +1,194 @@
+"""
+Per-case LoRA adapter routing for multi-adapter serving in one engine.
+
+We train separate adapters per vehicle platform / library version. Instead of
+one engine process (and one copy of the 40 GB base) per adapter, every adapter
+is registered here with a stable integer id. Each test case is routed to one of
+them, and mixed-adapter batches go to a single engine started with
+enable_lora=True, max_loras=MAX_RESIDENT_ADAPTERS.
+
+adapters.json (in the working directory):
+    {
+      "adapters": [
+        {"name": "dspace_adapter", "path": "/workspace/manual_models/adapter", "default": true},
+        {"name": "h100_v2", "path": "/workspace/manual_models/adapter_h100", "prefixes": ["VHIL_H100_"]},
+        {"name": "n600_v1", "path": "/workspace/manual_models/adapter_n600", "prefixes": ["VHIL_N600_"], "id": 7}
+      ]
+    }
+
+Routing order: explicit metadata {"adapter": name} > longest matching filename
+prefix > the default adapter. Ids come from "id" or, if omitted, a CRC32 of
+the name, so they stay the same across runs and processes.
+
+Run this file directly for the routing/batching simulation with a stub engine:
+    python adapter_routing.py
+"""
+
+import os
+import json
+import zlib
+from dataclasses import dataclass
+
+# --- 1. CONFIGURATION ---
+ADAPTERS_FILE = "adapters.json"
+MAX_RESIDENT_ADAPTERS = 2
+
+
+@dataclass(frozen=True)
+class AdapterSpec:
+    name: str
+    lora_id: int
+    path: str
+    prefixes: tuple = ()
+
+
+def stable_lora_id(name):
+    """Positive 31-bit id derived from the adapter name (vLLM needs ids > 0)."""
+    return (zlib.crc32(name.encode("utf-8")) & 0x7FFFFFFF) or 1
+
+
+# --- 2. REGISTRY ---
+class AdapterRegistry:
+    def __init__(self):
+        self.adapters = {}
+        self._ids = {}
+        self.default = None
+
+    def register(self, name, path, prefixes=(), lora_id=None, default=False):
+        if name in self.adapters:
+            raise ValueError(f"Adapter '{name}' registered twice.")
+        lora_id = int(lora_id) if lora_id is not None else stable_lora_id(name)
+        if lora_id <= 0:
+            raise ValueError(f"Adapter '{name}': id must be > 0, got {lora_id}.")
+        if lora_id in self._ids:
+            raise ValueError(f"Adapter id {lora_id} of '{name}' collides with '{self._ids[lora_id]}'; set an explicit id.")
+        spec = AdapterSpec(name, lora_id, path, tuple(prefixes))
+        self.adapters[name] = spec
+        self._ids[lora_id] = name
+        if default or self.default is None:
+            self.default = spec
+        return spec
+
+    @classmethod
+    def from_file(cls, path=ADAPTERS_FILE):
+        with open(path, "r") as f:
+            config = json.load(f)
+        registry = cls()
+        for entry in config.get("adapters", []):
+            registry.register(entry["name"], entry["path"], entry.get("prefixes", ()),
+                              entry.get("id"), entry.get("default", False))
+        if registry.default is None:
+            raise ValueError(f"{path} does not register any adapter.")
+        return registry
+
+    @classmethod
+    def single(cls, name, path, lora_id=1):
+        """The v14 setup: one adapter, id 1, used for every case."""
+        registry = cls()
+        registry.register(name, path, lora_id=lora_id, default=True)
+        return registry
+
+    @classmethod
+    def load(cls, default_name, default_path, path=ADAPTERS_FILE):
+        if os.path.exists(path):
+            return cls.from_file(path)
+        return cls.single(default_name, default_path)
+
+    def route(self, case_name, metadata=None):
+        if metadata and metadata.get("adapter"):
+            name = metadata["adapter"]
+            if name not in self.adapters:
+                raise KeyError(f"Unknown adapter '{name}' (registered: {sorted(self.adapters)})")
+            return self.adapters[name]
+        base = os.path.basename(case_name)
+        best, best_len = self.default, 0
+        for spec in self.adapters.values():
+            for prefix in spec.prefixes:
+                if base.startswith(prefix) and len(prefix) > best_len:
+                    best, best_len = spec, len(prefix)
+        return best
+
+
+# --- 3. BATCH PLANNING ---
+def plan_adapter_batches(jobs, max_loras=MAX_RESIDENT_ADAPTERS, resident=()):
+    """
+    Splits jobs into engine batches with at most max_loras distinct adapters each.
+    Jobs are grouped per adapter (arrival order kept inside a group), adapters that
+    are already resident (by name) go first, and each batch takes whole groups, so
+    every adapter is loaded at most once per call.
+    """
+    groups = {}
+    for job in jobs:
+        groups.setdefault(getattr(job, "adapter", None), []).append(job)
+    resident = set(resident)
+    order = sorted(groups, key=lambda a: ((a.name if a else None) not in resident, -len(groups[a])))
+
+    batches = []
+    for i in range(0, len(order), max(1, max_loras)):
+        batch = []
+        for adapter in order[i:i + max_loras]:
+            batch.extend(groups[adapter])
+        batches.append(batch)
+    return batches
+
+
+# --- 4. SIMULATION ---
+def main():
+    import glob
+    import time
+    import random
+    from conversion_steps import read_csv_rows, csv_row_title
+    from async_pipeline import CaseJob
+    from engine_backends import StubEngine, generate_with_budget
+
+    registry = AdapterRegistry()
+    registry.register("dspace_adapter", "/workspace/manual_models/adapter", default=True)
+    registry.register("h100_v2", "/workspace/manual_models/adapter_h100", ["VHIL_H100_"])
+    registry.register("n600_v1", "/workspace/manual_models/adapter_n600", ["VHIL_N600_"])
+    registry.register("k200_v1", "/workspace/manual_models/adapter_k200", ["VHIL_K200_"])
+
+    titles = []
+    for path in sorted(glob.glob(os.path.join("inputs", "*.csv"))):
+        titles.extend(t for t in (csv_row_title(r) for r in read_csv_rows(path)) if t)
+    if not titles:
+        titles = [f"VHIL_{p}_case_{i}" for p in ("H100", "N600", "K200") for i in range(30)] + ["odo_1", "odo_2"]
+    random.Random(0).shuffle(titles)
+
+    jobs = []
+    for title in titles:
+        job = CaseJob(input_file=title, user_content="Precondition:\n1. step", prompt="x" * 3000)
+        job.adapter = registry.route(title)
+        jobs.append(job)
+    routed = {}
+    for job in jobs:
+        routed[job.adapter.name] = routed.get(job.adapter.name, 0) + 1
+    print(f"--> Routed {len(jobs)} cases: {routed}")
+    print(f"    ids: { {s.name: s.lora_id for s in registry.adapters.values()} }")
+
+    batch_size = 8
+    for label, planned in (("arrival order", False), ("adapter-aware plan", True)):
+        engine = StubEngine(prefill_s=0.05, max_loras=MAX_RESIDENT_ADAPTERS, adapter_load_s=0.02)
+        t0 = time.perf_counter()
+        for i in range(0, len(jobs), batch_size):
+            chunk = jobs[i:i + batch_size]
+            if planned:
+                sub_batches = plan_adapter_batches(chunk, MAX_RESIDENT_ADAPTERS, engine.resident_adapters())
+            else:
+                # Naive: split only where the max_loras limit forces it
+                sub_batches, current, seen = [], [], set()
+                for job in chunk:
+                    if job.adapter not in seen and len(seen) == MAX_RESIDENT_ADAPTERS:
+                        sub_batches.append(current)
+                        current, seen = [], set()
+                    current.append(job)
+                    seen.add(job.adapter)
+                sub_batches.append(current)
+            for sub in sub_batches:
+                generate_with_budget(engine, sub, log=lambda *a: None)
+        print(f"--> {label}: {len(engine.batch_sizes)} engine calls, {engine.adapter_loads} adapter loads, "
+              f"max distinct adapters per batch = {max(engine.batch_adapter_counts)}, "
+              f"{time.perf_counter() - t0:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
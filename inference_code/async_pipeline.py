@@ -0,0 +1,226 @@
+"""
+Streaming producer/consumer pipeline for the batch runner.
+
+v14 used to read a case, filter the context, build the prompt, generate, wrap
+and write it, and only then start on the next case, so the GPU sat idle during
+the CPU work. Here each of those becomes a stage connected by bounded asyncio
+queues:
+
+    reader -> prompt builder -> generator -> writer
+
+The CPU stages run in worker threads, the generator runs in its own single
+thread (one engine), and a full queue blocks the stage upstream of it
+(backpressure). Every stage records how long it was busy, how long it waited
+for input (starved) and how long it waited on a full output queue (blocked).
+
+Run this file directly to see the utilization report with synthetic delays:
+    python async_pipeline.py
+"""
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+_DONE = object()
+
+
+@dataclass
+class CaseJob:
+    input_file: str
+    user_content: str = ""
+    prompt: str = ""
+    text: str = ""
+    output_path: str = ""
+    adapter: object = None     # adapter_routing.AdapterSpec; None = engine default
+    grammar: object = None     # dictionary_grammar.DictionaryGrammar; None = unconstrained
+    sections: list = None      # section_split.py: one CaseJob per output slot
+    windows: list = None       # windowed_generation.py: one CaseJob per step window
+    picked_up: float = field(default_factory=time.time)
+    timings: dict = field(default_factory=dict)
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    busy: float = 0.0
+    starved: float = 0.0      # waiting for input after the first item arrived
+    fill: float = 0.0         # waiting for the very first item (pipeline warm-up)
+    blocked: float = 0.0      # waiting on a full downstream queue
+    started: float = 0.0
+    finished: float = 0.0
+
+    def record_wait(self, seconds):
+        if self.items == 0:
+            self.fill += seconds
+        else:
+            self.starved += seconds
+
+    @property
+    def wall(self):
+        return max(self.finished - self.started, 1e-9)
+
+    @property
+    def utilization(self):
+        return self.busy / self.wall
+
+
+# --- 1. STAGES ---
+async def _put(queue, item, stats):
+    t0 = time.perf_counter()
+    await queue.put(item)
+    stats.blocked += time.perf_counter() - t0
+
+
+async def _reader(input_files, read_fn, out_q, stats, pool):
+    loop = asyncio.get_running_loop()
+    stats.started = time.perf_counter()
+    for input_file in input_files:
+        job = CaseJob(input_file=input_file)
+        t0 = time.perf_counter()
+        job.user_content = await loop.run_in_executor(pool, read_fn, input_file)
+        job.timings["read"] = time.perf_counter() - t0
+        stats.busy += job.timings["read"]
+        stats.items += 1
+        await _put(out_q, job, stats)
+    await out_q.put(_DONE)
+    stats.finished = time.perf_counter()
+
+
+async def _mapper(name, fn, in_q, out_q, stats, pool):
+    """Generic one-in/one-out CPU stage (prompt builder, writer)."""
+    loop = asyncio.get_running_loop()
+    stats.started = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        job = await in_q.get()
+        stats.record_wait(time.perf_counter() - t0)
+        if job is _DONE:
+            if out_q is not None:
+                await out_q.put(_DONE)
+            break
+        t0 = time.perf_counter()
+        await loop.run_in_executor(pool, fn, job)
+        job.timings[name] = time.perf_counter() - t0
+        stats.busy += job.timings[name]
+        stats.items += 1
+        if out_q is not None:
+            await _put(out_q, job, stats)
+    stats.finished = time.perf_counter()
+
+
+async def _generator(generate_fn, in_q, out_q, stats, pool, batch_size):
+    """
+    Takes whatever prompts are ready (up to batch_size) and hands them to the
+    engine in one call, so the engine's own batcher sees them together.
+    """
+    loop = asyncio.get_running_loop()
+    stats.started = time.perf_counter()
+    upstream_done = False
+    while not upstream_done:
+        t0 = time.perf_counter()
+        job = await in_q.get()
+        stats.record_wait(time.perf_counter() - t0)
+        if job is _DONE:
+            break
+        batch = [job]
+        while len(batch) < batch_size and not in_q.empty():
+            nxt = in_q.get_nowait()
+            if nxt is _DONE:
+                upstream_done = True
+                break
+            batch.append(nxt)
+
+        t0 = time.perf_counter()
+        await loop.run_in_executor(pool, generate_fn, batch)
+        elapsed = time.perf_counter() - t0
+        stats.busy += elapsed
+        stats.items += len(batch)
+        for job in batch:
+            job.timings["generate"] = elapsed
+            await _put(out_q, job, stats)
+    await out_q.put(_DONE)
+    stats.finished = time.perf_counter()
+
+
+# --- 2. PIPELINE ---
+async def run_pipeline_async(input_files, read_fn, build_fn, generate_fn, write_fn,
+                             queue_size=4, batch_size=1, cpu_workers=2):
+    """
+    read_fn(path) -> str, build_fn(job), generate_fn([job, ...]) and write_fn(job)
+    fill in the CaseJob fields. Returns (jobs_in_completion_order, stats_by_stage).
+    """
+    read_q = asyncio.Queue(maxsize=queue_size)
+    prompt_q = asyncio.Queue(maxsize=queue_size)
+    write_q = asyncio.Queue(maxsize=queue_size)
+
+    stats = {name: StageStats(name) for name in ("reader", "prompt", "generate", "write")}
+    done_jobs = []
+
+    def write_and_collect(job):
+        write_fn(job)
+        job.timings["latency"] = time.time() - job.picked_up
+        done_jobs.append(job)
+
+    cpu_pool = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix="cpu")
+    gpu_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="engine")
+    try:
+        await asyncio.gather(
+            _reader(input_files, read_fn, read_q, stats["reader"], cpu_pool),
+            _mapper("prompt", build_fn, read_q, prompt_q, stats["prompt"], cpu_pool),
+            _generator(generate_fn, prompt_q, write_q, stats["generate"], gpu_pool, batch_size),
+            _mapper("write", write_and_collect, write_q, None, stats["write"], cpu_pool),
+        )
+    finally:
+        cpu_pool.shutdown(wait=True)
+        gpu_pool.shutdown(wait=True)
+    return done_jobs, stats
+
+
+def run_pipeline(*args, **kwargs):
+    return asyncio.run(run_pipeline_async(*args, **kwargs))
+
+
+def print_utilization(stats):
+    print("\n--> Pipeline Stage Utilization")
+    print(f"    {'stage':<10}{'items':>6}{'util':>8}{'busy(s)':>10}{'fill(s)':>10}{'starved(s)':>12}{'blocked(s)':>12}")
+    for s in stats.values():
+        print(f"    {s.name:<10}{s.items:>6}{s.utilization:>8.1%}{s.busy:>10.2f}{s.fill:>10.2f}{s.starved:>12.2f}{s.blocked:>12.2f}")
+    gen = stats["generate"]
+    print(f"    Generator starved for {gen.starved:.2f}s after warm-up "
+          f"({gen.starved / gen.wall:.1%} of its wall time).")
+
+
+# --- 3. SYNTHETIC DEMO ---
+def main():
+    """Stub stages with v14-like proportions: CPU work well below generate time."""
+    read_s, build_s, gen_s, write_s = 0.01, 0.15, 0.5, 0.02
+
+    def read_fn(path):
+        time.sleep(read_s)
+        return f"Precondition:\n1. {path}"
+
+    def build_fn(job):
+        time.sleep(build_s)
+        job.prompt = job.user_content
+
+    def generate_fn(batch):
+        time.sleep(gen_s)
+        for job in batch:
+            job.text = "<FrameworkBuilder.ActualOperationSlot/>"
+
+    def write_fn(job):
+        time.sleep(write_s)
+
+    files = [f"case_{i:03d}.txt" for i in range(20)]
+    serial = len(files) * (read_s + build_s + gen_s + write_s)
+    t0 = time.perf_counter()
+    jobs, stats = run_pipeline(files, read_fn, build_fn, generate_fn, write_fn)
+    wall = time.perf_counter() - t0
+    print(f"--> {len(jobs)} cases in {wall:.2f}s (serial loop would take {serial:.2f}s)")
+    print_utilization(stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Offline batch requests: export every assembled prompt as an OpenAI batch-request
+JSONL file, run it as one saturated offline job, then ingest the results JSONL
+into the usual wrapped .xml outputs.
+
+Request line (one per case, custom_id = input file name):
+    {"custom_id": "Test_01.txt", "method": "POST", "url": "/v1/completions",
+     "body": {"model": "dspace_adapter", "prompt": "...", "max_tokens": 3100,
+              "temperature": 0.1, "repetition_penalty": 1.15, "stop": [...]}}
+
+Result line (what the OpenAI Batch API and vLLM's run_batch write):
+    {"custom_id": "Test_01.txt", "response": {"status_code": 200,
+     "body": {"choices": [{"text": "...", "finish_reason": "stop"}], "usage": {...}}},
+     "error": null}
+
+Both directions stream line by line. Ingestion keeps only the byte offsets of
+the request lines in memory, which it needs to write a retry batch with a
+larger max_tokens for outputs cut off by max_tokens.
+
+How to use (from the working directory):
+    python batch_export.py export                          # -> batch_requests.jsonl
+    python -m vllm.entrypoints.openai.run_batch -i batch_requests.jsonl -o batch_results.jsonl \
+        --model /workspace/manual_models/base --enable-lora \
+        --lora-modules dspace_adapter=/workspace/manual_models/adapter
+    python batch_export.py ingest                          # -> outputs/*.xml (+ batch_retry.jsonl)
+    python batch_export.py selftest
+"""
+
+import os
+import sys
+import json
+import argparse
+
+from token_budget import predict_max_tokens, next_budget, count_tokens
+from conversion_steps import wrap_xml, output_path_for
+from engine_backends import SAMPLING_DEFAULTS, ADAPTER_NAME, MAX_MODEL_LEN, FIXED_MAX_TOKENS
+
+# --- 1. CONFIGURATION ---
+# Not requests.jsonl: that name is taken by the team's work-order backlog
+REQUESTS_FILE = "batch_requests.jsonl"
+RESULTS_FILE = "batch_results.jsonl"
+RETRY_FILE = "batch_retry.jsonl"
+BATCH_URL = "/v1/completions"
+
+
+# --- 2. EXPORT ---
+def request_line(job, budget_model=None, fixed_max_tokens=FIXED_MAX_TOKENS, max_model_len=MAX_MODEL_LEN):
+    """One batch request for a built job (.input_file, .user_content, .prompt, .adapter)."""
+    ceiling = max_model_len - count_tokens(job.prompt)
+    if budget_model:
+        max_tokens = predict_max_tokens(budget_model, job.user_content, ceiling=ceiling)
+    else:
+        max_tokens = min(fixed_max_tokens, ceiling)
+    body = {"model": job.adapter.name if job.adapter else ADAPTER_NAME, "prompt": job.prompt}
+    body.update(SAMPLING_DEFAULTS)
+    body["max_tokens"] = max_tokens
+    return {"custom_id": os.path.basename(job.input_file), "method": "POST", "url": BATCH_URL, "body": body}
+
+
+def export_batch(jobs, path=REQUESTS_FILE, budget_model=None, fixed_max_tokens=FIXED_MAX_TOKENS,
+                 max_model_len=MAX_MODEL_LEN):
+    """Writes one request per job as the jobs come in (jobs may be a generator). Returns the count."""
+    count = 0
+    seen = set()
+    with open(path, "w", encoding="utf-8") as f:
+        for job in jobs:
+            line = request_line(job, budget_model, fixed_max_tokens, max_model_len)
+            if line["custom_id"] in seen:
+                raise ValueError(f"Duplicate custom_id {line['custom_id']}")
+            seen.add(line["custom_id"])
+            f.write(json.dumps(line) + "\n")
+            count += 1
+    return count
+
+
+# --- 3. INGEST ---
+def _index_requests(path):
+    """custom_id -> byte offset of its line, so a retry can re-read just that request."""
+    offsets = {}
+    with open(path, "rb") as f:
+        while True:
+            offset = f.tell()
+            raw = f.readline()
+            if not raw:
+                break
+            if raw.strip():
+                offsets[json.loads(raw)["custom_id"]] = offset
+    return offsets
+
+
+def _read_request(f, offset):
+    f.seek(offset)
+    return json.loads(f.readline())
+
+
+def parse_result(line):
+    """(custom_id, text, finish_reason, completion_tokens, error) from one result line."""
+    custom_id = line.get("custom_id")
+    if line.get("error"):
+        return custom_id, None, None, 0, str(line["error"])
+    response = line.get("response") or {}
+    if response.get("status_code", 200) != 200:
+        return custom_id, None, None, 0, f"HTTP {response.get('status_code')}: {response.get('body')}"
+    body = response.get("body") or {}
+    choices = body.get("choices") or []
+    if not choices:
+        return custom_id, None, None, 0, "no choices in response"
+    choice = choices[0]
+    # /v1/completions has "text"; tolerate chat-format results too
+    text = choice.get("text")
+    if text is None:
+        text = (choice.get("message") or {}).get("content", "")
+    tokens = (body.get("usage") or {}).get("completion_tokens", 0)
+    return custom_id, text, choice.get("finish_reason") or "stop", tokens, None
+
+
+def ingest_results(results_path=RESULTS_FILE, output_dir="outputs", requests_path=REQUESTS_FILE,
+                   retry_path=RETRY_FILE, max_model_len=MAX_MODEL_LEN, log=print):
+    """
+    Writes outputs/<case>.xml for every result. Outputs cut off by max_tokens are
+    still written (like the online runner at its ceiling) and, when the requests
+    file is available, also go into retry_path with a larger max_tokens.
+    Returns a summary dict.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    offsets = _index_requests(requests_path) if requests_path and os.path.exists(requests_path) else {}
+    summary = {"written": 0, "errors": 0, "truncated": 0, "retried": 0, "completion_tokens": 0}
+    retry_f = None
+    requests_f = open(requests_path, "rb") if offsets else None
+    try:
+        with open(results_path, "r", encoding="utf-8") as results:
+            for raw in results:
+                if not raw.strip():
+                    continue
+                custom_id, text, finish_reason, tokens, error = parse_result(json.loads(raw))
+                if error:
+                    summary["errors"] += 1
+                    log(f"    [ERROR] {custom_id}: {error}")
+                    continue
+                output_path = output_path_for(custom_id, output_dir)
+                with open(output_path, "w") as f:
+                    f.write(wrap_xml(text.strip()))
+                summary["written"] += 1
+                summary["completion_tokens"] += tokens
+                if finish_reason != "length":
+                    continue
+                summary["truncated"] += 1
+                if custom_id not in offsets:
+                    log(f"    [WARNING] {custom_id}: truncated, no request to retry from.")
+                    continue
+                request = _read_request(requests_f, offsets[custom_id])
+                ceiling = max_model_len - count_tokens(request["body"]["prompt"])
+                new_budget = next_budget(request["body"]["max_tokens"], ceiling)
+                if new_budget is None:
+                    log(f"    [WARNING] {custom_id}: truncated at the context window limit.")
+                    continue
+                request["body"]["max_tokens"] = new_budget
+                if retry_f is None:
+                    retry_f = open(retry_path, "w", encoding="utf-8")
+                retry_f.write(json.dumps(request) + "\n")
+                summary["retried"] += 1
+                log(f"    [RETRY] {custom_id}: truncated, queued with max_tokens={new_budget}")
+    finally:
+        if retry_f:
+            retry_f.close()
+        if requests_f:
+            requests_f.close()
+    return summary
+
+
+# --- 4. ENTRY POINTS ---
+def build_jobs(input_dir="inputs", context_path="context.txt"):
+    """Yields built jobs for every .txt case, one at a time (prompt + adapter route)."""
+    import io
+    import contextlib
+    from async_pipeline import CaseJob
+    from conversion_steps import list_input_files, read_file, build_library_index, filter_context, build_prompt
+    from adapter_routing import AdapterRegistry
+    from engine_backends import ADAPTER_PATH
+
+    library_index = build_library_index(read_file(context_path))
+    registry = AdapterRegistry.load(ADAPTER_NAME, ADAPTER_PATH)
+    for input_file in sorted(list_input_files(input_dir)):
+        job = CaseJob(input_file=input_file, user_content=read_file(input_file))
+        job.adapter = registry.route(input_file)
+        with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+            job.prompt = build_prompt(filter_context(library_index, job.user_content), job.user_content)
+        yield job
+
+
+def selftest():
+    """Export -> fake offline run (replay engine, one truncation) -> ingest -> retry file."""
+    import tempfile
+    from engine_backends import ReplayEngine
+
+    base = tempfile.mkdtemp()
+    requests_path = os.path.join(base, REQUESTS_FILE)
+    results_path = os.path.join(base, RESULTS_FILE)
+    retry_path = os.path.join(base, RETRY_FILE)
+    count = export_batch(build_jobs(), requests_path)
+    print(f"--> Exported {count} requests ({os.path.getsize(requests_path) / 1024:.0f} KiB)")
+
+    engine = ReplayEngine("outputs.zip", "inputs.zip")
+    with open(requests_path, "r") as src, open(results_path, "w") as dst:
+        for i, raw in enumerate(src):
+            request = json.loads(raw)
+            sampling = {k: v for k, v in request["body"].items() if k not in ("model", "prompt")}
+            if i == 0:
+                sampling["max_tokens"] = 100   # force one truncated output
+            result = engine.generate([request["body"]["prompt"]], sampling)[0]
+            dst.write(json.dumps({"id": f"batch_req_{i}", "custom_id": request["custom_id"], "error": None,
+                                  "response": {"status_code": 200, "body": {
+                                      "choices": [{"index": 0, "text": result.text, "finish_reason": result.finish_reason}],
+                                      "usage": {"completion_tokens": result.num_output_tokens}}}}) + "\n")
+    summary = ingest_results(results_path, os.path.join(base, "outputs"), requests_path, retry_path)
+    print(f"--> Ingested: {summary}")
+    print(f"    outputs: {sorted(os.listdir(os.path.join(base, 'outputs')))}, retry file: {os.path.exists(retry_path)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI batch-format export / results ingestion.")
+    parser.add_argument("command", choices=["export", "ingest", "selftest"])
+    parser.add_argument("--inputs", default="inputs")
+    parser.add_argument("--outputs", default="outputs")
+    parser.add_argument("--context", default="context.txt")
+    parser.add_argument("--requests", default=REQUESTS_FILE)
+    parser.add_argument("--results", default=RESULTS_FILE)
+    parser.add_argument("--retry", default=RETRY_FILE)
+    args = parser.parse_args()
+
+    if args.command == "selftest":
+        return selftest()
+    if args.command == "export":
+        from token_budget import load_budget_model
+        count = export_batch(build_jobs(args.inputs, args.context), args.requests, load_budget_model())
+        print(f"--> Wrote {count} batch requests to {args.requests}")
+    else:
+        summary = ingest_results(args.results, args.outputs, args.requests, args.retry)
+        print(f"--> Wrote {summary['written']} outputs ({summary['errors']} errors, {summary['truncated']} truncated, "
+              f"{summary['retried']} queued in {args.retry}).")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+"""
+Best-of-n generation: ask the engine for n samples of each prompt in one call,
+check every sample locally and keep the best one, instead of regenerating the
+whole case (and paying its 20-30k-token prefill again) when the XML is broken.
+
+The n samples share one prefill: vLLM forks the prompt's KV cache blocks for
+them and they decode side by side in the same engine steps. Each sample is
+scored with output_validation.validate_case(), the check the run ends with:
+    - well-formed XML,
+    - exactly the Initialization / StepsAndEvaluation / Cleanup
+      ActualOperationSlots,
+    - every block a dictionary entry with the dictionary's id and required
+      parameters (output_checks.LINK_GAPS and libraries the dictionary does
+      not cover are let through, as block_repair.DictionaryIndex does).
+A case is accepted if at least one sample passes. Otherwise a well-formed
+sample with the fewest problems is kept (any well-formed sample ranks above
+every broken one) and the case is counted as rejected.
+
+Running this file compares best-of-n with sequential retries (generate,
+validate, regenerate up to MAX_ATTEMPTS times) on the recorded targets. Each
+sample is broken at --failure-rate in one of the ways seen in outputs.zip, and
+every engine call is priced with capacity_planner's A100 model (one prefill
+per call, decode steps for the longest sample at the call's concurrency).
+
+How to use:
+    BEST_OF_N = 4 in run_batch_tests_v14.py (1 = off)
+    python best_of_n.py [--n 4] [--failure-rate 0.3] [--prompt-tokens 20000]
+"""
+
+import os
+import random
+import argparse
+
+from token_budget import next_budget
+from conversion_steps import build_prompt
+from output_checks import load_dictionary, DICTIONARY_FILE
+from output_validation import validate_case
+from block_repair import DictionaryIndex, START_TAG, LINK_ATTR, ID_ATTR, _set_attribute
+from engine_backends import (ReplayEngine, SAMPLING_DEFAULTS, FIXED_MAX_TOKENS, ENGINE_ARGS,
+                             budget_jobs)
+
+# --- 1. CONFIGURATION ---
+NUM_SAMPLES = 4
+# With several samples, v14's temperature 0.1 would return n near-copies
+SAMPLE_TEMPERATURE = 0.6
+MAX_ATTEMPTS = 4          # sequential-retry baseline in the simulation
+FAILURE_RATE = 0.3        # per sample, in the simulation
+PROMPT_TOKENS = 20000
+RECORDINGS = "targets/targets.zip"
+
+
+# --- 2. SCORING ---
+_INDEXES = {}
+
+
+def _index_for(dictionary):
+    """The DictionaryIndex of a load_dictionary() result, built once per dictionary."""
+    if dictionary is None:
+        return None
+    if id(dictionary) not in _INDEXES:
+        _INDEXES.clear()
+        _INDEXES[id(dictionary)] = (dictionary, DictionaryIndex(list(dictionary.values())))
+    return _INDEXES[id(dictionary)][1]
+
+
+def score_sample(result, dictionary=None):
+    """validate_case() of one GenerationResult as {"ok", "errors", "well_formed"}, plus a sort key (higher is better)."""
+    _, problems, _ = validate_case("", result.text.strip(), dictionary, _index_for(dictionary))
+    check = {"ok": not problems, "errors": [reason for _, reason in problems],
+             "well_formed": not any(kind == "xml" for kind, _ in problems)}
+    check["key"] = (check["well_formed"], check["ok"], result.finish_reason != "length", -len(problems))
+    return check
+
+
+def pick_best(result, dictionary=None):
+    """(best sample, its check, number of valid samples) of a GenerationResult."""
+    samples = result.samples or [result]
+    checks = [score_sample(sample, dictionary) for sample in samples]
+    best = max(range(len(samples)), key=lambda i: checks[i]["key"])
+    return samples[best], checks[best], sum(1 for c in checks if c["ok"])
+
+
+def generate_best_of_n(engine, jobs, n=NUM_SAMPLES, dictionary=None, budget_model=None,
+                       fixed_max_tokens=FIXED_MAX_TOKENS, temperature=SAMPLE_TEMPERATURE,
+                       records=None, log=print):
+    """
+    generate_with_budget() with n samples per prompt: sets job.text to the best
+    sample and job.accepted. When every sample was cut off by max_tokens, the
+    case is retried with a larger budget. One record per engine call per case
+    goes into `records` (see print_report).
+    """
+    pending = budget_jobs(engine, jobs, budget_model, fixed_max_tokens, log)
+    while pending:
+        sampling = [dict(SAMPLING_DEFAULTS, max_tokens=max_tokens, n=n, temperature=temperature,
+                         grammar=getattr(job, "grammar", None)) for job, max_tokens, _ in pending]
+        adapters = [getattr(job, "adapter", None) for job, _, _ in pending]
+        if any(a is not None for a in adapters):
+            results = engine.generate([job.prompt for job, _, _ in pending], sampling, adapters)
+        else:
+            results = engine.generate([job.prompt for job, _, _ in pending], sampling)
+
+        retry = []
+        for (job, max_tokens, ceiling), result in zip(pending, results):
+            samples = result.samples or [result]
+            best, check, valid = pick_best(result, dictionary)
+            job.text = best.text.strip()
+            job.accepted = check["ok"]
+            name = os.path.basename(job.input_file)
+            log(f"    [BEST-OF-N] {name}: {valid}/{len(samples)} samples valid, "
+                f"kept #{samples.index(best)} ({len(check['errors'])} errors)")
+            if records is not None:
+                records.append({"case": name, "samples": len(samples), "valid": valid,
+                                "first_valid": score_sample(samples[0], dictionary)["ok"],
+                                "prompt_tokens": engine.count_tokens(job.prompt),
+                                "output_tokens": sum(s.num_output_tokens for s in samples)})
+            if valid or any(s.finish_reason != "length" for s in samples):
+                continue
+            new_budget = next_budget(max_tokens, ceiling)
+            if new_budget is None:
+                log(f"    [WARNING] {job.input_file}: every sample truncated at the context window limit.")
+                continue
+            log(f"    [RETRY] {job.input_file}: every sample truncated, retrying with max_tokens={new_budget}")
+            retry.append((job, new_budget, ceiling))
+        pending = retry
+
+
+def print_report(records, log=print):
+    """Acceptance over the cases of a run (the last record of each case counts)."""
+    if not records:
+        return
+    last = {}
+    for record in records:
+        last[record["case"]] = record
+    accepted = sum(1 for r in last.values() if r["valid"])
+    rescued = sum(1 for r in last.values() if r["valid"] and not r["first_valid"])
+    samples = sum(r["samples"] for r in records)
+    log(f"    [BEST-OF-N] accepted {accepted}/{len(last)} cases ({accepted / len(last):.0%}); "
+        f"{rescued} only because a later sample was valid (each one a full rerun before); "
+        f"{samples} samples from {len(records)} prefills")
+
+
+# --- 3. SIMULATION ---
+class FlakyReplayEngine(ReplayEngine):
+    """ReplayEngine whose samples are each broken with probability failure_rate."""
+
+    def __init__(self, recordings_path, failure_rate=FAILURE_RATE, seed=0, dictionary=None, **kwargs):
+        super().__init__(recordings_path, inputs_path=recordings_path, prefill_s=0.0, **kwargs)
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.dictionary = dictionary
+
+    def sample_for(self, prompt, full_text, index):
+        if self.rng.random() >= self.failure_rate:
+            return full_text
+        return corrupt(full_text, self.rng, self.dictionary)
+
+
+def corrupt(text, rng, dictionary=None):
+    """
+    One of the failures seen in generated outputs. The id and link breaks hit
+    the first block the dictionary knows: a block outside it takes any id,
+    and a misspelled link into a library the dictionary lacks still passes.
+    """
+    kind = rng.choice(["tag", "repeat", "bad-id", "bad-link"])
+    if kind == "tag":       # a mismatched closing tag (</subsystem> for </subsystems>)
+        return text.replace("</subsystems>", "</subsystem>", 1)
+    if kind == "repeat":    # the three slots generated twice (outputs.zip input1.xml)
+        return text + "\n" + text
+    block = next((m for m in START_TAG.finditer(text)
+                  if dictionary is None or LINK_ATTR.search(m.group()).group(1) in dictionary), None)
+    if block is None:
+        return text + "\n" + text
+    tag = block.group()
+    if kind == "bad-id":
+        tag = _set_attribute(tag, ID_ATTR, "id", f"{{{rng.getrandbits(128):032X}}}", LINK_ATTR)
+    else:
+        tag = _set_attribute(tag, LINK_ATTR, "library-link", LINK_ATTR.search(tag).group(1) + "_CHECK")
+    return text[:block.start()] + tag + text[block.end():]
+
+
+def call_cost_s(prompt_tokens, output_tokens, concurrency, gpu_name="A100-80G"):
+    """GPU seconds of one engine call: one prefill, then output_tokens decode steps."""
+    from capacity_planner import load_model_config, memory_plan, throughput, GPUS
+
+    cfg = load_model_config()
+    gpu = GPUS[gpu_name]
+    plan = memory_plan(cfg, gpu, ENGINE_ARGS)
+    summary = {"prompt_mean": prompt_tokens, "output_mean": output_tokens}
+    perf = throughput(cfg, gpu, plan, summary, concurrency, ENGINE_ARGS["enforce_eager"])
+    return perf["prefill_s"] + output_tokens * perf["decode_step_ms"] / 1000
+
+
+def simulate(strategy, engine, cases, dictionary, n, max_attempts, prompt_tokens):
+    """strategy "sequential" (n=1, rerun until valid) or "best-of-n" (one call). Returns totals."""
+    totals = {"cases": len(cases), "accepted": 0, "calls": 0, "prefill_tokens": 0,
+              "decode_tokens": 0, "gpu_s": 0.0}
+    for prompt in cases:
+        attempts = max_attempts if strategy == "sequential" else 1
+        samples = 1 if strategy == "sequential" else n
+        for _ in range(attempts):
+            result = engine.generate([prompt], dict(SAMPLING_DEFAULTS, max_tokens=32768, n=samples))[0]
+            _, check, valid = pick_best(result, dictionary)
+            longest = max(s.num_output_tokens for s in result.samples or [result])
+            totals["calls"] += 1
+            totals["prefill_tokens"] += prompt_tokens
+            totals["decode_tokens"] += sum(s.num_output_tokens for s in result.samples or [result])
+            totals["gpu_s"] += call_cost_s(prompt_tokens, longest, samples)
+            if valid:
+                totals["accepted"] += 1
+                break
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Best-of-n vs sequential retries on the recorded targets.")
+    parser.add_argument("--n", type=int, default=NUM_SAMPLES)
+    parser.add_argument("--failure-rate", type=float, default=FAILURE_RATE)
+    parser.add_argument("--max-attempts", type=int, default=MAX_ATTEMPTS)
+    parser.add_argument("--prompt-tokens", type=int, default=PROMPT_TOKENS)
+    parser.add_argument("--recordings", default=RECORDINGS)
+    parser.add_argument("--dictionary", default=DICTIONARY_FILE)
+    args = parser.parse_args()
+
+    dictionary = load_dictionary(args.dictionary)
+    print(f"--> {len(dictionary)} dictionary entries, samples broken at p={args.failure_rate}, "
+          f"{args.prompt_tokens}-token prompts, costs from capacity_planner (A100-80G, v14 ENGINE_ARGS)")
+
+    rows = []
+    for strategy in ("sequential", "best-of-n"):
+        engine = FlakyReplayEngine(args.recordings, args.failure_rate, dictionary=dictionary)
+        cases = []
+        for i, recording in enumerate(engine.recordings):
+            user_content = f"case {i}"
+            engine.by_case[user_content] = recording
+            cases.append(build_prompt("", user_content))
+        label = f"sequential (<= {args.max_attempts} attempts)" if strategy == "sequential" else f"best-of-{args.n} (1 call)"
+        rows.append((label, simulate(strategy, engine, cases, dictionary, args.n, args.max_attempts, args.prompt_tokens)))
+
+    print(f"\n    {'strategy':<28} {'accepted':>9} {'calls':>6} {'prefill Mtok':>13} {'decode Mtok':>12} "
+          f"{'GPU s/case':>11} {'GPU s/accepted':>15}")
+    for label, t in rows:
+        per_accepted = t["gpu_s"] / t["accepted"] if t["accepted"] else float("inf")
+        print(f"    {label:<28} {t['accepted'] / t['cases']:>9.1%} {t['calls']:>6} {t['prefill_tokens'] / 1e6:>13.2f} "
+              f"{t['decode_tokens'] / 1e6:>12.2f} {t['gpu_s'] / t['cases']:>11.1f} {per_accepted:>15.1f}")
+    index = _index_for(dictionary)
+    clean = sum(1 for r in FlakyReplayEngine(args.recordings, 0.0).recordings
+                if not validate_case("", r, dictionary, index)[1])
+    print(f"\n    ({clean}/{rows[0][1]['cases']} recordings pass validate_case() unbroken; "
+          f"the rest are not well-formed XML and can never be accepted.)")
+
+
+if __name__ == "__main__":
+    main()
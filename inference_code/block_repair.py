@@ -0,0 +1,314 @@
+"""
+Deterministic repair of LibraryLinkBlock library-links and ids after
+generation, so a case with one bad GUID is fixed in microseconds instead of
+being decoded again.
+
+DictionaryIndex holds three hash maps built once from
+cleaned_dictionary_master.json: library_link -> entry, id -> entry and
+normalized name -> entry (lower case, library prefix and punctuation dropped,
+from the library_link and the concept; names shared by two entries are left
+out). repair_blocks() rewrites each block's start tag in place, keeping the
+rest of the text byte for byte:
+    link known                  id missing -> added (FILL_MISSING_IDS),
+                                id wrong   -> the entry's id
+    link unknown, id known      link       -> the entry of the id
+    link unknown, id unknown    link, id   -> the entry whose normalized name
+                                              matches the link (or the block's
+                                              name when the link is missing)
+    nothing matches             the block is unknown: the case is regenerated
+Links into libraries the dictionary does not cover at all (XIL API
+Convenience, Test Builder) and output_checks.LINK_GAPS are left as they are.
+
+With REPAIR_BLOCKS, v14 repairs every generated case and regenerates only the
+ones that still have unknown blocks. The regenerated output (sampled at
+ABORT_RETRY_SAMPLING's higher temperature) replaces the first one only when it
+is better: fewer check_output errors, then fewer unknown blocks
+(keep_better). Running this file breaks the targets in
+the ways the model breaks blocks, repairs them and reports the repair counts,
+the cases that still need regeneration and the decode time the repairs save;
+then it repairs the recorded outputs.
+
+How to use:
+    REPAIR_BLOCKS = True in run_batch_tests_v14.py
+    python block_repair.py outputs/ [--write]      # repair a finished run
+    python block_repair.py --benchmark
+"""
+
+import os
+import re
+import sys
+import time
+import random
+import argparse
+from collections import Counter
+
+from output_checks import load_dictionary, check_output, iter_outputs, DICTIONARY_FILE, LINK_TAG, LINK_GAPS
+
+# --- 1. CONFIGURATION ---
+FILL_MISSING_IDS = True     # give blocks without an id their entry's id
+START_TAG = re.compile(r"<" + re.escape(LINK_TAG) + r"\b[^>]*>")
+ATTRIBUTE = r'\s{0}="([^"]*)"'
+LINK_ATTR = re.compile(ATTRIBUTE.format("library-link"))
+ID_ATTR = re.compile(ATTRIBUTE.format("id"))
+NAME_ATTR = re.compile(ATTRIBUTE.format("name"))
+REQUIRES = re.compile(r"\(Requires:.*?\)\s*$")
+
+
+def normalize(name):
+    """'TVSM_Library.Set_Battery_Voltage 13.5' -> 'setbatteryvoltage135'."""
+    return re.sub(r"[^a-z0-9]", "", name.split(".", 1)[-1].lower())
+
+
+def library_key(link):
+    """'TVSM_Library.X' -> 'tvsmlibrary': the library, however the model spelled it."""
+    return re.sub(r"[^a-z0-9]", "", link.split(".", 1)[0].lower())
+
+
+# --- 2. INDEX AND REPAIR ---
+class DictionaryIndex:
+    def __init__(self, entries):
+        self.by_link = {e["library_link"]: e for e in entries if e.get("library_link")}
+        self.by_id = {e["id"]: e for e in self.by_link.values() if e.get("id")}
+        names = {}
+        for entry in self.by_link.values():
+            keys = {normalize(entry["library_link"]), normalize(REQUIRES.sub("", entry.get("concept", "")))}
+            for key in keys - {""}:
+                names.setdefault(key, []).append(entry)
+        self.by_name = {key: found[0] for key, found in names.items() if len(found) == 1}
+        self.libraries = {library_key(link) for link in self.by_link}
+
+    @classmethod
+    def load(cls, path=DICTIONARY_FILE):
+        return cls(list(load_dictionary(path).values()))
+
+    def resolve(self, link, gid, name):
+        """(entry, how) for one block, how naming the repair; (None, "external" / "unknown") if there is no entry."""
+        entry = self.by_link.get(link)
+        if entry is not None:
+            if gid == entry.get("id") or not entry.get("id") or (gid is None and not FILL_MISSING_IDS):
+                return entry, "ok"
+            return entry, "id added" if gid is None else "id corrected"
+        if link in LINK_GAPS or (link and "." in link and library_key(link) not in self.libraries):
+            return None, "external"
+        entry = self.by_id.get(gid)
+        if entry is not None:
+            return entry, "link from id"
+        entry = self.by_name.get(normalize(link)) if link else None
+        if entry is None and not link and name:
+            entry = self.by_name.get(normalize(re.sub(r"\d+$", "", name)))
+        if entry is not None:
+            return entry, "link by name"
+        return None, "unknown"
+
+
+def _set_attribute(tag, pattern, name, value, after=None):
+    """tag with attribute name set to value (added after the `after` attribute, or after the element name)."""
+    match = pattern.search(tag)
+    if match:
+        return tag[:match.start(1)] + value + tag[match.end(1):]
+    anchor = after.search(tag) if after is not None else None
+    at = anchor.end() if anchor else len("<" + LINK_TAG)
+    return f'{tag[:at]} {name}="{value}"{tag[at:]}'
+
+
+def repair_blocks(text, index):
+    """
+    (repaired text, Counter of how each block resolved, [unknown links]).
+    Only the start tags of LibraryLinkBlocks change.
+    """
+    counts, unknown = Counter(), []
+
+    def fix(match):
+        tag = match.group()
+        link, gid, name = (m.group(1) if m else None for m in (p.search(tag) for p in (LINK_ATTR, ID_ATTR, NAME_ATTR)))
+        entry, how = index.resolve(link, gid, name)
+        counts[how] += 1
+        if entry is None:
+            if how == "unknown":
+                unknown.append(link or f"(no library-link, name {name})")
+            return tag
+        tag = _set_attribute(tag, LINK_ATTR, "library-link", entry["library_link"], NAME_ATTR)
+        if entry.get("id") and (gid is not None or FILL_MISSING_IDS):
+            tag = _set_attribute(tag, ID_ATTR, "id", entry["id"], LINK_ATTR)
+        return tag
+
+    return START_TAG.sub(fix, text), counts, unknown
+
+
+def needs_regeneration(text, index, dictionary):
+    """The reasons a case would have to be decoded again: structural errors, or blocks the dictionary contradicts."""
+    result = check_output(text, dictionary)
+    reasons = list(result["errors"])
+    for match in START_TAG.finditer(text):
+        tag = match.group()
+        link, gid, name = (m.group(1) if m else None for m in (p.search(tag) for p in (LINK_ATTR, ID_ATTR, NAME_ATTR)))
+        _, how = index.resolve(link, gid, name)
+        if how not in ("ok", "external", "id added"):
+            reasons.append(f"{how}: {link}")
+    return reasons
+
+
+def repair_jobs(jobs, index, log=print):
+    """Repairs job.text of every job in place; returns the jobs that still have unknown blocks."""
+    unrepaired = []
+    for job in jobs:
+        job.text, counts, unknown = repair_blocks(job.text, index)
+        fixed = {how: n for how, n in counts.items() if how not in ("ok", "external", "unknown")}
+        if fixed:
+            log(f"    [REPAIR] {os.path.basename(job.input_file)}: "
+                + ", ".join(f"{how} {n}" for how, n in sorted(fixed.items())))
+        if unknown:
+            log(f"    [REGENERATE] {os.path.basename(job.input_file)}: unknown block(s) {', '.join(unknown[:3])}")
+            unrepaired.append(job)
+    return unrepaired
+
+
+def attempt_score(text, index):
+    """(check_output errors, unknown blocks) of one repaired output: lower is better."""
+    return len(check_output(text, index.by_link)["errors"]), len(repair_blocks(text, index)[2])
+
+
+def keep_better(jobs, first_texts, index, log=print):
+    """
+    After regenerating jobs: puts each job's first (repaired) text back unless
+    the new one scores better. A tie keeps the first, decoded at the lower temperature.
+    """
+    for job, first in zip(jobs, first_texts):
+        before, after = attempt_score(first, index), attempt_score(job.text, index)
+        if after < before:
+            continue
+        job.text = first
+        log(f"    [REGENERATE] {os.path.basename(job.input_file)}: kept the first attempt "
+            f"({before[0]} errors, {before[1]} unknown blocks; the new one has {after[0]}, {after[1]})")
+
+
+# --- 3. COMMAND LINE AND BENCHMARK ---
+def repair_folder(path, index, write=False, log=print):
+    """Repairs every .xml under path (in place with write=True); returns the names that need regeneration."""
+    regenerate, totals = [], Counter()
+    for name, text in iter_outputs(path):
+        repaired, counts, unknown = repair_blocks(text, index)
+        totals.update(counts)
+        if unknown:
+            regenerate.append(name)
+            log(f"    [REGENERATE] {name}: {', '.join(unknown[:3])}")
+        if write and repaired != text and os.path.isdir(path):
+            with open(os.path.join(path, name), "w", encoding="utf-8") as f:
+                f.write(repaired)
+    log("--> Blocks: " + ", ".join(f"{how} {n}" for how, n in totals.most_common()))
+    log(f"--> {len(regenerate)} case(s) to regenerate" + ("" if write else " (dry run: --write saves the repairs)"))
+    return regenerate
+
+
+def _guid(rng):
+    return "{%08X-%04X-%04X-%04X-%012X}" % (rng.getrandbits(32), rng.getrandbits(16), rng.getrandbits(16),
+                                            rng.getrandbits(16), rng.getrandbits(48))
+
+
+def _break_tag(tag, kind, index, rng):
+    link = LINK_ATTR.search(tag).group(1)
+    entry = index.by_link[link]
+    if kind == "wrong id":
+        return _set_attribute(tag, ID_ATTR, "id", _guid(rng), LINK_ATTR)
+    if kind == "another entry's id":
+        return _set_attribute(tag, ID_ATTR, "id", rng.choice(list(index.by_id)), LINK_ATTR)
+    if kind == "link lost, id kept":
+        tag = _set_attribute(tag, ID_ATTR, "id", entry["id"], LINK_ATTR)
+        return LINK_ATTR.sub("", tag)
+    if kind == "link misspelled":
+        garbled = rng.choice([link.lower(), link.split(".", 1)[1], link.replace("_", " "), link.replace("_", "")])
+        return _set_attribute(tag, LINK_ATTR, "library-link", garbled)
+    if kind == "invented link":
+        return _set_attribute(tag, LINK_ATTR, "library-link", link + "_AND_VERIFY")
+    raise ValueError(kind)
+
+
+BREAKS = ("wrong id", "another entry's id", "link lost, id kept", "link misspelled", "invented link")
+
+
+def benchmark(args):
+    from token_budget import load_targets, extract_slots, count_tokens, TARGETS_PATH
+    from capacity_planner import load_model_config, plan_profile, throughput, measure_lengths, summarize_lengths, GPUS
+
+    t0 = time.perf_counter()
+    index = DictionaryIndex.load(args.dictionary)
+    dictionary = load_dictionary(args.dictionary)
+    print(f"--> Index of {len(index.by_link)} entries ({len(index.by_id)} ids, {len(index.by_name)} names) "
+          f"built in {(time.perf_counter() - t0) * 1000:.1f} ms")
+
+    texts = [extract_slots(t) for _, t in sorted(load_targets(TARGETS_PATH).items())]
+    texts = [t for t in texts if START_TAG.search(t)]
+    gaps = Counter(link for t in texts for link in repair_blocks(t, index)[2])
+    clean = [t for t in texts if not needs_regeneration(t, index, dictionary)]
+    lacking = f" (links it lacks: {', '.join(f'{l} x{n}' for l, n in gaps.most_common(3))})" if gaps else ""
+    print(f"--> {len(texts)} targets with blocks, {len(clean)} that the dictionary fully explains{lacking}")
+
+    cfg = load_model_config()
+    summary = summarize_lengths(measure_lengths())
+    profile = plan_profile(args.gpu, cfg, summary)
+    step_s = throughput(cfg, GPUS[args.gpu], profile["memory"], summary, 1,
+                        profile["engine_args"]["enforce_eager"])["decode_step_ms"] / 1000
+
+    rng = random.Random(args.seed)
+    print(f"\n    {'break (1-3 blocks per case)':<28} {'cases':>6} {'repaired':>9} {'regenerate':>11} "
+          f"{'us per case':>12} {'decode saved s':>15}")
+    total = avoided = 0
+    avoided_s = 0.0
+    for kind in BREAKS:
+        cases = repaired = regenerate = 0
+        repair_s = saved_s = 0.0
+        for text in clean:
+            tags = [m for m in START_TAG.finditer(text)
+                    if LINK_ATTR.search(m.group()) and LINK_ATTR.search(m.group()).group(1) in index.by_link]
+            if not tags:
+                continue
+            broken = text
+            for m in sorted(rng.sample(tags, min(len(tags), rng.randint(1, 3))), key=lambda m: -m.start()):
+                broken = broken[:m.start()] + _break_tag(m.group(), kind, index, rng) + broken[m.end():]
+            if not needs_regeneration(broken, index, dictionary):
+                continue   # e.g. a missing id alone is not an error
+            cases += 1
+            t0 = time.perf_counter()
+            fixed, _, unknown = repair_blocks(broken, index)
+            repair_s += time.perf_counter() - t0
+            if unknown or needs_regeneration(fixed, index, dictionary):
+                regenerate += 1
+            else:
+                repaired += 1
+                saved_s += count_tokens(text) * step_s
+        total += cases
+        avoided += repaired
+        avoided_s += saved_s
+        print(f"    {kind:<28} {cases:>6} {repaired / max(cases, 1):>9.0%} {regenerate / max(cases, 1):>11.0%} "
+              f"{repair_s / max(cases, 1) * 1e6:>12.0f} {saved_s:>15.0f}")
+    print(f"--> {avoided}/{total} broken cases repaired without regenerating: {avoided_s / 60:.0f} GPU minutes of "
+          f"decode avoided ({args.gpu} profile, {step_s * 1000:.1f} ms per step at one sequence)")
+
+    if os.path.exists(args.recordings):
+        print(f"\n--> Recorded outputs ({args.recordings}):")
+        repair_folder(args.recordings, index, log=lambda line: print("    " + line.lstrip()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Repair library-links and ids of generated blocks.")
+    parser.add_argument("path", nargs="?", default="outputs", help="Folder or .zip of outputs.")
+    parser.add_argument("--write", action="store_true", help="Save the repaired files (folders only).")
+    parser.add_argument("--regenerate-list", default="", help="Write the names of the cases to regenerate here.")
+    parser.add_argument("--dictionary", default=DICTIONARY_FILE)
+    parser.add_argument("--benchmark", action="store_true", help="Break and repair the targets instead.")
+    parser.add_argument("--recordings", default="outputs.zip")
+    parser.add_argument("--gpu", default="H200-141G")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        return benchmark(args)
+    regenerate = repair_folder(args.path, DictionaryIndex.load(args.dictionary), args.write)
+    if args.regenerate_list:
+        with open(args.regenerate_list, "w", encoding="utf-8") as f:
+            f.writelines(name + "\n" for name in regenerate)
+    return 1 if regenerate else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
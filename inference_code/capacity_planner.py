@@ -0,0 +1,379 @@
+"""
+Engine capacity planner and named hardware profiles for the vLLM settings.
+
+v14's LLM(...) arguments were found by trial and error on an A100 80GB. This
+planner computes them instead, in plain Python (no GPU, no torch). It works
+from:
+- the model architecture (config.json of the base model, or the built-in
+  Qwen2.5-72B numbers),
+- the weight quantization (AWQ 4-bit / bf16) and KV cache dtype,
+- the GPU's memory, HBM bandwidth and compute,
+- the prompt/output token lengths measured on our inputs (context filter +
+  prompt template) and targets (.blkx slots), with the model's tokenizer when
+  transformers and the base model are on this machine. Otherwise lengths are
+  estimated at CHARS_PER_TOKEN, which undercounts JSON and GUIDs, so the
+  profiles keep at least v14's max_model_len.
+
+It reports the memory split (weights / LoRA slots / activations / KV cache),
+how many sequences fit concurrently, and the expected decode tokens/s and
+cases/hour. The engine profiles it writes to engine_profiles.json
+("A100-80G", "H200-141G") are selected with ENGINE_PROFILE in
+run_batch_tests_v14.py.
+
+The estimates are first-order (bandwidth-bound decode, compute-bound prefill,
+vLLM block rounding), which is enough to choose settings. The measured
+throughput of a real run is still the final word.
+
+How to use (from the working directory with context.txt, inputs/, targets/):
+    python capacity_planner.py
+    python -m pytest test_capacity_planner.py
+"""
+
+import io
+import os
+import json
+import math
+import glob
+import contextlib
+
+from token_budget import count_tokens, extract_slots, load_targets, _quantile, INPUT_CSV_GLOB, TARGETS_PATH
+from conversion_steps import (read_csv_rows, csv_row_title, csv_row_to_text, build_library_index,
+                              filter_context, build_prompt, read_file)
+from engine_backends import ENGINE_ARGS, BASE_MODEL_PATH
+
+# --- 1. CONFIGURATION ---
+PROFILES_FILE = "engine_profiles.json"
+CONTEXT_FILE = "context.txt"
+
+# Qwen2.5-72B-Instruct-AWQ (used when the base model's config.json is not on this machine)
+QWEN25_72B_CONFIG = dict(
+    hidden_size=8192,
+    intermediate_size=29568,
+    num_hidden_layers=80,
+    num_attention_heads=64,
+    num_key_value_heads=8,
+    vocab_size=152064,
+    max_position_embeddings=32768,
+    tie_word_embeddings=False,
+    torch_dtype="float16",
+    quantization_config=dict(quant_method="awq", bits=4, group_size=128),
+)
+
+GPUS = {
+    #               usable memory   HBM bandwidth   dense fp16/bf16
+    "A100-80G":  dict(memory_gib=80.0, hbm_tb_s=2.039, tflops=312.0),
+    "H200-141G": dict(memory_gib=140.4, hbm_tb_s=4.8, tflops=989.0),
+}
+
+ADAPTER_RANK = 64            # max_lora_rank: vLLM sizes every LoRA slot for this rank
+KV_BLOCK_TOKENS = 16         # vLLM paged-attention block size
+NON_TORCH_GIB = 1.0          # CUDA context, NCCL, allocator slack
+CUDA_GRAPH_GIB = 1.5         # captured graphs when enforce_eager=False
+BANDWIDTH_EFFICIENCY = 0.6   # achieved / peak HBM bandwidth in decode (AWQ kernels)
+PREFILL_MFU = 0.45           # achieved / peak FLOPs in prefill
+EAGER_STEP_OVERHEAD_S = 0.012  # extra CPU launch time per decode step without CUDA graphs
+MAX_NUM_SEQS_CAP = 64
+
+DTYPE_BYTES = {"float16": 2, "bfloat16": 2, "float32": 4}
+KV_DTYPE_BYTES = {"fp8": 1, "fp8_e4m3": 1, "fp8_e5m2": 1}   # "auto" = model dtype
+
+GIB = 1024 ** 3
+
+
+# --- 2. MODEL MEMORY ---
+def load_model_config(model_path=BASE_MODEL_PATH):
+    path = os.path.join(model_path, "config.json")
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return dict(QWEN25_72B_CONFIG)
+
+
+def _head_dim(cfg):
+    return cfg.get("head_dim") or cfg["hidden_size"] // cfg["num_attention_heads"]
+
+
+def _linear_shapes(cfg):
+    """(in, out) of every linear layer in one decoder layer."""
+    h, inter = cfg["hidden_size"], cfg["intermediate_size"]
+    kv = cfg["num_key_value_heads"] * _head_dim(cfg)
+    return [(h, h), (h, kv), (h, kv), (h, h),           # q, k, v, o
+            (h, inter), (h, inter), (inter, h)]         # gate, up, down
+
+
+def parameter_count(cfg):
+    layers = cfg["num_hidden_layers"]
+    linear = layers * sum(i * o for i, o in _linear_shapes(cfg))
+    embed = cfg["vocab_size"] * cfg["hidden_size"] * (1 if cfg.get("tie_word_embeddings") else 2)
+    return linear, embed
+
+
+def weight_bytes(cfg):
+    """Linear layers at the quantized width (+ fp16 scales/zeros per group); embeddings in fp16."""
+    linear, embed = parameter_count(cfg)
+    dtype_bytes = DTYPE_BYTES.get(cfg.get("torch_dtype", "float16"), 2)
+    quant = cfg.get("quantization_config") or {}
+    if quant.get("bits"):
+        per_param = quant["bits"] / 8 + 2.5 / quant.get("group_size", 128)
+    else:
+        per_param = dtype_bytes
+    return linear * per_param + embed * dtype_bytes
+
+
+def lora_bytes(cfg, max_loras, rank=ADAPTER_RANK):
+    """GPU buffers vLLM preallocates: A and B for every linear layer, per slot."""
+    per_layer = sum(rank * (i + o) for i, o in _linear_shapes(cfg))
+    return max_loras * cfg["num_hidden_layers"] * per_layer * 2
+
+
+def kv_bytes_per_token(cfg, kv_cache_dtype="auto"):
+    dtype_bytes = KV_DTYPE_BYTES.get(kv_cache_dtype, DTYPE_BYTES.get(cfg.get("torch_dtype", "float16"), 2))
+    return 2 * cfg["num_hidden_layers"] * cfg["num_key_value_heads"] * _head_dim(cfg) * dtype_bytes
+
+
+def activation_bytes(cfg, max_num_batched_tokens, max_num_seqs):
+    """
+    Peak of vLLM's profiling forward pass: hidden states, qkv and the gate/up
+    projections for the largest prefill chunk, plus fp32 logits per sequence.
+    """
+    h, inter = cfg["hidden_size"], cfg["intermediate_size"]
+    qkv = h + 2 * cfg["num_key_value_heads"] * _head_dim(cfg)
+    per_token = (4 * h + qkv + 2 * inter) * 2
+    return max_num_batched_tokens * per_token + max_num_seqs * cfg["vocab_size"] * 4
+
+
+def memory_plan(cfg, gpu, engine_args):
+    args = dict(ENGINE_ARGS)
+    args.update(engine_args)
+    max_model_len = args["max_model_len"]
+    batched = args.get("max_num_batched_tokens") or max_model_len
+    budget = gpu["memory_gib"] * GIB * args["gpu_memory_utilization"]
+    weights = weight_bytes(cfg)
+    lora = lora_bytes(cfg, args.get("max_loras", 1), args.get("max_lora_rank", ADAPTER_RANK)) if args.get("enable_lora") else 0
+    activations = activation_bytes(cfg, batched, args["max_num_seqs"])
+    graphs = 0 if args.get("enforce_eager") else CUDA_GRAPH_GIB * GIB
+    kv = budget - weights - lora - activations - graphs - NON_TORCH_GIB * GIB
+    per_token = kv_bytes_per_token(cfg, args.get("kv_cache_dtype", "auto"))
+    kv_blocks = max(0, int(kv // (per_token * KV_BLOCK_TOKENS)))
+    return {
+        "budget_gib": budget / GIB,
+        "weights_gib": weights / GIB,
+        "lora_gib": lora / GIB,
+        "activations_gib": activations / GIB,
+        "cuda_graphs_gib": graphs / GIB,
+        "kv_cache_gib": max(0.0, kv) / GIB,
+        "kv_bytes_per_token": per_token,
+        "kv_tokens": kv_blocks * KV_BLOCK_TOKENS,
+        "fits": kv_blocks * KV_BLOCK_TOKENS >= max_model_len,
+    }
+
+
+# --- 3. WORKLOAD ---
+def measure_lengths(context_path=CONTEXT_FILE, csv_glob=INPUT_CSV_GLOB, targets_path=TARGETS_PATH, tokenizer=None):
+    """
+    [(prompt_tokens, output_tokens)] for every CSV test case with a matching
+    target: the prompt is built exactly like the runner does (filtered context +
+    template), the output is the target's three slots.
+    """
+    if not os.path.exists(context_path):
+        return []
+    library_index = build_library_index(read_file(context_path))
+    if library_index is None:
+        return []
+    targets = load_targets(targets_path)
+    lengths = []
+    for csv_path in sorted(glob.glob(csv_glob)):
+        for row in read_csv_rows(csv_path):
+            title = csv_row_title(row)
+            matches = sorted(name for name in targets if title and name.startswith(title + "."))
+            if not matches:
+                continue
+            text = csv_row_to_text(row)
+            with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+                prompt = build_prompt(filter_context(library_index, text), text)
+            lengths.append((count_tokens(prompt, tokenizer),
+                            count_tokens(extract_slots(targets[matches[0]]), tokenizer)))
+    return lengths
+
+
+def load_tokenizer(model_path=BASE_MODEL_PATH):
+    """The base model's tokenizer, or None (no transformers or no model here): lengths are then estimated."""
+    if not os.path.isdir(model_path):
+        return None
+    try:
+        from transformers import AutoTokenizer
+        return AutoTokenizer.from_pretrained(model_path)
+    except (ImportError, OSError, ValueError) as e:
+        print(f"    [WARNING] No tokenizer from {model_path} ({type(e).__name__}: {e}); estimating lengths.")
+        return None
+
+
+def summarize_lengths(lengths, exact=False):
+    prompts = [p for p, _ in lengths]
+    outputs = [o for _, o in lengths]
+    totals = [p + o for p, o in lengths]
+    return {
+        "cases": len(lengths),
+        "prompt_mean": sum(prompts) / len(prompts), "prompt_p95": _quantile(prompts, 0.95),
+        "output_mean": sum(outputs) / len(outputs), "output_p95": _quantile(outputs, 0.95),
+        "total_mean": sum(totals) / len(totals), "total_p95": _quantile(totals, 0.95),
+        "total_max": max(totals),
+        "exact": exact,   # measured with the model's tokenizer
+    }
+
+
+def _blocks(tokens):
+    return int(math.ceil(tokens / KV_BLOCK_TOKENS))
+
+
+def max_concurrency(kv_tokens, summary):
+    """Sequences that fit in the KV cache at once: with p95 lengths (safe) and mean lengths (typical)."""
+    kv_blocks = kv_tokens // KV_BLOCK_TOKENS
+    return {"p95": kv_blocks // _blocks(summary["total_p95"]),
+            "mean": kv_blocks // _blocks(summary["total_mean"])}
+
+
+def throughput(cfg, gpu, plan, summary, concurrency, enforce_eager):
+    """
+    Steady state with `concurrency` sequences decoding together. Each decode
+    step reads the weights once plus every sequence's KV cache (bandwidth
+    bound). Each case also needs one prefill of its prompt (compute bound, not
+    overlapped without chunked prefill).
+    """
+    linear, embed = parameter_count(cfg)
+    params = linear + embed
+    bandwidth = gpu["hbm_tb_s"] * 1e12 * BANDWIDTH_EFFICIENCY
+    flops = gpu["tflops"] * 1e12 * PREFILL_MFU
+
+    avg_context = summary["prompt_mean"] + summary["output_mean"] / 2
+    step_s = (weight_bytes(cfg) + concurrency * avg_context * plan["kv_bytes_per_token"]) / bandwidth
+    step_s += EAGER_STEP_OVERHEAD_S if enforce_eager else 0.0
+
+    prompt = summary["prompt_mean"]
+    attention = 2 * cfg["num_hidden_layers"] * prompt * prompt * cfg["hidden_size"]
+    prefill_s = (2 * params * prompt + attention) / flops
+
+    per_case_s = prefill_s + summary["output_mean"] * step_s / concurrency
+    return {
+        "decode_step_ms": step_s * 1000,
+        "prefill_s": prefill_s,
+        "decode_tokens_per_s": concurrency / step_s,
+        "output_tokens_per_s": summary["output_mean"] / per_case_s,
+        "cases_per_hour": 3600 / per_case_s,
+        "single_case_latency_s": prefill_s + summary["output_mean"] * step_s,
+    }
+
+
+# --- 4. PROFILES ---
+def plan_profile(gpu_name, cfg, summary, max_loras=1):
+    """
+    Picks engine arguments for one GPU:
+    - max_model_len covers the longest measured case plus 10%, rounded up to 4k and
+      capped at the model's window; with estimated lengths (summary["exact"]
+      False) it stays at least ENGINE_ARGS' max_model_len;
+    - CUDA graphs are kept (enforce_eager=False) if they leave room for 2 p95
+      sequences;
+    - the KV cache drops to fp8 only if fp16 cannot hold 2 p95 sequences;
+    - max_num_seqs is what fits at p95 lengths, so admission never preempts.
+    """
+    gpu = GPUS[gpu_name]
+    max_model_len = int(math.ceil(summary["total_max"] * 1.1 / 4096)) * 4096
+    if not summary.get("exact"):
+        max_model_len = max(max_model_len, ENGINE_ARGS["max_model_len"])
+    max_model_len = min(cfg.get("max_position_embeddings", 32768), max_model_len)
+    base = dict(ENGINE_ARGS, max_model_len=max_model_len, max_loras=max_loras,
+                gpu_memory_utilization=0.92, enable_chunked_prefill=False)
+
+    chosen = None
+    for enforce_eager in (False, True):
+        for kv_cache_dtype in ("auto", "fp8"):
+            args = dict(base, enforce_eager=enforce_eager, kv_cache_dtype=kv_cache_dtype, max_num_seqs=MAX_NUM_SEQS_CAP)
+            plan = memory_plan(cfg, gpu, args)
+            if plan["fits"] and max_concurrency(plan["kv_tokens"], summary)["p95"] >= 2:
+                chosen = args
+                break
+        if chosen:
+            break
+    if chosen is None:
+        chosen = dict(base, enforce_eager=True, kv_cache_dtype="fp8", max_num_seqs=1)
+
+    # Re-plan with the real max_num_seqs (fewer logits buffers -> a little more KV)
+    plan = memory_plan(cfg, gpu, chosen)
+    seqs = max(1, min(MAX_NUM_SEQS_CAP, max_concurrency(plan["kv_tokens"], summary)["p95"]))
+    chosen["max_num_seqs"] = seqs
+    plan = memory_plan(cfg, gpu, chosen)
+    perf = throughput(cfg, gpu, plan, summary, seqs, chosen["enforce_eager"])
+    return {"gpu": gpu_name, "engine_args": chosen, "memory": plan, "throughput": perf}
+
+
+def save_profiles(profiles, path=PROFILES_FILE):
+    with open(path, "w") as f:
+        json.dump(profiles, f, indent=2)
+
+
+def load_profile(name, path=PROFILES_FILE):
+    """Engine arguments of profile `name` from engine_profiles.json, or None if missing."""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        profiles = json.load(f)
+    if name not in profiles:
+        raise KeyError(f"Engine profile '{name}' not in {path} (have: {sorted(profiles)})")
+    return profiles[name]["engine_args"]
+
+
+def print_plan(label, plan, concurrency, perf=None):
+    print(f"--> {label}")
+    print(f"    Memory budget:     {plan['budget_gib']:.1f} GiB = weights {plan['weights_gib']:.1f} + "
+          f"LoRA {plan['lora_gib']:.1f} + activations {plan['activations_gib']:.1f} + "
+          f"graphs {plan['cuda_graphs_gib']:.1f} + overhead {NON_TORCH_GIB:.1f} + KV {plan['kv_cache_gib']:.1f}")
+    print(f"    KV cache:          {plan['kv_tokens']} tokens ({plan['kv_bytes_per_token'] / 1024:.0f} KiB/token), "
+          f"fits max_model_len: {plan['fits']}")
+    print(f"    Concurrent seqs:   {concurrency['p95']} at p95 length, {concurrency['mean']} at mean length")
+    if perf:
+        print(f"    Decode step:       {perf['decode_step_ms']:.1f} ms -> {perf['decode_tokens_per_s']:.0f} tokens/s "
+              f"across the batch; prefill {perf['prefill_s']:.1f} s per case")
+        print(f"    Expected:          {perf['output_tokens_per_s']:.0f} output tokens/s, "
+              f"{perf['cases_per_hour']:.0f} cases/hour, one case alone {perf['single_case_latency_s']:.0f} s")
+
+
+def main():
+    cfg = load_model_config()
+    linear, embed = parameter_count(cfg)
+    quant = (cfg.get("quantization_config") or {}).get("quant_method", "none")
+    print(f"--> Model: {(linear + embed) / 1e9:.1f}B params, quantization={quant}, "
+          f"weights {weight_bytes(cfg) / GIB:.1f} GiB")
+
+    tokenizer = load_tokenizer()
+    lengths = measure_lengths(tokenizer=tokenizer)
+    if lengths:
+        print(f"--> Measured {len(lengths)} cases from {INPUT_CSV_GLOB} + {TARGETS_PATH} "
+              + ("with the model's tokenizer." if tokenizer else "(estimated tokens: no tokenizer here)."))
+    else:
+        print("--> context.txt / inputs / targets not found; assuming 20000-token prompts and 3000-token outputs.")
+        lengths = [(20000, 3000)]
+    summary = summarize_lengths(lengths, exact=tokenizer is not None)
+    print(f"    prompt mean/p95 {summary['prompt_mean']:.0f}/{summary['prompt_p95']}, "
+          f"output mean/p95 {summary['output_mean']:.0f}/{summary['output_p95']}, "
+          f"total max {summary['total_max']}")
+
+    # The settings v14 actually runs with
+    v14_plan = memory_plan(cfg, GPUS["A100-80G"], ENGINE_ARGS)
+    v14_conc = max_concurrency(v14_plan["kv_tokens"], summary)
+    v14_perf = throughput(cfg, GPUS["A100-80G"], v14_plan, summary, ENGINE_ARGS["max_num_seqs"], ENGINE_ARGS["enforce_eager"])
+    print_plan(f"v14 ENGINE_ARGS on A100-80G (max_num_seqs={ENGINE_ARGS['max_num_seqs']})", v14_plan, v14_conc, v14_perf)
+
+    profiles = {}
+    for gpu_name in GPUS:
+        profile = plan_profile(gpu_name, cfg, summary)
+        profiles[gpu_name] = profile
+        args = profile["engine_args"]
+        print_plan(f"Profile {gpu_name}: max_num_seqs={args['max_num_seqs']}, max_model_len={args['max_model_len']}, "
+                   f"kv_cache_dtype={args['kv_cache_dtype']}, enforce_eager={args['enforce_eager']}",
+                   profile["memory"], max_concurrency(profile["memory"]["kv_tokens"], summary), profile["throughput"])
+    save_profiles(profiles)
+    print(f"--> Saved: {PROFILES_FILE} (set ENGINE_PROFILE in run_batch_tests_v14.py)")
+
+
+if __name__ == "__main__":
+    main()
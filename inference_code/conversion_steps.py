@@ -0,0 +1,240 @@
+"""
+CPU-side steps of the v14 conversion: reading a test case, filtering the
+library dictionary, assembling the prompt and wrapping the generated XML.
+
+These used to live inline in run_batch_tests_v14.py. They are kept here so they
+can be imported without pulling in vLLM (which builds the engine on import).
+"""
+
+import os
+import re
+import csv
+import json
+import glob
+
+# --- 1. RANKED FILTER (FIXED TOKENIZATION) ---
+def build_library_index(context_text):
+    """
+    Parses the context JSON once and pre-computes the lowercase search string of
+    every item, so long-running callers don't re-parse 200+ KB per test case.
+    Returns a list of (item, item_str) pairs, or None if the JSON is invalid.
+    """
+    try:
+        library_data = json.loads(context_text)
+        if not isinstance(library_data, list): library_data = [library_data]
+    except json.JSONDecodeError:
+        return None
+
+    index = []
+    for item in library_data:
+        actual_data = item.get("json_snippet", item)
+        index.append((actual_data, json.dumps(actual_data).lower()))
+    return index
+
+def filter_context(context_text, user_input):
+    """context_text is either the raw context JSON or a build_library_index() result."""
+    library_index = context_text if isinstance(context_text, list) else build_library_index(context_text)
+    if library_index is None:
+        print("       [ERROR] Context file is not valid JSON.")
+        return "[]"
+
+    # --- THE FIX: SPLIT BY UNDERSCORES TOO ---
+    # Old: re.findall(r'\w+', ...) -> kept "HIL_Mdl_Cons_APS" together
+    # New: re.findall(r'[a-zA-Z0-9]+', ...) -> splits into "HIL", "Mdl", "Cons", "APS"
+    user_words = re.findall(r'[a-zA-Z0-9]+', user_input.lower())
+
+    stop_words = {"the", "and", "or", "to", "of", "in", "is", "a", "step", "measure", "that", "value"}
+    base_keywords = set([w for w in user_words if w not in stop_words and len(w) > 2])
+
+    # --- SYNONYM MAP ---
+    synonym_map = {
+        # Faults & Safety
+        "fault":  ["fiu", "short", "circuit", "failure", "scg"],
+        "remove": ["deactivate", "release", "clear", "reset"],
+        "can":    ["fiu", "scg", "bus"],
+
+        # Specific Simulations
+        "gear":   ["write_read_gear", "gear_position"],
+        "pedal":  ["write_read_aps", "acc_pedal"],
+        "acc":    ["write_read_aps", "acc_pedal"],
+        "aps":    ["write_read_aps", "acc_pedal"], # Now this will definitely trigger
+
+        # Standard Mappings
+        "create": ["set", "activate", "trigger"],
+        "check":  ["read", "verify", "validate", "camera", "vision", "pattern"],
+        "mil":    ["telltale", "indicator", "warning", "lamp"],
+        "screen": ["cluster", "display", "hmi"],
+        "simulate": ["set", "force", "write"],
+        "ignition": ["ign", "key", "switch", "simulating"],
+        "battery":  ["batt", "voltage"],
+        "crank":    ["start", "engine"]
+    }
+
+    final_keywords = set(base_keywords)
+    for word in base_keywords:
+        if word in synonym_map:
+            final_keywords.update(synonym_map[word])
+
+    # Score Items
+    scored_items = []
+    for actual_data, item_str in library_index:
+        match_count = 0
+        for key in final_keywords:
+            if key in item_str:
+                match_count += 1
+
+        # Priority Boosting
+        if "deactivate" in item_str and "remove" in final_keywords: match_count += 10
+        if "gear" in item_str and "gear" in final_keywords: match_count += 5
+        if "battery" in item_str and "battery" in final_keywords: match_count += 5
+
+        # APS BOOST (Now guaranteed to trigger because "aps" is in final_keywords)
+        if "write_read_aps" in item_str and "aps" in final_keywords: match_count += 20
+
+        if match_count > 0:
+             scored_items.append((match_count, actual_data))
+
+    # Sort and Trim
+    scored_items.sort(key=lambda x: x[0], reverse=True)
+    MAX_ITEMS = 100
+    relevant_items = [x[1] for x in scored_items[:MAX_ITEMS]]
+
+    # Debug Output (Check if WRITE_READ_APS is at the top now)
+    print(f"       [DEBUG] Found {len(scored_items)} matches. Keeping top {len(relevant_items)}.")
+    if len(relevant_items) > 0:
+        print("       [DEBUG] Top 10 Selected Items:")
+        for idx, item in enumerate(relevant_items[:10]):
+            name = item.get("library_link") or item.get("concept") or "Unknown"
+            print(f"          {idx+1}. {name}")
+
+    return json.dumps(relevant_items, indent=2)
+
+def read_file(filename):
+    with open(filename, 'r') as f: return f.read().strip()
+
+# --- 2. CSV TEST CASES ---
+# Column names differ between suites ("Test Case Title" vs "Name", ...)
+TITLE_COLUMNS = ["Test Case Title", "Name"]
+PRE_COLUMNS = ["Pre-Action"]
+STEP_COLUMNS = ["Test Steps.Action"]
+POST_COLUMNS = ["Post Condition", "Post-Action"]
+
+def _cell(row, columns):
+    for col in columns:
+        value = row.get(col)
+        if value:
+            return value.strip()
+    return ""
+
+def read_csv_rows(path):
+    try:
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            return list(csv.DictReader(f))
+    except UnicodeDecodeError:
+        with open(path, "r", encoding="cp1252", newline="") as f:
+            return list(csv.DictReader(f))
+
+def csv_row_title(row):
+    return _cell(row, TITLE_COLUMNS)
+
+def safe_file_name(title, max_length=150):
+    """A CSV title usable as a file name ("..._ON/OFF_within30ms." -> "..._ON_OFF_within30ms")."""
+    name = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", title).strip(" .")
+    return name[:max_length] or "case"
+
+def csv_row_to_text(row):
+    """One CSV row in the Precondition: / Action: / Postcondition: form the README asks for."""
+    return f"""Precondition:
+{_cell(row, PRE_COLUMNS)}
+Action:
+{_cell(row, STEP_COLUMNS)}
+Postcondition:
+{_cell(row, POST_COLUMNS)}"""
+
+def load_cases(path):
+    """
+    Returns [(case_name, test_case_text)] for one input file: a .txt file is one
+    case named after the file, a .csv file gives one case per titled row.
+    """
+    if path.lower().endswith(".csv"):
+        cases = []
+        for row in read_csv_rows(path):
+            title = csv_row_title(row)
+            if title:
+                cases.append((title, csv_row_to_text(row)))
+        return cases
+    name = os.path.splitext(os.path.basename(path))[0]
+    return [(name, read_file(path))]
+
+# --- 3. PROMPT ---
+system_block = """### System:
+You are an expert Automotive Test Automation Engineer.
+Convert Natural Language Test Steps into dSPACE XML.
+
+### CRITICAL RULES:
+1. **Block Type:** Use `<Standard.LibraryLinkBlock>`.
+2. **Parameters:** YOU MUST NEST DATA INSIDE A `<value>` TAG.
+   - **WRONG:** `<MainLibrary.Int name="x">10</MainLibrary.Int>`
+   - **CORRECT:** <MainLibrary.Int name="x">
+         <value>10</value>
+     </MainLibrary.Int>
+3. **Logic:** - "Remove Fault" -> Use `DEACTIVATE_RELEASE_ERROR`.
+   - "Check Telltale" -> Use `CHECK_CLUSTER_THROUGH_CAMERA`.
+   - "Simulate Gear" -> Use `WRITE_READ_GEAR`.
+   - "Simulate APS" -> Use `WRITE_READ_APS`.
+
+### Required Output Format:
+<FrameworkBuilder.ActualOperationSlot name="Initialization">
+    <subsystems> ... </subsystems>
+</FrameworkBuilder.ActualOperationSlot>
+<FrameworkBuilder.ActualOperationSlot name="StepsAndEvaluation">
+    <subsystems> ... </subsystems>
+</FrameworkBuilder.ActualOperationSlot>
+<FrameworkBuilder.ActualOperationSlot name="Cleanup">
+    <subsystems> ... </subsystems>
+</FrameworkBuilder.ActualOperationSlot>
+"""
+
+def build_prompt(filtered_context, user_content):
+    return f"{system_block}\n\n### Library Dictionary (JSON):\n{filtered_context}\n\n### User Input:\n{user_content}\n\n### Response (XML):\n"
+
+# --- 4. OUTPUT ---
+def wrap_xml(generated_text):
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<Standard.Sequence name="Test_Sequence_Generated">
+    <library-description>Generated by AI Model</library-description>
+    <subsystems>
+        <FrameworkBuilder.Frame name="Test_Frame_Main">
+            <library-description>To execute subsystems sequentially.</library-description>
+            <subsystems>
+                <FrameworkBuilder.ActualDataSlot name="Data">
+                    <subsystems>
+{generated_text}
+                    </subsystems>
+                </FrameworkBuilder.ActualDataSlot>
+            </subsystems>
+        </FrameworkBuilder.Frame>
+    </subsystems>
+</Standard.Sequence>"""
+
+def unwrap_xml(xml_text):
+    """Inverse of wrap_xml: the generated slots inside the Data slot's <subsystems>."""
+    start = xml_text.find('<FrameworkBuilder.ActualDataSlot name="Data">')
+    if start < 0:
+        return xml_text.strip()
+    start = xml_text.find("<subsystems>", start) + len("<subsystems>")
+    end = xml_text.rfind("</subsystems>", start, xml_text.rfind("</FrameworkBuilder.ActualDataSlot>"))
+    return xml_text[start:end].strip()
+
+def user_content_of(prompt):
+    """The test case text of a build_prompt() prompt, or None for other prompts."""
+    head, sep, rest = prompt.partition("\n### User Input:\n")
+    if not sep:
+        return None
+    return rest.rsplit("\n\n### Response (XML):", 1)[0].strip()
+
+def output_path_for(input_file, output_dir):
+    return os.path.join(output_dir, os.path.basename(input_file).replace(".txt", ".xml"))
+
+def list_input_files(input_dir):
+    return glob.glob(os.path.join(input_dir, "*.txt"))
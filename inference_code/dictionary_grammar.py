@@ -0,0 +1,667 @@
+"""
+Constrained decoding from the dictionary: the model can only write tag names,
+library-links, block ids and parameter names that the dictionary allows, with
+the same exemptions block_repair.py and output_validation.py make.
+
+Nothing stops the decoder from writing a library-link or GUID that is not in
+the dictionary (output_checks reports those afterwards). DictionaryGrammar
+compiles one item set into character tries and runs a character-level
+automaton over the output:
+    - element names directly inside the markup: the fixed markup (slots,
+      subsystems, LibraryLinkBlock, parameters, value, ...), the items'
+      xml_tag values and any MainLibrary.* name (parameter types and blocks
+      such as MainLibrary.For; the dictionary lists none). Inside other
+      elements (MainLibrary.Exec's <command>, ...) and inside external blocks
+      names are free;
+    - LibraryLinkBlock library-link: the items' library_link values,
+      output_checks.LINK_GAPS, or any link into a library the dictionary does
+      not cover (XIL API Convenience, Test Builder: "external"); id: the GUID
+      of the item named by the library-link (any item GUID if the id comes
+      first, and then the library-link must be that item's), free for gaps
+      and external blocks;
+    - the name of a parameter inside a block's <parameters>: the item's
+      required_params, when the item lists any and is not in
+      output_checks.PARAM_GAPS.
+Everything else (values, descriptions, comments, other attributes) is free.
+
+At decode time the automaton gives a token mask per step: with a constrained
+field open, only the tokens that continue it (found through the vocabulary
+indexed by first character); otherwise every token except those with a "<" or
+'"' that would open a field wrongly. Masks are computed once per automaton
+state and cached in the grammar, and compiled grammars are cached by the hash
+of their item set (grammar_for). With the in-process vLLM engine a sampling
+dict's "grammar" becomes a logits processor (GrammarLogitsProcessor).
+Per-request SamplingParams.logits_processors only exist in vLLM's V0 engine,
+which vLLM 0.10 dropped: require_v0_engine() selects it before the engine is
+built and fails on a vLLM without it. The openai backend cannot run one in the
+server and drops it.
+
+Running this file compiles the grammar of every CSV case with a target, both
+from the whole dictionary and from the items filter_context retrieved for the
+case, reports the compile time and cache reuse, how much of each target the
+grammar accepts, that hallucinated links and GUIDs are refused, and the CPU
+cost of the mask per decode step, including finding each sequence's state.
+Constraining to the retrieved items refuses every target (retrieval finds
+about half of their blocks), so v14 only offers the whole dictionary. Tokens
+are the model's with --tokenizer, otherwise a vocabulary built from the
+targets and the dictionary, padded to the model's vocab_size with an
+estimated share of "<" / '"' tokens (PROXY_OPENER_SHARE).
+
+How to use:
+    CONSTRAINED_DECODING = "dictionary" in run_batch_tests_v14.py (vllm backend, pip install "vllm<0.10")
+    python dictionary_grammar.py [--tokenizer /path/to/model]
+"""
+
+import io
+import os
+import re
+import glob
+import json
+import time
+import random
+import hashlib
+import argparse
+import contextlib
+from collections import OrderedDict
+
+from output_checks import SLOT_TAG, LINK_TAG, LINK_GAPS, PARAM_GAPS, PARAMETER_PREFIX
+from block_repair import library_key
+from engine_backends import SequenceTracks, FIXED_MAX_TOKENS
+
+# --- 1. CONFIGURATION ---
+GRAMMAR_CACHE_SIZE = 64    # compiled item sets kept
+V0_ENGINE_BEFORE = (0, 10)  # first vLLM release without the V0 engine (and per-request logits processors)
+MARKUP_TAGS = (SLOT_TAG, "subsystems", LINK_TAG, "parameters", "value", "description", "library-description")
+NAME_END = " \t\r\n/>"
+NAME_INVALID = '<"=&'
+FIELD_OPENERS = '<"'      # a token without these cannot open a constrained field
+# Share of the tokens with a FIELD_OPENERS character in a byte-level BPE vocabulary
+# trained on code (an estimate; --tokenizer measures the model's own)
+PROXY_OPENER_SHARE = 0.02
+
+# Automaton modes
+TEXT, OPEN, NAME, CLOSE, MARKUP, COMMENT, ATTRS, VALUE, LIBRARY = range(9)
+FREE = -1                  # node of an unconstrained element name or attribute value
+EXTERNAL = "<external>"    # link of a block in a library the dictionary does not cover
+# (mode, node, attr, tag, link, gid, stack): stack holds (tag, library-link) per open element
+START = (TEXT, 0, "", "", None, None, ())
+
+
+# --- 2. GRAMMAR ---
+class DictionaryGrammar:
+    """The automaton for one set of dictionary items (json_snippet dicts)."""
+
+    def __init__(self, items):
+        t0 = time.perf_counter()
+        self._children = []   # trie node -> {char: node}; all tries share the list
+        self._parent = []     # trie node -> (parent node, char), to spell out a prefix
+        self._word = {}       # node -> the word that ends there
+        self.tag_root = self._trie(set(MARKUP_TAGS) | {i["xml_tag"] for i in items if i.get("xml_tag")})
+        # Any MainLibrary.* element: output_checks takes them all as parameters, the dictionary lists no types
+        self._free_names = self._subtree(self._path(self.tag_root, PARAMETER_PREFIX))
+        items = [i for i in items if i.get("library_link")]
+        self.link_root = self._trie({i["library_link"] for i in items} | LINK_GAPS)
+        self.libraries = {library_key(i["library_link"]) for i in items}
+        self.id_root = self._trie(i["id"] for i in items if i.get("id"))
+        self.link_root_of_id = {i["id"]: self._trie([i["library_link"]]) for i in items if i.get("id")}
+        self.id_root_of_link = {i["library_link"]: self._trie([i["id"]]) for i in items if i.get("id")}
+        # PARAM_GAPS: the dictionary's parameter list is wrong for these, so their names are free
+        self.param_root = {i["library_link"]: self._trie(i["required_params"]) for i in items
+                           if i.get("required_params") and i["library_link"] not in PARAM_GAPS}
+        self.library_links = frozenset(i["library_link"] for i in items)
+        self._masks = {}
+        self._mask_vocab = None
+        self.compile_s = time.perf_counter() - t0
+
+    def _trie(self, words):
+        root = self._new_node(None)
+        for word in words:
+            self._word[self._path(root, word)] = word
+        return root
+
+    def _new_node(self, parent):
+        self._children.append({})
+        self._parent.append(parent)
+        return len(self._children) - 1
+
+    def _path(self, node, chars):
+        """The node that spells chars below node, created as needed."""
+        for ch in chars:
+            nxt = self._children[node].get(ch)
+            if nxt is None:
+                nxt = self._children[node][ch] = self._new_node((node, ch))
+            node = nxt
+        return node
+
+    def _subtree(self, node):
+        nodes, todo = set(), [node]
+        while todo:
+            node = todo.pop()
+            nodes.add(node)
+            todo.extend(self._children[node].values())
+        return nodes
+
+    def _prefix(self, node):
+        chars = []
+        while self._parent[node] is not None:
+            node, ch = self._parent[node]
+            chars.append(ch)
+        return "".join(reversed(chars))
+
+    def allows_link(self, link):
+        """Whether a library-link can be written: a known link or one into a library the dictionary lacks."""
+        return (link in self.library_links or link in LINK_GAPS
+                or ("." in link and library_key(link) not in self.libraries))
+
+    @property
+    def nodes(self):
+        return len(self._children)
+
+    def advance(self, state, text):
+        """The state after text, or None if the grammar does not allow it."""
+        for ch in text:
+            state = self._step(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def _step(self, state, ch):
+        mode, node, attr, tag, link, gid, stack = state
+        if mode == TEXT:
+            if ch != "<":
+                return state
+            return (OPEN, self.tag_root if self._names_constrained(stack) else FREE, "", "", None, None, stack)
+        if mode == OPEN:
+            if ch == "/":
+                return (CLOSE, 0, "", "", None, None, stack)
+            if ch in "!?":
+                return (MARKUP, 0, ch, "", None, None, stack)
+            mode = NAME
+        if mode == NAME:
+            # A free name is spelled out in attr, so a LibraryLinkBlock is recognized anywhere
+            if node == FREE or ch in NAME_END:
+                name = attr if node == FREE else self._word.get(node)
+                if node != FREE and name is None and node in self._free_names:
+                    name = self._prefix(node)
+                if ch not in NAME_END:
+                    return None if ch in NAME_INVALID else (NAME, FREE, attr + ch, "", None, None, stack)
+                if not name:
+                    return None
+                state = (ATTRS, 0, "", name, None, None, stack)
+                mode, node, attr, tag = ATTRS, 0, "", name
+            else:
+                nxt = self._children[node].get(ch)
+                if nxt is not None:
+                    return (NAME, nxt, "", "", None, None, stack)
+                if node not in self._free_names or ch in NAME_INVALID:
+                    return None
+                return (NAME, FREE, self._prefix(node) + ch, "", None, None, stack)
+        if mode == CLOSE:
+            return (TEXT, 0, "", "", None, None, stack[:-1]) if ch == ">" else state
+        if mode == MARKUP:
+            if ch == ">":
+                return (TEXT, 0, "", "", None, None, stack)
+            if attr + ch == "!--":
+                return (COMMENT, 0, "", "", None, None, stack)
+            return (MARKUP, 0, attr + ch if len(attr) < 3 else attr, "", None, None, stack)
+        if mode == COMMENT:
+            if ch == ">" and node == 2:
+                return (TEXT, 0, "", "", None, None, stack)
+            return (COMMENT, min(node + 1, 2) if ch == "-" else 0, "", "", None, None, stack)
+        if mode == ATTRS:
+            # node: 0 = between or in attribute names, 1 = after "=", 2 = after "/"
+            if ch == ">":
+                pushed = stack if node == 2 else stack + ((tag, link),)
+                return (TEXT, 0, "", "", None, None, pushed)
+            if node == 1 and ch == '"':
+                return (VALUE, self._value_root(tag, attr, link, gid, stack), attr, tag, link, gid, stack)
+            if ch == "=":
+                return (ATTRS, 1, attr.strip(), tag, link, gid, stack)
+            if ch == "/":
+                return (ATTRS, 2, "", tag, link, gid, stack)
+            if ch in " \t\r\n":
+                return state if node == 1 or not attr or attr.endswith(" ") else (ATTRS, 0, attr + " ", tag, link, gid, stack)
+            # A name character (an unquoted value after "=" is not ours to judge)
+            attr = ch if node or attr.endswith(" ") else attr + ch
+            return (ATTRS, 0, attr, tag, link, gid, stack)
+        if mode == VALUE:
+            if node == FREE:
+                return (ATTRS, 0, "", tag, link, gid, stack) if ch == '"' else state
+            nxt = self._children[node].get(ch)
+            if nxt is not None:
+                return (VALUE, nxt, attr, tag, link, gid, stack)
+            if tag == LINK_TAG and attr == "library-link" and gid is None and not (ch == '"' and node in self._word):
+                return self._library(self._prefix(node) + ch, state)
+            if ch != '"' or node not in self._word:
+                return None
+            value = self._word[node]
+            if tag == LINK_TAG and attr == "library-link":
+                link = value
+            elif tag == LINK_TAG and attr == "id":
+                gid = value
+            return (ATTRS, 0, "", tag, link, gid, stack)
+        if mode == LIBRARY:
+            return self._library(attr + ch, state)
+        return None
+
+    def _library(self, text, state):
+        """
+        A library-link off the dictionary's links (attr holds it up to its
+        first "."): free if its library is not one of the dictionary's, the
+        links block_repair leaves alone as "external"; refused otherwise.
+        """
+        _, _, _, tag, link, gid, stack = state
+        library, dot, rest = text.partition(".")
+        if not dot:
+            return None if text[-1] in '"<' else (LIBRARY, 0, text, tag, link, gid, stack)
+        if library_key(library) in self.libraries or '"' in rest:
+            return None
+        return (VALUE, FREE, "library-link", tag, EXTERNAL, gid, stack)
+
+    def _names_constrained(self, stack):
+        """Element names come from the tag set directly inside the markup, outside external blocks."""
+        return (not stack or stack[-1][0] in MARKUP_TAGS) and all(link != EXTERNAL for _, link in stack)
+
+    def _value_root(self, tag, attr, link, gid, stack):
+        if tag == LINK_TAG:
+            if attr == "library-link":
+                return self.link_root_of_id[gid] if gid else self.link_root
+            if attr == "id":
+                # Links without a dictionary GUID (LINK_GAPS, external blocks) take any id
+                return self.id_root if link is None else self.id_root_of_link.get(link, FREE)
+        elif attr == "name" and len(stack) > 1 and stack[-1][0] == "parameters":
+            return self.param_root.get(stack[-2][1], FREE)
+        return FREE
+
+    def _first_chars(self, state):
+        """The characters that may come next in a constrained field, or None outside one."""
+        mode, node = state[0], state[1]
+        if node == FREE or (mode == NAME and node in self._free_names):
+            return None
+        if mode == OPEN:
+            return "/!?" + "".join(self._children[node])
+        if mode == NAME:
+            return "".join(self._children[node]) + (NAME_END if node in self._word else "")
+        if mode == VALUE and node != FREE:
+            return "".join(self._children[node]) + ('"' if node in self._word else "")
+        return None
+
+    def mask(self, state, vocab):
+        """
+        ("allow", token ids) inside a constrained field, ("deny", token ids)
+        outside one; computed on the first visit of a state, then cached.
+        """
+        if vocab is not self._mask_vocab:
+            self._masks, self._mask_vocab = {}, vocab
+        mask = self._masks.get(state)
+        if mask is None:
+            first = self._first_chars(state)
+            if first is None:
+                mask = ("deny", tuple(i for i in vocab.openers if self.advance(state, vocab.strings[i]) is None))
+            else:
+                mask = ("allow", tuple(i for ch in first for i in vocab.by_first.get(ch, ())
+                                       if self.advance(state, vocab.strings[i]) is not None) + vocab.free)
+            self._masks[state] = mask
+        return mask
+
+
+def grammar_key(items):
+    """Hash of what the grammar is compiled from, independent of item order."""
+    fields = sorted((i.get("library_link") or "", i.get("id") or "", i.get("xml_tag") or "",
+                     tuple(i.get("required_params") or ())) for i in items)
+    return hashlib.sha1(json.dumps(fields).encode("utf-8")).hexdigest()
+
+
+_GRAMMARS = OrderedDict()
+
+
+def grammar_for(items):
+    """The compiled grammar of an item set, from the cache when the same set was compiled before."""
+    key = grammar_key(items)
+    grammar = _GRAMMARS.get(key)
+    if grammar is None:
+        grammar = _GRAMMARS[key] = DictionaryGrammar(items)
+        if len(_GRAMMARS) > GRAMMAR_CACHE_SIZE:
+            _GRAMMARS.popitem(last=False)
+    else:
+        _GRAMMARS.move_to_end(key)
+    return grammar
+
+
+def require_v0_engine():
+    """
+    Selects vLLM's V0 engine for GrammarLogitsProcessor (VLLM_USE_V1=0; call it
+    before the engine is built). RuntimeError if the installed vLLM has none.
+    """
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        installed = version("vllm")
+    except PackageNotFoundError:
+        raise RuntimeError("constrained decoding needs vllm (pip install \"vllm<0.10\")") from None
+    if tuple(int(x) for x in re.findall(r"\d+", installed)[:2]) >= V0_ENGINE_BEFORE:
+        raise RuntimeError(f"vLLM {installed} has no V0 engine, which per-request logits processors need: "
+                           f"pip install \"vllm<{'.'.join(map(str, V0_ENGINE_BEFORE))}\" or turn constrained decoding off")
+    os.environ["VLLM_USE_V1"] = "0"
+
+
+# --- 3. TOKEN MASKS ---
+class TokenVocabulary:
+    """Token id -> text, indexed the way DictionaryGrammar.mask() looks tokens up."""
+
+    def __init__(self, strings, special_ids=()):
+        special = set(special_ids)
+        self.strings = [("" if i in special else s) for i, s in enumerate(strings)]
+        self.free = tuple(i for i, s in enumerate(self.strings) if not s)   # EOS and friends: always allowed
+        self.openers = tuple(i for i, s in enumerate(self.strings) if any(c in s for c in FIELD_OPENERS))
+        self.by_first = {}
+        for i, s in enumerate(self.strings):
+            if s:
+                self.by_first.setdefault(s[0], []).append(i)
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer):
+        """From a Hugging Face tokenizer (vLLM's engine.tokenizer): decodes every id once."""
+        size = len(tokenizer)
+        return cls([tokenizer.decode([i]) for i in range(size)], tokenizer.all_special_ids)
+
+
+_VOCABULARIES = {}
+
+
+def vocabulary_of(tokenizer):
+    if id(tokenizer) not in _VOCABULARIES:
+        _VOCABULARIES[id(tokenizer)] = TokenVocabulary.from_tokenizer(tokenizer)
+    return _VOCABULARIES[id(tokenizer)]
+
+
+class GrammarLogitsProcessor:
+    """
+    A vLLM logits processor (output token ids, logits) -> logits for one
+    request. The automaton state of each sequence is followed token by token
+    (engine_backends.SequenceTracks), so the n samples of a request each get
+    their own.
+    """
+
+    def __init__(self, grammar, vocab):
+        self.grammar = grammar
+        self.vocab = vocab
+        self._tracks = SequenceTracks(START, self._advance)
+        self._tensors = {}
+
+    def _advance(self, state, token):
+        # A token outside the mask (e.g. a partial UTF-8 byte) leaves the state unchanged
+        return self.grammar.advance(state, self.vocab.strings[token]) or state
+
+    def mask(self, token_ids):
+        """(state, grammar.mask() of it) for the sequence with these output token ids."""
+        state = self._tracks.state(token_ids)
+        return state, self.grammar.mask(state, self.vocab)
+
+    def __call__(self, token_ids, logits):
+        import torch
+        state, (kind, ids) = self.mask(token_ids)
+        if not ids:
+            return logits
+        index = self._tensors.get(state)
+        if index is None:
+            index = self._tensors[state] = torch.tensor(ids, dtype=torch.long, device=logits.device)
+        if kind == "deny":
+            return logits.index_fill(0, index, float("-inf"))
+        masked = torch.full_like(logits, float("-inf"))
+        masked[index] = logits[index]
+        return masked
+
+
+# --- 4. BENCHMARK ---
+VOCAB_PIECE = re.compile(r" ?[A-Za-z]+| ?\d{1,3}| ?[^\sA-Za-z\d]{1,3}|\s+")
+
+
+def proxy_vocabulary(texts, size=None, opener_share=PROXY_OPENER_SHARE, seed=0):
+    """
+    A BPE-like vocabulary without the model's tokenizer: corpus pieces and
+    their prefixes, plus every character. With size, padded to that many
+    tokens with made-up words, opener_share of them around a "<" or '"' (the
+    mask cost grows with both counts).
+    """
+    pieces = set()
+    for text in texts:
+        for piece in VOCAB_PIECE.findall(text):
+            pieces.update(piece[:n] for n in range(1, len(piece) + 1))
+    pieces |= {chr(c) for c in range(32, 127)} | {"\n", "\t"}
+    if size:
+        rng = random.Random(seed)
+        openers = sum(1 for s in pieces if any(c in s for c in FIELD_OPENERS))
+        target_openers = int(size * opener_share)
+        while len(pieces) < size - 1:
+            word = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(2, 8)))
+            word = rng.choice(["", " ", " ", word[0].upper()]) + word
+            if openers < target_openers:
+                word = rng.choice(['<', '</', ' <', '"', ' "', '="', '("']) + word + rng.choice(["", '"', '">', ">", '",'])
+            if word not in pieces:
+                pieces.add(word)
+                openers += any(c in word for c in FIELD_OPENERS)
+    strings = sorted(pieces) + ["<|endoftext|>"]
+    return TokenVocabulary(strings, special_ids=[len(strings) - 1])
+
+
+def greedy_tokens(text, vocab):
+    """Longest-match split of text into the vocabulary's token ids (proxy tokenizer)."""
+    ids = {s: i for i, s in enumerate(vocab.strings) if s}
+    longest = max(map(len, ids))
+    out, pos = [], 0
+    while pos < len(text):
+        for n in range(min(longest, len(text) - pos), 0, -1):
+            token = ids.get(text[pos:pos + n])
+            if token is not None:
+                out.append(token)
+                pos += n
+                break
+        else:
+            pos += 1
+    return out
+
+
+def failure_field(grammar, text):
+    """(position, what was refused) of the first character the grammar refuses, or (None, None)."""
+    state = START
+    for pos, ch in enumerate(text):
+        nxt = grammar._step(state, ch)
+        if nxt is None:
+            mode, attr, tag = state[0], state[2], state[3]
+            if mode in (OPEN, NAME):
+                return pos, "element name"
+            if tag == LINK_TAG:
+                return pos, attr
+            return pos, "parameter name"
+        state = nxt
+    return None, None
+
+
+def load_cases(context_path, csv_glob, targets_path):
+    """[(target name, retrieved items, target slots)] for the CSV cases with a target."""
+    from token_budget import extract_slots, load_targets
+    from conversion_steps import read_csv_rows, csv_row_title, csv_row_to_text, build_library_index, filter_context, read_file
+
+    library_index = build_library_index(read_file(context_path))
+    targets = load_targets(targets_path)
+    cases = []
+    for csv_path in sorted(glob.glob(csv_glob)):
+        for row in read_csv_rows(csv_path):
+            title = csv_row_title(row)
+            matches = sorted(name for name in targets if title and name.startswith(title + "."))
+            if not matches:
+                continue
+            with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+                items = json.loads(filter_context(library_index, csv_row_to_text(row)))
+            cases.append((matches[0], items, extract_slots(targets[matches[0]])))
+    return cases
+
+
+def mask_cost(cases, vocab, tokenize, scope_grammar):
+    """
+    Replays the targets token by token through a GrammarLogitsProcessor (the
+    sequence's state, then its mask), up to the first refused token.
+    """
+    stats = dict(steps=0, first_visits=0, cold_s=0.0, warm_s=0.0, allowed=0, allow_steps=0)
+    for _, items, target in cases:
+        grammar = scope_grammar(items)
+        processor = GrammarLogitsProcessor(grammar, vocab)
+        state, token_ids = START, []
+        for token in tokenize(target):
+            states = len(grammar._masks) if grammar._mask_vocab is vocab else -1
+            t0 = time.perf_counter()
+            _, (kind, ids) = processor.mask(token_ids)
+            elapsed = time.perf_counter() - t0
+            known = len(grammar._masks) == states
+            stats["steps"] += 1
+            stats["warm_s" if known else "cold_s"] += elapsed
+            stats["first_visits"] += not known
+            if kind == "allow":
+                stats["allowed"] += len(ids)
+                stats["allow_steps"] += 1
+            state = grammar.advance(state, vocab.strings[token])
+            if state is None:
+                break
+            token_ids.append(token)
+    return stats
+
+
+def tracking_cost(token_ids):
+    """
+    Seconds per step of finding a sequence's state over one decode of
+    token_ids: keyed by the tuple of its ids (hashed in full every step) and
+    with SequenceTracks.
+    """
+    states, ids = {(): START}, []
+    t0 = time.perf_counter()
+    for token in token_ids:
+        key = tuple(ids)
+        if key not in states:
+            states.pop(key[:-1], None)
+            states[key] = START
+        ids.append(token)
+    keyed = (time.perf_counter() - t0) / len(token_ids)
+    tracks, ids = SequenceTracks(START, lambda state, token: state), []
+    t0 = time.perf_counter()
+    for token in token_ids:
+        tracks.state(ids)
+        ids.append(token)
+    return keyed, (time.perf_counter() - t0) / len(token_ids)
+
+
+def main():
+    from token_budget import INPUT_CSV_GLOB, TARGETS_PATH
+    from output_checks import load_dictionary, DICTIONARY_FILE
+    from capacity_planner import load_model_config, plan_profile, throughput, measure_lengths, summarize_lengths, GPUS
+
+    parser = argparse.ArgumentParser(description="Compile time, target coverage and mask cost of the dictionary grammar.")
+    parser.add_argument("--context", default="context.txt")
+    parser.add_argument("--dictionary", default=DICTIONARY_FILE)
+    parser.add_argument("--tokenizer", default="", help="Model or tokenizer path (transformers); default: proxy vocabulary.")
+    parser.add_argument("--gpu", default="H200-141G")
+    args = parser.parse_args()
+
+    cases = load_cases(args.context, INPUT_CSV_GLOB, TARGETS_PATH)
+    if not cases:
+        print(f"CRITICAL: no CSV cases with targets found ({INPUT_CSV_GLOB}, {TARGETS_PATH}).")
+        return 1
+    dictionary = list(load_dictionary(args.dictionary).values())
+    scopes = {"retrieved": grammar_for, "dictionary": lambda items: grammar_for(dictionary)}
+
+    # 1. Compile every case's item set; the cache serves the repeats
+    compile_times, hits = [], 0
+    for _, items, _ in cases:
+        cached = grammar_key(items) in _GRAMMARS
+        grammar = grammar_for(items)
+        hits += cached
+        if not cached:
+            compile_times.append(grammar.compile_s)
+    whole = grammar_for(dictionary)
+    print(f"--> {len(cases)} cases: {len(cases) - hits} compiles, {hits} cache hits ({hits / len(cases):.0%}); "
+          f"{sum(compile_times) / len(compile_times) * 1000:.2f} ms per item set of "
+          f"{len(grammar.library_links)} items (max {max(compile_times) * 1000:.2f} ms); "
+          f"whole dictionary ({len(whole.library_links)} items): {whole.compile_s * 1000:.2f} ms")
+
+    # 2. How much of each target the grammar lets through
+    link_attr = re.compile(r'library-link="([^"]+)"')
+    accepted = {}
+    print(f"\n    {'scope':<11} {'target links allowed':>21} {'targets accepted':>17}   first refusal in the others")
+    for scope, scope_grammar in scopes.items():
+        links = allowed = 0
+        refused = {}
+        accepted[scope] = []
+        for case in cases:
+            grammar = scope_grammar(case[1])
+            for link in link_attr.findall(case[2]):
+                links += 1
+                allowed += grammar.allows_link(link)
+            pos, field = failure_field(grammar, case[2])
+            if pos is None:
+                accepted[scope].append(case)
+            else:
+                refused[field] = refused.get(field, 0) + 1
+        print(f"    {scope:<11} {allowed / links:>21.0%} {len(accepted[scope]):>10}/{len(cases):<6}   "
+              + ", ".join(f"{field} {n}" for field, n in sorted(refused.items(), key=lambda x: -x[1])))
+    print("    A target link outside the retrieved items is one the model cannot write with the \"retrieved\" scope:")
+    print("    that scope is only as good as filter_context's recall, so v14 only offers \"dictionary\".")
+
+    # 3. Hallucinations: a link or GUID that is not in the items
+    caught = total = 0
+    for _, items, target in accepted["dictionary"]:
+        # The first block the dictionary knows: external blocks take any link in their library and any id
+        known = next((m for m in link_attr.finditer(target) if m.group(1) in whole.library_links), None)
+        if known is None:
+            continue
+        head, tail = target[:known.start()], target[known.end():]
+        for broken in (f'{head}library-link="{known.group(1)}_V2"{tail}',
+                       f'{head}library-link="TVSM_Library.NOT_IN_DICTIONARY"{tail}',
+                       f'{head}{known.group()} id="{{{"0" * 8}-0000-0000-0000-{"0" * 12}}}"{tail}'):
+            total += 1
+            caught += whole.advance(START, broken) is None
+    print(f"--> Invented links and wrong GUIDs refused (dictionary scope): {caught}/{total}")
+
+    # 4. Mask cost per decode step
+    cfg = load_model_config()
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        vocab = TokenVocabulary.from_tokenizer(tokenizer)
+        tokenize = lambda text: tokenizer.encode(text, add_special_tokens=False)
+        label = args.tokenizer
+    else:
+        vocab = proxy_vocabulary([target for _, _, target in cases] + [json.dumps(dictionary)], size=cfg["vocab_size"])
+        tokenized = {}
+
+        def tokenize(text):
+            if text not in tokenized:
+                tokenized[text] = greedy_tokens(text, vocab)
+            return tokenized[text]
+        label = f"proxy vocabulary of the model's size, {PROXY_OPENER_SHARE:.0%} openers estimated; --tokenizer measures the real one"
+    summary = summarize_lengths(measure_lengths())
+    profile = plan_profile(args.gpu, cfg, summary)
+    step_ms = throughput(cfg, GPUS[args.gpu], profile["memory"], summary, 1,
+                         profile["engine_args"]["enforce_eager"])["decode_step_ms"]
+    print(f"\n--> Masks, {len(vocab.strings)} tokens ({label}), {len(vocab.openers)} of them with < or \"; "
+          f"decode step {step_ms:.1f} ms ({args.gpu} profile, one sequence)")
+    print(f"    {'scope':<11} {'steps':>7} {'new states':>11} {'ms each':>8} {'in all s':>9} {'cached us':>10} "
+          f"{'mean ms/step':>13} {'of a step':>10} {'allowed in a field':>19}")
+    for scope, scope_grammar in scopes.items():
+        s = mask_cost(cases, vocab, tokenize, scope_grammar)
+        per_step_ms = (s["cold_s"] + s["warm_s"]) / s["steps"] * 1000
+        print(f"    {scope:<11} {s['steps']:>7} {s['first_visits']:>11} "
+              f"{s['cold_s'] / max(s['first_visits'], 1) * 1000:>8.2f} {s['cold_s']:>9.1f} "
+              f"{s['warm_s'] / max(s['steps'] - s['first_visits'], 1) * 1e6:>10.1f} {per_step_ms:>13.3f} "
+              f"{per_step_ms / step_ms:>10.1%} {s['allowed'] / max(s['allow_steps'], 1):>19.0f}")
+    print("    New states cost a pass over the candidate tokens once per grammar; the cached lookup is what every")
+    print("    other step pays. The mean spreads the new states over all cases: on a fresh grammar a new state")
+    print("    costs more than a decode step, so the first cases decode slower. Applying the mask to the logits")
+    print("    (one index_fill on the GPU) is not included.")
+
+    decode = [token for _, _, target in cases for token in tokenize(target)][:FIXED_MAX_TOKENS]
+    keyed, tracked = tracking_cost(decode)
+    print(f"--> Finding the sequence's state over a {len(decode)}-token decode: {keyed * 1e6:.1f} us/step keyed by "
+          f"the ids tuple (grows with the output), {tracked * 1e6:.1f} us/step with SequenceTracks (included above)")
+
+
+if __name__ == "__main__":
+    main()
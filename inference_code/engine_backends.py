@@ -0,0 +1,701 @@
+"""
+Generation engines used by the batch runner and the inference daemon.
+
+Every engine has the same small interface:
+    .max_model_len, .max_loras
+    .count_tokens(text) -> int
+    .generate(prompts, sampling, adapters=None) -> [GenerationResult]
+    .stream(prompt, sampling, on_delta, adapter=None) -> GenerationResult
+        (on_delta(text) as the tokens arrive; see streaming_output.py)
+
+VLLMEngine wraps the in-process vLLM engine with the v14 settings.
+OpenAIClientEngine (openai_client_backend.py) talks to a separate server.
+StubEngine sleeps and returns canned XML. ReplayEngine returns the recorded
+output of each case (outputs.zip) with a configurable per-token latency.
+The last two let everything around the GPU (retrieval, prompt building,
+post-processing, I/O) be profiled and tested on a plain Linux box.
+make_engine(backend, ...) builds any of them by name and only imports vLLM
+for "vllm".
+
+Both take sampling settings as plain dicts (SAMPLING_DEFAULTS + max_tokens), so
+callers never need to import vLLM themselves. generate() also takes an optional
+per-prompt list of adapter_routing.AdapterSpec; None means the default adapter.
+A sampling dict with n > 1 asks for n samples of the prompt from one prefill;
+they come back in GenerationResult.samples (see best_of_n.py).
+"""
+
+import os
+import time
+import zipfile
+import hashlib
+import threading
+from dataclasses import dataclass
+
+from token_budget import predict_max_tokens, next_budget, extract_slots
+from conversion_steps import unwrap_xml, user_content_of
+
+# --- 1. CONFIGURATION ---
+BASE_MODEL_PATH = "/workspace/manual_models/base"
+ADAPTER_PATH = "/workspace/manual_models/adapter"
+ADAPTER_NAME = "dspace_adapter"
+
+MAX_MODEL_LEN = 32768
+FIXED_MAX_TOKENS = 8192
+
+# The LLM(...) arguments v14 was tuned with on an A100 80GB
+ENGINE_ARGS = dict(
+    enable_lora=True,
+    max_lora_rank=64,
+    gpu_memory_utilization=0.92,
+    max_model_len=MAX_MODEL_LEN,
+    kv_cache_dtype="auto",
+    enforce_eager=True,
+    enable_chunked_prefill=False,
+    max_num_seqs=1,
+    max_loras=1,        # adapters resident on the GPU at once (one batch may mix this many)
+)
+
+SAMPLING_DEFAULTS = dict(
+    temperature=0.1,
+    repetition_penalty=1.15,
+    stop=["</FrameworkBuilder.ActualDataSlot>"],
+)
+
+# A request a stop monitor aborted (finish_reason "abort") is retried this many
+# times with these overrides: near-greedy sampling would repeat the same mistake
+ABORT_RETRIES = 1
+ABORT_RETRY_SAMPLING = dict(temperature=0.6)
+# ... and a request aborted as a runaway loop (repetition_guard.py, stop_reason
+# "loop: ...") with a stronger repetition penalty as well
+LOOP_RETRY_SAMPLING = dict(ABORT_RETRY_SAMPLING, repetition_penalty=1.25)
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    finish_reason: str
+    num_output_tokens: int
+    # With sampling n > 1: all n samples (the fields above are samples[0])
+    samples: list = None
+    # Why a stop monitor ended the request (its .reason), e.g. the XML error it saw
+    stop_reason: str = None
+
+    @classmethod
+    def of_samples(cls, samples):
+        first = samples[0]
+        return cls(first.text, first.finish_reason, first.num_output_tokens,
+                   samples if len(samples) > 1 else None, first.stop_reason)
+
+
+def abort_retry_sampling(stop_reason):
+    """The sampling overrides for retrying a request a stop monitor aborted with stop_reason."""
+    return LOOP_RETRY_SAMPLING if stop_reason and stop_reason.startswith("loop") else ABORT_RETRY_SAMPLING
+
+
+def apply_monitor(monitor, text):
+    """
+    Runs a finished text through a stop monitor in one piece (for engines that
+    cannot stop mid-decode). Returns (kept text, finish_reason, stop_reason),
+    the last two None if the monitor let the whole text through.
+    """
+    cut = monitor.feed(text)
+    if cut is None:
+        return text, None, None
+    return text[:cut], monitor.finish_reason, getattr(monitor, "reason", None)
+
+
+class MonitorChain:
+    """Several stop monitors on one request, in order; each sees only the text the ones before it kept."""
+
+    def __init__(self, monitors):
+        self.monitors = monitors
+        self.finish_reason = None
+        self.reason = None
+
+    def feed(self, delta):
+        cut = None
+        for monitor in self.monitors:
+            c = monitor.feed(delta if cut is None else delta[:cut])
+            if c is not None and (cut is None or c <= cut):
+                cut = c
+                self.finish_reason = monitor.finish_reason
+                self.reason = getattr(monitor, "reason", None)
+        return cut
+
+
+def chain_monitors(*factories):
+    """One stop_monitor factory from several (None entries are skipped)."""
+    factories = [f for f in factories if f is not None]
+    if len(factories) <= 1:
+        return factories[0] if factories else None
+    return lambda: MonitorChain([factory() for factory in factories])
+
+
+TAKEN = "taken"         # a SequenceTracks node whose state a child took over
+
+
+class SequenceTracks:
+    """
+    Per-sequence state of a per-request vLLM logits processor, found from the
+    output token ids it is called with. The engine decodes a request's
+    sequences in lockstep, so a call's ids extend one of the previous length's
+    by one token: the state is the parent's advanced by that token, O(1) per
+    step. (Hashing the whole id tuple each step is quadratic in the decode.)
+    Samples with the same tokens so far share one track. advance(state, token)
+    may change state in place: a child takes its parent's state over, and when
+    a second child forks off (the samples diverge, at most n - 1 times per
+    request) the parent's state is rebuilt by replaying its tokens.
+    """
+
+    def __init__(self, initial, advance):
+        self.advance = advance
+        self.initial = initial
+        self._root = [None, None, TAKEN]      # node: [token, parent, state or TAKEN]
+        self._length = 0
+        self._previous = []
+        self._current = [self._root]
+
+    def state(self, token_ids):
+        n = len(token_ids)
+        if n == 0:
+            return self.initial
+        if n == self._length + 1:
+            self._length, self._previous, self._current = n, self._current, []
+        elif n != self._length:
+            return self._replay(token_ids)
+        parent = self._find(self._previous, token_ids, n - 2)
+        if parent is None:
+            return self._replay(token_ids)
+        for node in self._current:
+            if node[1] is parent and node[0] == token_ids[-1]:
+                return node[2]
+        state = parent[2] if parent[2] is not TAKEN else self._replay(self._tokens(parent))
+        parent[2] = TAKEN
+        node = [token_ids[-1], parent, self.advance(state, token_ids[-1])]
+        self._current.append(node)
+        return node[2]
+
+    @staticmethod
+    def _find(candidates, token_ids, i):
+        """The candidate whose tokens are token_ids[:i + 1], walking back only as far as they differ."""
+        walks = [(node, node) for node in candidates]
+        while len({id(at) for _, at in walks}) > 1 and i >= 0:
+            walks = [(node, at[1]) for node, at in walks if at[0] == token_ids[i]]
+            i -= 1
+        return walks[0][0] if walks else None
+
+    @staticmethod
+    def _tokens(node):
+        tokens = []
+        while node[1] is not None:
+            tokens.append(node[0])
+            node = node[1]
+        return tokens[::-1]
+
+    def _replay(self, token_ids):
+        """The state of token_ids from the start (a fork, or a sequence out of step)."""
+        state = self.initial
+        for token in token_ids:
+            state = self.advance(state, token)
+        return state
+
+
+STOPPED = "stopped"     # the state of a sequence whose monitor has cut
+
+
+class MonitorLogitsProcessor:
+    """
+    A vLLM logits processor that runs a stop monitor on each sequence of one
+    request and, once it cuts, only lets EOS through: the request ends on the
+    next step instead of decoding to max_tokens. The text after the cut is
+    trimmed by apply_monitor afterwards (VLLMEngine._monitored).
+    """
+
+    def __init__(self, monitor_factory, token_strings, eos_ids):
+        self.monitor_factory = monitor_factory
+        self.strings = token_strings
+        self.eos_ids = list(eos_ids)
+        self._eos = None
+        self._tracks = SequenceTracks(None, self._advance)
+
+    def _advance(self, monitor, token):
+        if monitor is STOPPED:
+            return STOPPED
+        if monitor is None:
+            monitor = self.monitor_factory()
+        return STOPPED if monitor.feed(self.strings[token]) is not None else monitor
+
+    def stopped(self, token_ids):
+        """Whether the monitor of the sequence with these output token ids has cut."""
+        return self._tracks.state(token_ids) is STOPPED
+
+    def __call__(self, token_ids, logits):
+        if not self.stopped(token_ids):
+            return logits
+        import torch
+        if self._eos is None:
+            self._eos = torch.tensor(self.eos_ids, dtype=torch.long, device=logits.device)
+        forced = torch.full_like(logits, float("-inf"))
+        forced[self._eos] = 0.0
+        return forced
+
+
+# --- 2. ENGINES ---
+# Every engine has .stop_monitor: None, or a factory for one monitor per request,
+# and .aborts_mid_decode: whether a monitor ends a request while it decodes (the
+# rest of the decode is saved) or only sees the finished output.
+# A monitor's feed(delta) follows the output as it is decoded and returns None to
+# go on, or how many characters of delta to keep before the request ends with
+# monitor.finish_reason: "stop" when the output is complete (structural_stop.py),
+# "abort" when it is broken beyond repair (xml_stream_check.py; its .reason says why).
+class VLLMEngine:
+    """
+    adapter_path=None serves the base model alone (a checkpoint merged by
+    lora_merge.py). On vLLM's V0 engine (VLLM_USE_V1=0, see
+    dictionary_grammar.require_v0_engine) the stop monitor runs inside the
+    decode as a MonitorLogitsProcessor; on V1, which has no per-request logits
+    processors, LLM.generate returns finished sequences and the monitor only
+    trims them.
+    """
+
+    aborts_mid_decode = False
+
+    def __init__(self, base_model_path=BASE_MODEL_PATH, adapter_path=ADAPTER_PATH,
+                 adapter_name=ADAPTER_NAME, **engine_args):
+        os.environ["VLLM_ALLOW_LONG_MAX_MODEL_LEN"] = "1"
+        from vllm import LLM, SamplingParams
+        from vllm.lora.request import LoRARequest
+
+        self._SamplingParams = SamplingParams
+        args = dict(ENGINE_ARGS)
+        args.update(engine_args)
+        if adapter_path is None:
+            args["enable_lora"] = False
+            for name in ("max_lora_rank", "max_loras", "max_cpu_loras"):
+                args.pop(name, None)
+        self.max_model_len = args["max_model_len"]
+        self.max_loras = args.get("max_loras", 1)
+        self.llm = LLM(model=base_model_path, **args)
+        self._LoRARequest = LoRARequest
+        self.lora_request = LoRARequest(adapter_name, 1, adapter_path) if adapter_path else None
+        self._lora_requests = {}
+        self.tokenizer = self.llm.get_tokenizer()
+        self.stop_monitor = None
+        self.aborts_mid_decode = os.environ.get("VLLM_USE_V1") == "0"
+
+    def count_tokens(self, text):
+        return len(self.tokenizer.encode(text))
+
+    def _lora_for(self, adapter):
+        if adapter is None or self.lora_request is None:
+            return self.lora_request
+        if adapter.name not in self._lora_requests:
+            self._lora_requests[adapter.name] = self._LoRARequest(adapter.name, adapter.lora_id, adapter.path)
+        return self._lora_requests[adapter.name]
+
+    def generate(self, prompts, sampling, adapters=None):
+        """sampling is one dict or a list of dicts (one per prompt); adapters likewise per prompt."""
+        if isinstance(sampling, dict):
+            sampling = [sampling] * len(prompts)
+        params = [self._SamplingParams(**self._with_processors(s)) for s in sampling]
+        if adapters is None:
+            lora_request = self.lora_request
+        else:
+            lora_request = [self._lora_for(a) for a in adapters]
+        outputs = self.llm.generate(prompts, sampling_params=params, lora_request=lora_request)
+        results = []
+        for output in outputs:
+            samples = [self._monitored(c.text, c.finish_reason, len(c.token_ids)) for c in output.outputs]
+            results.append(GenerationResult.of_samples(samples))
+        return results
+
+    def _with_processors(self, sampling):
+        """
+        A "grammar" (dictionary_grammar.DictionaryGrammar) and, on the V0
+        engine, the stop monitor become logits processors of this request.
+        """
+        sampling = dict(sampling)
+        grammar = sampling.pop("grammar", None)
+        processors = list(sampling.get("logits_processors") or [])
+        if grammar is not None or (self.stop_monitor is not None and self.aborts_mid_decode):
+            from dictionary_grammar import GrammarLogitsProcessor, vocabulary_of
+        if grammar is not None:
+            if not self.aborts_mid_decode:
+                raise RuntimeError("a grammar needs vLLM's V0 engine: call dictionary_grammar.require_v0_engine() "
+                                   "before the engine is built")
+            processors.append(GrammarLogitsProcessor(grammar, vocabulary_of(self.tokenizer)))
+        if self.stop_monitor is not None and self.aborts_mid_decode:
+            processors.append(MonitorLogitsProcessor(self.stop_monitor, vocabulary_of(self.tokenizer).strings,
+                                                     [self.tokenizer.eos_token_id]))
+        if processors:
+            sampling["logits_processors"] = processors
+        return sampling
+
+    def _monitored(self, text, finish_reason, num_tokens):
+        """
+        The monitor again on the finished text: it trims what was decoded after
+        its cut (the token that completed it, or everything on V1) and sets the
+        finish reason.
+        """
+        stop_reason = None
+        if self.stop_monitor is not None:
+            text, reason, stop_reason = apply_monitor(self.stop_monitor(), text)
+            finish_reason = reason or finish_reason
+        return GenerationResult(text, finish_reason, num_tokens, stop_reason=stop_reason)
+
+    def stream(self, prompt, sampling, on_delta, adapter=None):
+        """The offline LLM class cannot stream: the text arrives in one piece. Stream with "openai"."""
+        result = self.generate([prompt], [sampling], [adapter] if adapter is not None else None)[0]
+        on_delta(result.text)
+        return result
+
+
+STUB_XML = """<FrameworkBuilder.ActualOperationSlot name="Initialization">
+    <subsystems>
+        <Standard.LibraryLinkBlock library-link="TVSM_Library.STEP_PRECONDITION_BATTERY" id="{47041834-6781-46E6-ADA1-3819FDC6874E}">
+            <parameters/>
+        </Standard.LibraryLinkBlock>
+    </subsystems>
+</FrameworkBuilder.ActualOperationSlot>
+<FrameworkBuilder.ActualOperationSlot name="StepsAndEvaluation">
+    <subsystems>
+        <Standard.LibraryLinkBlock library-link="TVSM_Library.SET_CHECK_IGN_ON" id="{AC498635-700E-4390-B1DB-B60555784614}">
+            <parameters/>
+        </Standard.LibraryLinkBlock>
+    </subsystems>
+</FrameworkBuilder.ActualOperationSlot>
+<FrameworkBuilder.ActualOperationSlot name="Cleanup">
+    <subsystems>
+        <Standard.LibraryLinkBlock library-link="TVSM_Library.DEACTIVATE_RELEASE_ERROR" id="{A877C350-A66E-4CD8-BDE0-E16766212837}">
+            <parameters/>
+        </Standard.LibraryLinkBlock>
+    </subsystems>
+</FrameworkBuilder.ActualOperationSlot>"""
+
+
+class StubEngine:
+    """
+    Stand-in engine for tests and benchmarks. Each generate() call costs
+    prefill_s + prompt_tokens * prefill_per_token_s + num_tokens * per_token_s,
+    like one batched engine step would. Records the size of every batch it was
+    handed.
+
+    With n > 1 the prompt is prefilled once and the n samples decode side by
+    side; sample_for() decides what each sample says (the recording by default).
+
+    Adapters behave like vLLM's GPU LoRA slots: at most max_loras are resident
+    (LRU), loading a missing one costs adapter_load_s, and a batch that mixes
+    more than max_loras adapters is rejected.
+    """
+
+    aborts_mid_decode = True    # charges only the tokens the monitor kept
+
+    def __init__(self, text=STUB_XML, prefill_s=0.05, per_token_s=0.0, chars_per_token=3.0,
+                 max_model_len=MAX_MODEL_LEN, max_loras=ENGINE_ARGS["max_loras"], adapter_load_s=0.0,
+                 prefill_per_token_s=0.0):
+        self.text = text
+        self.prefill_s = prefill_s
+        self.prefill_per_token_s = prefill_per_token_s
+        self.per_token_s = per_token_s
+        self.chars_per_token = chars_per_token
+        self.max_model_len = max_model_len
+        self.max_loras = max_loras
+        self.adapter_load_s = adapter_load_s
+        self.stop_monitor = None
+        self.batch_sizes = []
+        self.batch_adapter_counts = []
+        self.adapter_loads = 0
+        self._resident = []   # adapter names, least recently used first
+        self._lock = threading.Lock()
+
+    def count_tokens(self, text):
+        return int(len(text) / self.chars_per_token)
+
+    def output_for(self, prompt):
+        return self.text
+
+    def sample_for(self, prompt, full_text, index):
+        return full_text
+
+    def resident_adapters(self):
+        return list(self._resident)
+
+    def _load_adapters(self, adapters):
+        names = []
+        for adapter in adapters:
+            name = adapter.name if adapter is not None else None
+            if name not in names:
+                names.append(name)
+        if len(names) > self.max_loras:
+            raise ValueError(f"Batch mixes {len(names)} adapters but max_loras={self.max_loras}.")
+        self.batch_adapter_counts.append(len(names))
+        for name in names:
+            if name in self._resident:
+                self._resident.remove(name)
+            else:
+                self.adapter_loads += 1
+                time.sleep(self.adapter_load_s)
+                if len(self._resident) >= self.max_loras:
+                    self._resident.pop(0)
+            self._resident.append(name)
+
+    def generate(self, prompts, sampling, adapters=None):
+        if isinstance(sampling, dict):
+            sampling = [sampling] * len(prompts)
+        # One engine: concurrent callers are serialized like a real GPU would be
+        with self._lock:
+            self.batch_sizes.append(len(prompts))
+            self._load_adapters(adapters or [None] * len(prompts))
+            results = []
+            longest = 0
+            for prompt, s in zip(prompts, sampling):
+                recorded = self.output_for(prompt)
+                max_tokens = s.get("max_tokens", FIXED_MAX_TOKENS)
+                samples = []
+                for index in range(s.get("n", 1)):
+                    full_text = self.sample_for(prompt, recorded, index)
+                    reason = stop_reason = None
+                    if self.stop_monitor is not None:
+                        full_text, reason, stop_reason = apply_monitor(self.stop_monitor(), full_text)
+                    full_tokens = self.count_tokens(full_text)
+                    n = min(full_tokens, max_tokens)
+                    longest = max(longest, n)
+                    if n == full_tokens:
+                        samples.append(GenerationResult(full_text, reason or "stop", n, stop_reason=stop_reason))
+                    else:
+                        samples.append(GenerationResult(full_text[:int(n * self.chars_per_token)], "length", n))
+                results.append(GenerationResult.of_samples(samples))
+            prompt_tokens = sum(self.count_tokens(p) for p in prompts)
+            time.sleep(self.prefill_s + prompt_tokens * self.prefill_per_token_s + longest * self.per_token_s)
+        return results
+
+    def stream(self, prompt, sampling, on_delta, adapter=None):
+        """One prompt, handed to on_delta token by token: prefill, then a token every per_token_s."""
+        with self._lock:
+            self.batch_sizes.append(1)
+            self._load_adapters([adapter])
+            full_text = self.sample_for(prompt, self.output_for(prompt), 0)
+            full_tokens = self.count_tokens(full_text)
+            n = min(full_tokens, sampling.get("max_tokens", FIXED_MAX_TOKENS))
+            end = len(full_text) if n == full_tokens else int(n * self.chars_per_token)
+            monitor = self.stop_monitor() if self.stop_monitor is not None else None
+            time.sleep(self.prefill_s + self.count_tokens(prompt) * self.prefill_per_token_s)
+            for i in range(n):
+                time.sleep(self.per_token_s)
+                start = int(i * self.chars_per_token)
+                stop = end if i == n - 1 else int((i + 1) * self.chars_per_token)
+                delta = full_text[start:stop]
+                cut = monitor.feed(delta) if monitor is not None else None
+                if cut is not None:
+                    on_delta(delta[:cut])
+                    return GenerationResult(full_text[:start + cut], monitor.finish_reason, i + 1,
+                                            stop_reason=getattr(monitor, "reason", None))
+                on_delta(delta)
+        return GenerationResult(full_text[:end], "stop" if n == full_tokens else "length", n)
+
+
+def _read_archive(path, extensions):
+    """name stem -> text for the files with the given extensions in a folder or .zip."""
+    entries = {}
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for name in zf.namelist():
+                if name.lower().endswith(extensions):
+                    entries[os.path.splitext(os.path.basename(name))[0]] = zf.read(name).decode("utf-8", errors="ignore")
+    elif os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(extensions):
+                with open(os.path.join(path, name), "r", encoding="utf-8", errors="ignore") as f:
+                    entries[os.path.splitext(name)[0]] = f.read()
+    return entries
+
+
+class ReplayEngine(StubEngine):
+    """
+    Deterministic engine that replays recorded outputs. Recordings are the
+    runner's .xml outputs (unwrapped back to the generated slots) or .blkx
+    targets (their three slots), from a folder or .zip. A prompt is matched
+    to its recording through the test case text of the input with the same
+    name. Prompts without a recording get one picked by prompt hash (counted
+    in .misses), so synthetic inputs still produce realistic output lengths.
+    Timing is StubEngine's prefill + per-token model.
+    """
+
+    def __init__(self, recordings_path="outputs.zip", inputs_path="inputs.zip", prefill_s=0.05,
+                 per_token_s=0.0, **kwargs):
+        super().__init__(prefill_s=prefill_s, per_token_s=per_token_s, **kwargs)
+        recordings = {name: extract_slots(text) for name, text in _read_archive(recordings_path, (".blkx",)).items()}
+        for name, text in _read_archive(recordings_path, (".xml",)).items():
+            recordings[name] = unwrap_xml(text)
+        if not recordings:
+            raise ValueError(f"No .xml/.blkx recordings found in {recordings_path}")
+        self.recordings = [recordings[name] for name in sorted(recordings)]
+        self.by_case = {}
+        for name, text in _read_archive(inputs_path, (".txt",)).items():
+            if name in recordings:
+                self.by_case[text.strip()] = recordings[name]
+        self.hits = 0
+        self.misses = 0
+
+    def output_for(self, prompt):
+        recorded = self.by_case.get(user_content_of(prompt) or "")
+        if recorded is not None:
+            self.hits += 1
+            return recorded
+        self.misses += 1
+        digest = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest()[:8], 16)
+        return self.recordings[digest % len(self.recordings)]
+
+
+def make_engine(backend, **kwargs):
+    """backend: "vllm" | "openai" | "stub" | "replay"; kwargs go to the engine's constructor."""
+    if backend == "vllm":
+        return VLLMEngine(**kwargs)
+    if backend == "openai":
+        from openai_client_backend import OpenAIClientEngine
+        return OpenAIClientEngine(**kwargs)
+    if backend == "stub":
+        return StubEngine(**kwargs)
+    if backend == "replay":
+        return ReplayEngine(**kwargs)
+    raise ValueError(f"Unknown backend '{backend}' (expected vllm, openai, stub or replay)")
+
+
+# --- 3. BUDGETED GENERATION ---
+def initial_budget(engine, job, budget_model=None, fixed_max_tokens=FIXED_MAX_TOKENS):
+    """
+    (max_tokens, ceiling) for a job's first attempt; the ceiling is what the
+    prompt leaves free. max_tokens is None when the prompt leaves no room at all.
+    """
+    ceiling = engine.max_model_len - engine.count_tokens(job.prompt)
+    if ceiling <= 0:
+        return None, ceiling
+    if budget_model:
+        return min(predict_max_tokens(budget_model, job.user_content, ceiling=ceiling), ceiling), ceiling
+    return min(fixed_max_tokens, ceiling), ceiling
+
+
+def budget_jobs(engine, jobs, budget_model=None, fixed_max_tokens=FIXED_MAX_TOKENS, log=print):
+    """[(job, max_tokens, ceiling)] for the first attempt; jobs whose prompt fills the context are skipped (empty text)."""
+    pending = []
+    for job in jobs:
+        max_tokens, ceiling = initial_budget(engine, job, budget_model, fixed_max_tokens)
+        if max_tokens is None:
+            job.text = ""
+            log(f"    [SKIPPED] {job.input_file}: the prompt's {engine.max_model_len - ceiling} tokens leave no room "
+                f"for output in max_model_len={engine.max_model_len}.")
+            continue
+        pending.append((job, max_tokens, ceiling))
+    return pending
+
+
+def generate_with_budget(engine, jobs, budget_model=None, fixed_max_tokens=FIXED_MAX_TOKENS, log=print, sampling_overrides=None):
+    """
+    Generates every job (anything with .prompt, .user_content, .input_file, .text)
+    in one engine call, with per-case max_tokens from token_budget.py and a retry
+    with a larger budget for outputs cut off by max_tokens. Outputs a stop
+    monitor aborted are retried ABORT_RETRIES times with abort_retry_sampling().
+    A job's optional .adapter (adapter_routing.AdapterSpec) selects its LoRA adapter,
+    its optional .grammar (dictionary_grammar.py) constrains its decoding.
+    sampling_overrides apply to every job (e.g. a regeneration).
+    """
+    pending = budget_jobs(engine, jobs, budget_model, fixed_max_tokens, log)
+    aborts = {}   # id(job) -> aborted attempts so far
+    overrides = {}   # id(job) -> sampling overrides for its retry
+    base_sampling = dict(SAMPLING_DEFAULTS, **(sampling_overrides or {}))
+
+    while pending:
+        sampling = [dict(base_sampling, **overrides.get(id(job), {}), max_tokens=max_tokens,
+                         grammar=getattr(job, "grammar", None)) for job, max_tokens, _ in pending]
+        adapters = [getattr(job, "adapter", None) for job, _, _ in pending]
+        if any(a is not None for a in adapters):
+            results = engine.generate([job.prompt for job, _, _ in pending], sampling, adapters)
+        else:
+            results = engine.generate([job.prompt for job, _, _ in pending], sampling)
+
+        retry = []
+        for (job, max_tokens, ceiling), result in zip(pending, results):
+            job.text = result.text.strip()
+            log(f"    [BUDGET] {os.path.basename(job.input_file)}: max_tokens={max_tokens}, used={result.num_output_tokens}, finish={result.finish_reason}")
+            if result.finish_reason == "abort":
+                aborts[id(job)] = aborts.get(id(job), 0) + 1
+                if aborts[id(job)] > ABORT_RETRIES:
+                    log(f"    [WARNING] {job.input_file}: aborted again ({result.stop_reason}); keeping the partial output.")
+                    continue
+                overrides[id(job)] = abort_retry_sampling(result.stop_reason)
+                log(f"    [RETRY] {job.input_file}: aborted after {result.num_output_tokens} tokens "
+                    f"({result.stop_reason}), retrying with {overrides[id(job)]}")
+                retry.append((job, max_tokens, ceiling))
+                continue
+            if result.finish_reason != "length":
+                continue
+            # Truncated: retry with a larger budget until we hit the context window
+            new_budget = next_budget(max_tokens, ceiling)
+            if new_budget is None:
+                log(f"    [WARNING] {job.input_file}: output truncated at the context window limit.")
+                continue
+            log(f"    [RETRY] {job.input_file}: output truncated, retrying with max_tokens={new_budget}")
+            retry.append((job, new_budget, ceiling))
+        pending = retry
+
+
+# --- 4. PIPELINE BENCHMARK WITHOUT A GPU ---
+def main():
+    """
+    Runs the v14 stages (context filter, prompt, generate, wrap, write) over the
+    recorded cases with the replay engine and prints the stage utilization:
+        python engine_backends.py [--per-token-ms 0] [--repeat 20] [--batch 4]
+    With --per-token-ms 0 the engine is free and the wall time is pure CPU/I-O.
+    """
+    import argparse
+    import tempfile
+    from conversion_steps import build_library_index, filter_context, build_prompt, wrap_xml, read_file
+    from async_pipeline import run_pipeline, print_utilization
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline around a replay engine.")
+    parser.add_argument("--recordings", default="outputs.zip")
+    parser.add_argument("--inputs", default="inputs.zip")
+    parser.add_argument("--context", default="context.txt")
+    parser.add_argument("--prefill-ms", type=float, default=50.0)
+    parser.add_argument("--per-token-ms", type=float, default=0.0)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--queue", type=int, default=4)
+    args = parser.parse_args()
+
+    engine = ReplayEngine(args.recordings, args.inputs, prefill_s=args.prefill_ms / 1000,
+                          per_token_s=args.per_token_ms / 1000)
+    library_index = build_library_index(read_file(args.context))
+    cases = _read_archive(args.inputs, (".txt",))
+    names = [f"{name}__{i}" for i in range(args.repeat) for name in sorted(cases)]
+    output_dir = tempfile.mkdtemp()
+
+    def read_fn(name):
+        return cases[name.rsplit("__", 1)[0]]
+
+    def build_fn(job):
+        filtered = filter_context(library_index, job.user_content)
+        job.prompt = build_prompt(filtered, job.user_content)
+
+    def generate_fn(batch):
+        generate_with_budget(engine, batch, log=lambda *a: None)
+
+    def write_fn(job):
+        job.output_path = os.path.join(output_dir, job.input_file + ".xml")
+        with open(job.output_path, "w") as f:
+            f.write(wrap_xml(job.text))
+
+    import io
+    import contextlib
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+        jobs, stats = run_pipeline(names, read_fn, build_fn, generate_fn, write_fn,
+                                   queue_size=args.queue, batch_size=args.batch)
+    wall = time.perf_counter() - t0
+    print(f"--> Replayed {len(jobs)} cases in {wall:.2f}s ({len(jobs) / wall:.1f} cases/s), "
+          f"{engine.hits} recorded / {engine.misses} synthetic outputs, engine calls: {len(engine.batch_sizes)}")
+    print_utilization(stats)
+
+
+if __name__ == "__main__":
+    main()
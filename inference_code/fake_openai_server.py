@@ -0,0 +1,136 @@
+"""
+Local stand-in for an OpenAI-compatible vLLM server, for exercising the client
+backend without a GPU.
+
+Serves /v1/models, /tokenize and /v1/completions (streaming and non-streaming).
+Each completion waits ttft_s, then emits the canned XML in small chunks every
+per_token_s. With fail_every=N, every Nth completion request is answered with
+503 to exercise client retries. A client that hangs up mid-stream is counted
+in stats["aborted"], as vLLM would abort that request. Connection and request counts are kept in
+server.stats, so keep-alive reuse can be checked.
+
+    python fake_openai_server.py          # serves on 127.0.0.1:8000
+"""
+
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from engine_backends import STUB_XML, ADAPTER_NAME, MAX_MODEL_LEN
+
+CHARS_PER_TOKEN = 3
+
+
+class FakeCompletionsHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.stats["connections"] += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path == "/v1/models":
+            return self._send_json(200, {"object": "list", "data": [
+                {"id": ADAPTER_NAME, "object": "model", "max_model_len": self.server.max_model_len}]})
+        self._send_json(404, {"error": "not found"})
+
+    def do_POST(self):
+        payload = self._read_json()
+        if self.path == "/tokenize":
+            return self._send_json(200, {"count": len(payload.get("prompt", "")) // CHARS_PER_TOKEN})
+        if self.path != "/v1/completions":
+            return self._send_json(404, {"error": "not found"})
+
+        with self.server.lock:
+            self.server.stats["requests"] += 1
+            n = self.server.stats["requests"]
+        if self.server.fail_every and n % self.server.fail_every == 0:
+            with self.server.lock:
+                self.server.stats["injected_failures"] += 1
+            return self._send_json(503, {"error": "injected failure"})
+
+        text = self.server.text
+        max_chars = payload.get("max_tokens", 8192) * CHARS_PER_TOKEN
+        finish_reason = "stop" if len(text) <= max_chars else "length"
+        text = text[:max_chars]
+        chunks = [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+        usage = {"prompt_tokens": len(payload.get("prompt", "")) // CHARS_PER_TOKEN,
+                 "completion_tokens": len(chunks)}
+
+        time.sleep(self.server.ttft_s)
+        if not payload.get("stream"):
+            time.sleep(len(chunks) * self.server.per_token_s)
+            return self._send_json(200, {"object": "text_completion", "model": payload.get("model"),
+                                         "choices": [{"index": 0, "text": text, "finish_reason": finish_reason}],
+                                         "usage": usage})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send_event(data):
+            line = f"data: {data}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(line):X}\r\n".encode("ascii") + line + b"\r\n")
+            self.wfile.flush()
+
+        for i, chunk in enumerate(chunks):
+            last = i == len(chunks) - 1
+            try:
+                send_event(json.dumps({"choices": [{"index": 0, "text": chunk,
+                                                    "finish_reason": finish_reason if last else None}]}))
+            except (BrokenPipeError, ConnectionResetError):
+                # The client hung up mid-stream; vLLM aborts the request at this point
+                with self.server.lock:
+                    self.server.stats["aborted"] += 1
+                    self.server.stats["aborted_after_tokens"] += i
+                self.close_connection = True
+                return
+            time.sleep(self.server.per_token_s)
+        if payload.get("stream_options", {}).get("include_usage"):
+            send_event(json.dumps({"choices": [], "usage": usage}))
+        send_event("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_fake_server(host="127.0.0.1", port=0, ttft_s=0.1, per_token_s=0.001, fail_every=0,
+                      text=STUB_XML, max_model_len=MAX_MODEL_LEN):
+    """Starts the server in a background thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), FakeCompletionsHandler)
+    server.daemon_threads = True
+    server.ttft_s = ttft_s
+    server.per_token_s = per_token_s
+    server.fail_every = fail_every
+    server.text = text
+    server.max_model_len = max_model_len
+    server.lock = threading.Lock()
+    server.stats = {"connections": 0, "requests": 0, "injected_failures": 0, "aborted": 0,
+                    "aborted_after_tokens": 0}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    server, url = start_fake_server(port=8000)
+    print(f"--> Fake OpenAI-compatible server on {url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,311 @@
+"""
+Resident inference daemon: loads the engine and the dictionary index once and
+converts test cases sent over a local HTTP port or UNIX socket.
+
+Concurrent requests go through priority_scheduler.PriorityScheduler. It
+forms engine batches of up to MAX_BATCH requests by weighted fair queueing
+over the "interactive" and "bulk" classes, so several engineers share one
+warm engine and an urgent case is not stuck behind a bulk backlog.
+
+Endpoints:
+    POST /convert   body: {"name": "Test_01", "test_case": "Precondition: ...",
+                           "priority": "interactive" | "bulk", "adapter": "h100_v2"}
+                    (a plain-text body is accepted too; without "adapter" the
+                    case is routed by name prefix, see adapter_routing.py)
+                    -> {"name", "xml", "priority", "adapter", "batch_size", "timings": {stage: seconds}}
+    GET  /health    -> {"status": "ok", "engine", "requests", "adapters", "queued": {class: n},
+                        "latency": {class: {count, p50, p95, max}}}
+
+How to use (from the working directory with context.txt):
+    python inference_daemon.py                       # vLLM, http://127.0.0.1:8765
+    python inference_daemon.py --socket /tmp/tc2xml.sock
+    python inference_daemon.py --stub                # stub engine, no GPU needed
+    python inference_daemon.py --replay outputs.zip  # recorded outputs, no GPU needed
+    python inference_daemon.py --submit inputs/Test_01.txt [--priority bulk] [--socket ...]
+    python inference_daemon.py --selftest            # stub daemon + concurrent clients
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from token_budget import load_budget_model
+from conversion_steps import filter_context, build_library_index, read_file, build_prompt, wrap_xml
+from engine_backends import StubEngine, make_engine, ADAPTER_NAME, ADAPTER_PATH
+from adapter_routing import AdapterRegistry, MAX_RESIDENT_ADAPTERS
+from priority_scheduler import PriorityScheduler, ScheduledJob, PRIORITY_WEIGHTS
+
+# --- 1. CONFIGURATION ---
+HOST = "127.0.0.1"
+PORT = 8765
+CONTEXT_FILE = "context.txt"
+MAX_BATCH = 8
+BATCH_WINDOW_S = 0.02
+# Requests without a "priority" field are treated as an engineer waiting on them
+DEFAULT_PRIORITY = "interactive"
+
+
+# --- 2. SERVICE ---
+class ConversionService:
+    def __init__(self, engine, context_text, budget_model=None, max_batch=MAX_BATCH, window_s=BATCH_WINDOW_S,
+                 registry=None):
+        self.engine = engine
+        self.registry = registry
+        self.library_index = build_library_index(context_text)
+        if self.library_index is None:
+            raise ValueError("Context is not valid JSON.")
+        self.scheduler = PriorityScheduler(engine, budget_model, max_batch=max_batch, window_s=window_s)
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def convert(self, name, user_content, priority=DEFAULT_PRIORITY, adapter=None):
+        with self._lock:
+            self.requests += 1
+        start = time.perf_counter()
+        job = ScheduledJob(input_file=name, user_content=user_content.strip())
+        if self.registry:
+            job.adapter = self.registry.route(name, {"adapter": adapter})
+        elif adapter:
+            raise KeyError(f"Unknown adapter '{adapter}' (no adapter registry loaded)")
+
+        t0 = time.perf_counter()
+        filtered_context = filter_context(self.library_index, job.user_content)
+        job.timings["filter"] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        job.prompt = build_prompt(filtered_context, job.user_content)
+        job.timings["prompt"] = time.perf_counter() - t0
+
+        self.scheduler.submit(job, priority)
+        if job.error:
+            raise RuntimeError(job.error)
+
+        t0 = time.perf_counter()
+        xml = wrap_xml(job.text)
+        job.timings["wrap"] = time.perf_counter() - t0
+        job.timings["total"] = time.perf_counter() - start
+        return {"name": name, "xml": xml, "priority": priority,
+                "adapter": job.adapter.name if job.adapter else None,
+                "batch_size": job.batch_size, "timings": job.timings}
+
+    def shutdown(self):
+        self.scheduler.stop()
+
+
+class ConvertHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def address_string(self):
+        # UNIX socket peers have no (host, port) address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def log_message(self, format, *args):
+        print(f"    [HTTP] {self.address_string()} {format % args}")
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            return self._send_json(404, {"error": f"Unknown path: {self.path}"})
+        service = self.server.service
+        self._send_json(200, {"status": "ok", "engine": type(service.engine).__name__,
+                              "requests": service.requests,
+                              "adapters": sorted(service.registry.adapters) if service.registry else [],
+                              "queued": service.scheduler.queue_depths(),
+                              "latency": service.scheduler.latency_report()})
+
+    def do_POST(self):
+        if self.path != "/convert":
+            return self._send_json(404, {"error": f"Unknown path: {self.path}"})
+        length = int(self.headers.get("Content-Length", 0))
+        raw = self.rfile.read(length).decode("utf-8", errors="replace")
+        try:
+            payload = json.loads(raw)
+            name, user_content = payload.get("name", "request"), payload["test_case"]
+            priority = payload.get("priority", DEFAULT_PRIORITY)
+            adapter = payload.get("adapter")
+        except (json.JSONDecodeError, AttributeError, KeyError, TypeError):
+            name, user_content, priority, adapter = "request", raw, DEFAULT_PRIORITY, None
+        if not user_content.strip():
+            return self._send_json(400, {"error": "Empty test case."})
+        if priority not in PRIORITY_WEIGHTS:
+            return self._send_json(400, {"error": f"Unknown priority '{priority}'."})
+        try:
+            result = self.server.service.convert(name, user_content, priority, adapter)
+        except KeyError as e:
+            return self._send_json(400, {"error": str(e).strip("'\"")})
+        except Exception as e:
+            return self._send_json(500, {"error": str(e)})
+        self._send_json(200, result)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host=HOST, port=PORT, socket_path=None):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, ConvertHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), ConvertHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+# --- 3. CLIENT ---
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def submit_case(user_content, name="request", host=HOST, port=PORT, socket_path=None, timeout=3600,
+                priority=DEFAULT_PRIORITY, adapter=None):
+    conn = UnixHTTPConnection(socket_path, timeout) if socket_path else http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        body = json.dumps({"name": name, "test_case": user_content, "priority": priority, "adapter": adapter})
+        conn.request("POST", "/convert", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        payload = json.loads(response.read().decode("utf-8"))
+    finally:
+        conn.close()
+    if response.status != 200:
+        raise RuntimeError(f"Daemon returned {response.status}: {payload.get('error')}")
+    return payload
+
+
+# --- 4. ENTRY POINTS ---
+SELFTEST_CASE = """Precondition:
+1. Set Battery Voltage to 13.5V
+2. Turn Ignition ON [Ignition_SW_IP= 1]
+Action:
+3. Create CAN Bus OFF fault by shorting the CAN lines to Gnd
+4. Check that EMS MIL Telltale shall be ON
+5. Remove fault
+Postcondition:
+6. Turn Ignition OFF"""
+
+SELFTEST_CONTEXT = json.dumps([
+    {"json_snippet": {"concept": "Set Check Ign On", "library_link": "TVSM_Library.SET_CHECK_IGN_ON",
+                      "xml_tag": "MainLibrary.Serial", "id": "{AC498635-700E-4390-B1DB-B60555784614}", "required_params": []}},
+    {"json_snippet": {"concept": "Deactivate Release Error", "library_link": "TVSM_Library.DEACTIVATE_RELEASE_ERROR",
+                      "xml_tag": "MainLibrary.Serial", "id": "{A877C350-A66E-4CD8-BDE0-E16766212837}", "required_params": []}},
+])
+
+
+def selftest(num_clients=8, prefill_s=0.3):
+    """Stub daemon on a temporary UNIX socket, hit by concurrent clients."""
+    engine = StubEngine(prefill_s=prefill_s)
+    context = read_file(CONTEXT_FILE) if os.path.exists(CONTEXT_FILE) else SELFTEST_CONTEXT
+    service = ConversionService(engine, context)
+    socket_path = os.path.join(tempfile.mkdtemp(), "tc2xml.sock")
+    server = make_server(service, socket_path=socket_path)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = [None] * num_clients
+    def client(i):
+        results[i] = submit_case(SELFTEST_CASE, name=f"client_{i}", socket_path=socket_path)
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.perf_counter() - t0
+
+    server.shutdown()
+    server.server_close()
+    service.shutdown()
+
+    print(f"\n--> {num_clients} concurrent clients served in {wall:.2f}s "
+          f"(engine calls: {len(engine.batch_sizes)}, batch sizes: {engine.batch_sizes})")
+    for r in results:
+        t = r["timings"]
+        print(f"    {r['name']}: batch={r['batch_size']} total={t['total']:.3f}s "
+              f"queue={t['queue_wait']:.3f}s generate={t['generate']:.3f}s "
+              f"filter={t['filter'] * 1000:.1f}ms xml_ok={r['xml'].rstrip().endswith('</Standard.Sequence>')}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resident test-case -> dSPACE XML conversion daemon.")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--socket", dest="socket_path", help="Serve on a UNIX socket instead of TCP.")
+    parser.add_argument("--context", default=CONTEXT_FILE)
+    parser.add_argument("--stub", action="store_true", help="Use the stub engine (no GPU).")
+    parser.add_argument("--replay", metavar="RECORDINGS", help="Replay recorded outputs (.zip/folder of .xml or .blkx).")
+    parser.add_argument("--replay-inputs", default="inputs", help="Inputs the recordings belong to.")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    parser.add_argument("--batch-window", type=float, default=BATCH_WINDOW_S)
+    parser.add_argument("--submit", metavar="FILE", help="Send FILE to a running daemon and print the XML.")
+    parser.add_argument("--priority", default=DEFAULT_PRIORITY, choices=sorted(PRIORITY_WEIGHTS))
+    parser.add_argument("--adapter", help="With --submit: adapter name (default: route by file name).")
+    parser.add_argument("--selftest", action="store_true")
+    args = parser.parse_args()
+
+    if args.selftest:
+        return selftest()
+
+    if args.submit:
+        result = submit_case(read_file(args.submit), name=os.path.basename(args.submit),
+                             host=args.host, port=args.port, socket_path=args.socket_path,
+                             priority=args.priority, adapter=args.adapter)
+        print(result["xml"])
+        print(json.dumps(result["timings"], indent=2), file=sys.stderr)
+        return
+
+    if not os.path.exists(args.context):
+        print(f"CRITICAL: {args.context} missing.")
+        sys.exit(1)
+    context = read_file(args.context)
+
+    registry = AdapterRegistry.load(ADAPTER_NAME, ADAPTER_PATH)
+    max_loras = min(MAX_RESIDENT_ADAPTERS, len(registry.adapters))
+    print(f"--> Adapters: {', '.join(f'{s.name}={s.lora_id}' for s in registry.adapters.values())}")
+    if args.stub:
+        engine = make_engine("stub", max_loras=max_loras)
+    elif args.replay:
+        engine = make_engine("replay", recordings_path=args.replay, inputs_path=args.replay_inputs, max_loras=max_loras)
+    else:
+        print("--> Initializing vLLM Engine...")
+        engine = make_engine("vllm", max_loras=max_loras, max_cpu_loras=len(registry.adapters))
+
+    service = ConversionService(engine, context, load_budget_model(), args.max_batch, args.batch_window, registry)
+    server = make_server(service, args.host, args.port, args.socket_path)
+    where = args.socket_path or f"http://{args.host}:{args.port}"
+    print(f"--> Daemon ready on {where} (engine: {type(engine).__name__})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n--> Shutting down.")
+    finally:
+        server.server_close()
+        service.shutdown()
+        if args.socket_path and os.path.exists(args.socket_path):
+            os.remove(args.socket_path)
+
+
+if __name__ == "__main__":
+    main()
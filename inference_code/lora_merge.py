@@ -0,0 +1,415 @@
+"""
+Offline LoRA merge: folds the adapter into the base weights and writes a
+standalone checkpoint, so the engine can serve it without enable_lora (no
+per-token LoRA matmuls, no max_lora_rank slots, no LoRA-incompatible kernels).
+
+For every module the adapter targets (lora_target_linear: all q/k/v/o and
+gate/up/down projections):
+
+    W' = W + scale * B @ A        scale = lora_alpha / r   (alpha / sqrt(r) with use_rslora)
+
+r, lora_alpha and the module list come from the adapter's adapter_config.json
+(config.yaml trained it with lora_r 32, lora_alpha 64, so scale 2.0).
+
+The merge goes shard by shard and tensor by tensor. Each input shard is
+memory-mapped (its pages are page cache, not process memory), the output shard
+gets the same header (names, dtypes and shapes don't change) and the tensors
+are written one after another, so peak RAM is a few copies of one tensor, not
+the whole model. merge_torch peaks at about five times a merged tensor's bf16
+size: the bytes read from the mmap, the float32 copy from .float() (twice the
+size; the bytearray torch.frombuffer needs is freed before it), the bf16
+result of .to() and the bytes of .tobytes(). For Qwen2.5-72B the largest
+merged tensors are the MLP projections (29568 x 8192, 0.48 GB in bf16), so
+about 2.4 GB; embed_tokens and lm_head (2.5 GB) are not merged and pass
+through as one copy. The pure-Python path holds each weight as a Python float
+and is only meant for selftest. config.json, the tokenizer files and
+model.safetensors.index.json are copied unchanged.
+
+The base must be the unquantized checkpoint (Qwen/Qwen2.5-72B-Instruct in
+bf16, about 145 GB): 4-bit AWQ weights cannot take a dense delta, and
+merge_checkpoint refuses a base whose config.json has a quantization_config.
+That includes the Qwen2.5-72B-Instruct-AWQ the README downloads to
+/workspace/manual_models/base and v14 serves, so the bf16 base has to be
+downloaded separately (README, Phase 3). The merged bf16 checkpoint is about
+145 GB as well and fits neither GPU profile (80 GB, 141 GB), so quantize it
+back to AWQ 4-bit with the `quantize` step below (AutoAWQ, the group size and
+zero point of Qwen's own AWQ release) before pointing MERGED_MODEL_PATH at it.
+The adapter was trained on a 4-bit base (QLoRA, config.yaml) and is served
+today on the AWQ base; the merged, requantized model is neither of those
+exactly, so run output_validation.py on its outputs before switching v14 over.
+
+The arithmetic runs in torch when it is installed (the GPU pod); without it a
+pure-Python path does the same, which is only fast enough for the small
+synthetic model of `selftest`. selftest merges with both backends (the torch
+one when torch is installed) and checks the merged layers against the LoRA
+forward pass the engine computes, x W^T + scale * (x A^T) B^T.
+
+How to use:
+    python lora_merge.py /workspace/manual_models/base_bf16 /workspace/manual_models/adapter /workspace/manual_models/merged_bf16
+    python lora_merge.py quantize /workspace/manual_models/merged_bf16 /workspace/manual_models/merged
+    python lora_merge.py selftest
+    MERGED_MODEL_PATH = "/workspace/manual_models/merged" in run_batch_tests_v14.py
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import mmap
+import time
+import array
+import shutil
+import struct
+import argparse
+
+# --- 1. CONFIGURATION ---
+ADAPTER_CONFIG_FILE = "adapter_config.json"
+ADAPTER_WEIGHTS_FILE = "adapter_model.safetensors"
+INDEX_FILE = "model.safetensors.index.json"
+# lora_r / lora_alpha in config.yaml, used when the adapter has no adapter_config.json
+DEFAULT_R = 32
+DEFAULT_ALPHA = 64
+# AutoAWQ settings of Qwen/Qwen2.5-72B-Instruct-AWQ (4-bit, group size 128, zero point, GEMM kernels)
+AWQ_QUANT_CONFIG = {"zero_point": True, "q_group_size": 128, "w_bit": 4, "version": "GEMM"}
+# PEFT names: base_model.model.<module>.lora_A.weight (older saves: .lora_A.default.weight)
+LORA_KEY = re.compile(r"^(?:base_model\.model\.)?(?P<module>.+)\.lora_(?P<ab>[AB])(?:\.[\w-]+)?\.weight$")
+
+
+# --- 2. SAFETENSORS I/O ---
+class SafetensorsFile:
+    """A memory-mapped .safetensors file: header dict + raw bytes per tensor."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        (header_len,) = struct.unpack("<Q", self._file.read(8))
+        self.header_bytes = self._file.read(header_len)
+        self.header = json.loads(self.header_bytes)
+        self.metadata = self.header.pop("__metadata__", None)
+        self.data_start = 8 + header_len
+        size = os.path.getsize(path)
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size > self.data_start else None
+
+    def names(self):
+        """Tensor names in file order (data_offsets), the order they are written back in."""
+        return sorted(self.header, key=lambda n: self.header[n]["data_offsets"][0])
+
+    def raw(self, name):
+        start, end = self.header[name]["data_offsets"]
+        if start == end:
+            return b""
+        # A copy of one tensor: a memoryview would pin the mmap open
+        return self._mmap[self.data_start + start:self.data_start + end]
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_safetensors(path, tensors, metadata=None):
+    """tensors: {name: (dtype, shape, bytes)}. Used by selftest to build the synthetic model."""
+    header, offset = {}, 0
+    for name, (dtype, shape, data) in tensors.items():
+        header[name] = {"dtype": dtype, "shape": list(shape), "data_offsets": [offset, offset + len(data)]}
+        offset += len(data)
+    if metadata:
+        header["__metadata__"] = metadata
+    encoded = json.dumps(header).encode("utf-8")
+    encoded += b" " * (-len(encoded) % 8)
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        for _, _, data in tensors.values():
+            f.write(data)
+
+
+# --- 3. ARITHMETIC ---
+def _to_floats(raw, dtype):
+    """Raw little-endian bytes -> list of Python floats (pure-Python path)."""
+    if dtype == "F32":
+        return array.array("f", bytes(raw)).tolist()
+    if dtype == "F16":
+        return list(struct.unpack(f"<{len(raw) // 2}e", raw))
+    if dtype == "BF16":
+        halves = array.array("H", bytes(raw))
+        widened = array.array("I", (h << 16 for h in halves))
+        return array.array("f", widened.tobytes()).tolist()
+    raise ValueError(f"Cannot merge into a {dtype} tensor (quantized base?).")
+
+
+def _from_floats(values, dtype):
+    if dtype == "F32":
+        return array.array("f", values).tobytes()
+    if dtype == "F16":
+        return struct.pack(f"<{len(values)}e", *values)
+    # BF16: round the float32 bits to nearest even, like torch's .to(torch.bfloat16)
+    bits = array.array("I", array.array("f", values).tobytes())
+    return array.array("H", (((b + 0x7FFF + ((b >> 16) & 1)) >> 16) & 0xFFFF for b in bits)).tobytes()
+
+
+def merge_python(raw, dtype, shape, lora_a, lora_b, scale):
+    """W + scale * B @ A on lists; W is [out, in], A and B are (raw, dtype, [r, in] / [out, r])."""
+    out_dim, in_dim = shape
+    w = _to_floats(raw, dtype)
+    a, b = _to_floats(*lora_a[:2]), _to_floats(*lora_b[:2])
+    r = lora_a[2][0]
+    for o in range(out_dim):
+        b_row = [scale * b[o * r + k] for k in range(r)]
+        base = o * in_dim
+        for i in range(in_dim):
+            w[base + i] += sum(b_row[k] * a[k * in_dim + i] for k in range(r))
+    return _from_floats(w, dtype)
+
+
+def merge_torch(raw, dtype, shape, lora_a, lora_b, scale):
+    import torch
+
+    dtypes = {"F32": torch.float32, "F16": torch.float16, "BF16": torch.bfloat16}
+
+    def tensor(raw, dtype, shape):
+        return torch.frombuffer(bytearray(raw), dtype=dtypes[dtype]).reshape(shape).float()
+
+    w = tensor(raw, dtype, shape)
+    w.addmm_(tensor(*lora_b), tensor(*lora_a), alpha=scale)
+    return w.to(dtypes[dtype]).contiguous().view(torch.uint8).numpy().tobytes()
+
+
+def pick_backend(name="auto"):
+    if name == "auto":
+        try:
+            import torch  # noqa: F401
+            return merge_torch
+        except ImportError:
+            return merge_python
+    return {"torch": merge_torch, "python": merge_python}[name]
+
+
+# --- 4. MERGE ---
+def load_adapter(adapter_dir, adapter):
+    """
+    ({base tensor name: (A name, B name)}, scale) for the open adapter file. The
+    A/B weights are read from it one module at a time, when their shard comes up.
+    """
+    config = {}
+    config_path = os.path.join(adapter_dir, ADAPTER_CONFIG_FILE)
+    if os.path.exists(config_path):
+        with open(config_path, "r") as f:
+            config = json.load(f)
+    r = config.get("r", DEFAULT_R)
+    alpha = config.get("lora_alpha", DEFAULT_ALPHA)
+    scale = alpha / math.sqrt(r) if config.get("use_rslora") else alpha / r
+
+    pairs = {}
+    for name in adapter.names():
+        match = LORA_KEY.match(name)
+        if not match:
+            raise ValueError(f"{name}: not a LoRA A/B weight; merging modules_to_save is not supported.")
+        pairs.setdefault(match.group("module") + ".weight", {})[match.group("ab")] = name
+    incomplete = [name for name, ab in pairs.items() if set(ab) != {"A", "B"}]
+    if incomplete:
+        raise ValueError(f"LoRA weights without their A/B partner: {incomplete[:3]}")
+    return {name: (ab["A"], ab["B"]) for name, ab in pairs.items()}, scale
+
+
+def merge_shard(in_path, out_path, adapter, lora, scale, merge_fn):
+    """Writes one merged shard. Returns the names of the tensors it changed."""
+    merged = []
+    tmp_path = out_path + ".tmp"
+    with SafetensorsFile(in_path) as shard, open(tmp_path, "wb") as out:
+        out.write(struct.pack("<Q", len(shard.header_bytes)))
+        out.write(shard.header_bytes)   # same names, dtypes, shapes and offsets
+        for name in shard.names():
+            info = shard.header[name]
+            raw = shard.raw(name)
+            if name in lora:
+                lora_a, lora_b = ((adapter.raw(n), adapter.header[n]["dtype"], adapter.header[n]["shape"])
+                                  for n in lora[name])
+                expected = [lora_b[2][0], lora_a[2][1]]
+                if info["shape"] != expected:
+                    raise ValueError(f"{name}: base shape {info['shape']} but B @ A is {expected}")
+                out.write(merge_fn(raw, info["dtype"], info["shape"], lora_a, lora_b, scale))
+                merged.append(name)
+            else:
+                out.write(raw)
+    os.replace(tmp_path, out_path)
+    return merged
+
+
+def merge_checkpoint(base_dir, adapter_dir, out_dir, backend="auto", log=print):
+    config_path = os.path.join(base_dir, "config.json")
+    if os.path.exists(config_path):
+        with open(config_path, "r") as f:
+            quant = json.load(f).get("quantization_config")
+        if quant:
+            raise ValueError(f"{base_dir} is quantized ({quant.get('quant_method')}); merge into the bf16 checkpoint.")
+    merge_fn = pick_backend(backend)
+    with SafetensorsFile(os.path.join(adapter_dir, ADAPTER_WEIGHTS_FILE)) as adapter:
+        _merge_shards(base_dir, adapter_dir, adapter, out_dir, merge_fn, log)
+
+
+def _merge_shards(base_dir, adapter_dir, adapter, out_dir, merge_fn, log):
+    lora, scale = load_adapter(adapter_dir, adapter)
+    log(f"--> Merging {len(lora)} LoRA modules (scale {scale:g}) into {base_dir} "
+        f"[{merge_fn.__name__.replace('merge_', '')}]")
+    os.makedirs(out_dir, exist_ok=True)
+    remaining = set(lora)
+    start = time.perf_counter()
+    total_bytes = 0
+    for name in sorted(os.listdir(base_dir)):
+        src = os.path.join(base_dir, name)
+        if os.path.isdir(src) or name.startswith("."):
+            continue
+        dst = os.path.join(out_dir, name)
+        if not name.endswith(".safetensors"):
+            shutil.copy2(src, dst)   # config.json, tokenizer, index (shard layout is unchanged)
+            continue
+        t0 = time.perf_counter()
+        merged = merge_shard(src, dst, adapter, lora, scale, merge_fn)
+        remaining -= set(merged)
+        size = os.path.getsize(dst)
+        total_bytes += size
+        log(f"    [MERGE] {name}: {len(merged)} tensors merged, {size / 1e9:.2f} GB "
+            f"in {time.perf_counter() - t0:.1f}s")
+    if remaining:
+        raise ValueError(f"{len(remaining)} adapter modules have no base tensor, e.g. {sorted(remaining)[:3]}")
+    log(f"--> Merged checkpoint in {out_dir} ({total_bytes / 1e9:.2f} GB, {time.perf_counter() - start:.1f}s)")
+
+
+# --- 5. REQUANTIZE FOR SERVING ---
+def quantize_checkpoint(merged_dir, out_dir, quant_config=AWQ_QUANT_CONFIG, log=print):
+    """
+    AWQ 4-bit copy of a merged bf16 checkpoint, servable like the AWQ base
+    (vLLM reads the quantization_config that save_quantized writes). AutoAWQ
+    loads the model into CPU RAM (~145 GB for Qwen2.5-72B) and calibrates it
+    layer by layer on one GPU.
+    """
+    from awq import AutoAWQForCausalLM
+    from transformers import AutoTokenizer
+
+    start = time.perf_counter()
+    log(f"--> Quantizing {merged_dir} to AWQ {quant_config['w_bit']}-bit (group size {quant_config['q_group_size']})")
+    model = AutoAWQForCausalLM.from_pretrained(merged_dir, low_cpu_mem_usage=True, use_cache=False)
+    tokenizer = AutoTokenizer.from_pretrained(merged_dir)
+    model.quantize(tokenizer, quant_config=quant_config)
+    model.save_quantized(out_dir)
+    tokenizer.save_pretrained(out_dir)
+    log(f"--> Quantized checkpoint in {out_dir} ({time.perf_counter() - start:.0f}s)")
+
+
+# --- 6. SELFTEST ON A TINY SYNTHETIC MODEL ---
+def selftest(hidden=24, inter=40, layers=2, r=4, alpha=8):
+    import random
+    import tempfile
+
+    rng = random.Random(0)
+    tmp = tempfile.mkdtemp()
+    base_dir, adapter_dir, out_dir = (os.path.join(tmp, d) for d in ("base", "adapter", "merged"))
+    os.makedirs(base_dir)
+    os.makedirs(adapter_dir)
+    try:
+        def rand(n, std=0.1):
+            return [rng.gauss(0, std) for _ in range(n)]
+
+        # Two shards of bf16 linear weights + an untouched norm; LoRA on q_proj and down_proj
+        shapes = {"self_attn.q_proj": (hidden, hidden), "mlp.down_proj": (hidden, inter),
+                  "mlp.up_proj": (inter, hidden)}
+        base, adapter, index = {}, {}, {}
+        for layer in range(layers):
+            shard = f"model-{layer + 1:05d}-of-{layers:05d}.safetensors"
+            tensors = {}
+            for module, shape in shapes.items():
+                name = f"model.layers.{layer}.{module}.weight"
+                tensors[name] = ("BF16", shape, _from_floats(rand(shape[0] * shape[1]), "BF16"))
+                if module != "mlp.up_proj":
+                    prefix = f"base_model.model.model.layers.{layer}.{module}"
+                    adapter[f"{prefix}.lora_A.weight"] = ("F32", (r, shape[1]), _from_floats(rand(r * shape[1]), "F32"))
+                    adapter[f"{prefix}.lora_B.weight"] = ("F32", (shape[0], r), _from_floats(rand(shape[0] * r), "F32"))
+            tensors[f"model.layers.{layer}.input_layernorm.weight"] = ("BF16", (hidden,), _from_floats([1.0] * hidden, "BF16"))
+            write_safetensors(os.path.join(base_dir, shard), tensors, {"format": "pt"})
+            base.update(tensors)
+            index.update(dict.fromkeys(tensors, shard))
+        with open(os.path.join(base_dir, INDEX_FILE), "w") as f:
+            json.dump({"metadata": {}, "weight_map": index}, f)
+        write_safetensors(os.path.join(adapter_dir, ADAPTER_WEIGHTS_FILE), adapter)
+        with open(os.path.join(adapter_dir, ADAPTER_CONFIG_FILE), "w") as f:
+            json.dump({"r": r, "lora_alpha": alpha, "target_modules": ["q_proj", "down_proj"]}, f)
+
+        # merge_torch is what a real merge runs; merge_python where torch is missing
+        backends = ["python"] + (["torch"] if pick_backend("auto") is merge_torch else [])
+        for backend in backends:
+            merge_checkpoint(base_dir, adapter_dir, f"{out_dir}_{backend}", backend=backend)
+            worst, checked = _check_merge(f"{out_dir}_{backend}", base, adapter, layers, r, alpha / r, rng)
+            # bf16 keeps 8 mantissa bits: ~0.4% per weight, averaging out over the dot product
+            assert worst < 1e-2, f"{backend}: merged output differs from base + LoRA by {worst:.2e}"
+            assert os.path.exists(os.path.join(f"{out_dir}_{backend}", INDEX_FILE))
+            print(f"--> Selftest passed ({backend} backend): {checked} merged layers match base + LoRA "
+                  f"(max relative error {worst:.1e}, bf16 rounding); untouched tensors are byte-identical.")
+        if "torch" not in backends:
+            print("    [WARNING] torch is not installed: merge_torch, the backend of a real merge, was not tested.")
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _check_merge(out_dir, base, adapter, layers, r, scale, rng):
+    """(max relative error, layers checked): the merged layers against x W^T + scale (x A^T) B^T."""
+    worst, checked = 0.0, 0
+    for layer in range(layers):
+        shard = f"model-{layer + 1:05d}-of-{layers:05d}.safetensors"
+        with SafetensorsFile(os.path.join(out_dir, shard)) as merged:
+            for name in merged.names():
+                info = merged.header[name]
+                w_merged = _to_floats(merged.raw(name), info["dtype"])
+                w_base = _to_floats(base[name][2], "BF16")
+                prefix = "base_model.model." + name[:-len(".weight")]
+                if prefix + ".lora_A.weight" not in adapter:
+                    assert w_merged == w_base, f"{name} changed without an adapter"
+                    continue
+                out_dim, in_dim = info["shape"]
+                a = _to_floats(adapter[prefix + ".lora_A.weight"][2], "F32")
+                b = _to_floats(adapter[prefix + ".lora_B.weight"][2], "F32")
+                x = [rng.gauss(0, 1.0) for _ in range(in_dim)]
+                xa = [sum(x[i] * a[k * in_dim + i] for i in range(in_dim)) for k in range(r)]
+                for o in range(out_dim):
+                    lora_y = (sum(x[i] * w_base[o * in_dim + i] for i in range(in_dim))
+                              + scale * sum(xa[k] * b[o * r + k] for k in range(r)))
+                    merged_y = sum(x[i] * w_merged[o * in_dim + i] for i in range(in_dim))
+                    worst = max(worst, abs(merged_y - lora_y) / max(abs(lora_y), 1.0))
+                checked += 1
+    return worst, checked
+
+
+def main():
+    if sys.argv[1:2] == ["selftest"]:
+        return selftest()
+    if sys.argv[1:2] == ["quantize"]:
+        parser = argparse.ArgumentParser(prog="lora_merge.py quantize",
+                                         description="AWQ 4-bit copy of a merged bf16 checkpoint.")
+        parser.add_argument("merged")
+        parser.add_argument("out")
+        args = parser.parse_args(sys.argv[2:])
+        try:
+            quantize_checkpoint(args.merged, args.out)
+        except ImportError as e:
+            print(f"CRITICAL: quantize needs {e.name} (pip install autoawq).")
+            return 1
+        return 0
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into the base weights, shard by shard.")
+    parser.add_argument("base")
+    parser.add_argument("adapter")
+    parser.add_argument("out")
+    parser.add_argument("--backend", choices=["auto", "torch", "python"], default="auto")
+    args = parser.parse_args()
+    merge_checkpoint(args.base, args.adapter, args.out, args.backend)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""
+Model preparation before the first LLM(...) load: verify every .safetensors
+file of the base model and the adapter, then warm the page cache so engine
+start is bound by the GPU transfer, not by a cold 40 GB disk read.
+
+1. Header check (instant): a safetensors file is an 8-byte header length, a
+   JSON header and the tensor data. A file shorter than the header says it is
+   is a partial download, reported before any hashing.
+2. Hashes: sha256 of every shard in parallel threads (hashlib releases the
+   GIL on large updates), compared with the recorded hashes:
+     - sha256sums.json next to the weights ({"file": "hex", ...}, written by
+       `python model_prep.py record`), or else
+     - the .cache/huggingface/download/*.metadata files that
+       `huggingface-cli download --local-dir` leaves behind (their etag is
+       the LFS sha256).
+3. Warm: posix_fadvise + madvise(MADV_WILLNEED) on an mmap of each shard,
+   then one read per page so the data is really resident. Verification has
+   already read the files once; `warm` alone is the fast path for a machine
+   that verified them before.
+
+Throughput (GB/s) is reported per step.
+
+How to use:
+    python model_prep.py verify [/workspace/manual_models/base /workspace/manual_models/adapter]
+    python model_prep.py record /workspace/manual_models/base
+    python model_prep.py warm
+    python model_prep.py selftest          # synthetic shards, no model needed
+"""
+
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from engine_backends import BASE_MODEL_PATH, ADAPTER_PATH
+
+# --- 1. CONFIGURATION ---
+MANIFEST_FILE = "sha256sums.json"
+HF_METADATA_DIR = os.path.join(".cache", "huggingface", "download")
+CHUNK_BYTES = 8 * 1024 * 1024
+PAGE_BYTES = mmap.PAGESIZE
+HASH_WORKERS = min(8, (os.cpu_count() or 1) * 2)
+
+
+# --- 2. CHECKS ---
+def weight_files(model_dir):
+    """Relative paths of the .safetensors files under model_dir (sorted)."""
+    files = []
+    for root, dirs, names in os.walk(model_dir):
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in names:
+            if name.endswith(".safetensors"):
+                files.append(os.path.relpath(os.path.join(root, name), model_dir))
+    return sorted(files)
+
+
+def check_header(path):
+    """None if the file is as long as its safetensors header says, else the problem."""
+    size = os.path.getsize(path)
+    if size < 8:
+        return f"{size} bytes, too short for a safetensors header"
+    with open(path, "rb") as f:
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        if 8 + header_len > size:
+            return f"header of {header_len} bytes runs past the end of the file ({size} bytes)"
+        try:
+            header = json.loads(f.read(header_len))
+        except (ValueError, UnicodeDecodeError) as e:
+            return f"header is not valid JSON: {e}"
+    data_end = max((t["data_offsets"][1] for k, t in header.items() if k != "__metadata__"), default=0)
+    expected = 8 + header_len + data_end
+    if size != expected:
+        return f"{size} bytes, header expects {expected} (partial download?)"
+    return None
+
+
+def sha256_file(path, chunk_bytes=CHUNK_BYTES):
+    digest = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        buf = bytearray(chunk_bytes)
+        view = memoryview(buf)
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+def recorded_hashes(model_dir):
+    """{relative file: sha256} from sha256sums.json or the huggingface download metadata."""
+    manifest = os.path.join(model_dir, MANIFEST_FILE)
+    if os.path.exists(manifest):
+        with open(manifest, "r") as f:
+            return json.load(f)
+    hashes = {}
+    metadata_dir = os.path.join(model_dir, HF_METADATA_DIR)
+    for root, _, names in os.walk(metadata_dir):
+        for name in names:
+            if not name.endswith(".metadata"):
+                continue
+            with open(os.path.join(root, name), "r") as f:
+                lines = f.read().splitlines()
+            # commit hash, etag, timestamp; the etag of an LFS file is its sha256
+            if len(lines) >= 2 and len(lines[1].strip('"')) == 64:
+                relative = os.path.relpath(os.path.join(root, name[:-len(".metadata")]), metadata_dir)
+                hashes[relative] = lines[1].strip('"')
+    return hashes
+
+
+# --- 3. VERIFY / WARM ---
+def _run_parallel(fn, paths, workers):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(fn, paths))
+    return results, time.perf_counter() - start
+
+
+def _rate(nbytes, seconds):
+    return f"{nbytes / 1e9:.2f} GB in {seconds:.2f}s ({nbytes / 1e9 / max(seconds, 1e-9):.2f} GB/s)"
+
+
+def verify(model_dir, workers=HASH_WORKERS, log=print):
+    """Header-checks and hashes every shard. Returns the list of problems ([] = all good)."""
+    files = weight_files(model_dir)
+    if not files:
+        return [f"{model_dir}: no .safetensors files"]
+    paths = [os.path.join(model_dir, f) for f in files]
+    problems = []
+    for name, path in zip(files, paths):
+        problem = check_header(path)
+        if problem:
+            problems.append(f"{name}: {problem}")
+    if problems:
+        return problems   # don't spend minutes hashing a download that is known to be incomplete
+
+    expected = recorded_hashes(model_dir)
+    if not expected:
+        log(f"    [WARNING] {model_dir}: no {MANIFEST_FILE} or huggingface metadata; headers checked only.")
+        return []
+    digests, seconds = _run_parallel(sha256_file, paths, workers)
+    total = sum(os.path.getsize(p) for p in paths)
+    for name, digest in zip(files, digests):
+        if name not in expected:
+            log(f"    [WARNING] {name}: no recorded hash.")
+        elif expected[name] != digest:
+            problems.append(f"{name}: sha256 {digest[:12]}... != recorded {expected[name][:12]}...")
+    missing = sorted(set(expected) - set(files) - {MANIFEST_FILE})
+    problems.extend(f"{name}: recorded but missing" for name in missing if name.endswith(".safetensors"))
+    log(f"    [VERIFY] {model_dir}: {len(files)} shards, {_rate(total, seconds)} with {workers} threads")
+    return problems
+
+
+def record(model_dir, workers=HASH_WORKERS, log=print):
+    """Writes sha256sums.json for the shards as they are now (after a download you trust)."""
+    files = weight_files(model_dir)
+    digests, seconds = _run_parallel(sha256_file, [os.path.join(model_dir, f) for f in files], workers)
+    with open(os.path.join(model_dir, MANIFEST_FILE), "w") as f:
+        json.dump(dict(zip(files, digests)), f, indent=2)
+    log(f"--> Recorded {len(files)} hashes in {os.path.join(model_dir, MANIFEST_FILE)} ({seconds:.2f}s)")
+
+
+def warm_file(path):
+    """Asks the kernel to read the file ahead, then touches every page. Returns bytes."""
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    with open(path, "rb") as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_WILLNEED)
+            touched = 0
+            for offset in range(0, size, PAGE_BYTES):
+                touched ^= mm[offset]
+    return size
+
+
+def warm(model_dir, workers=HASH_WORKERS, log=print):
+    paths = [os.path.join(model_dir, f) for f in weight_files(model_dir)]
+    sizes, seconds = _run_parallel(warm_file, paths, workers)
+    log(f"    [WARM] {model_dir}: {len(paths)} shards, {_rate(sum(sizes), seconds)}")
+    return sum(sizes), seconds
+
+
+def prepare(model_dirs, do_verify=True, do_warm=True, workers=HASH_WORKERS, log=print):
+    """verify + warm every directory. Returns False if any shard failed verification."""
+    ok = True
+    for model_dir in model_dirs:
+        if do_verify:
+            problems = verify(model_dir, workers, log)
+            for problem in problems:
+                log(f"    [ERROR] {problem}")
+            ok = ok and not problems
+        if do_warm and ok:
+            warm(model_dir, workers, log)
+    return ok
+
+
+# --- 4. SELFTEST WITH SYNTHETIC SHARDS ---
+def write_shard(path, tensor_bytes):
+    """A minimal valid safetensors file with one uint8 tensor of random bytes."""
+    header = json.dumps({"__metadata__": {"format": "pt"},
+                         "weight": {"dtype": "U8", "shape": [tensor_bytes], "data_offsets": [0, tensor_bytes]}})
+    header = header.encode("utf-8")
+    header += b" " * (-len(header) % 8)   # the format pads the header to 8 bytes
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(os.urandom(tensor_bytes))
+
+
+def selftest(shards=4, shard_mib=32):
+    import shutil
+    import tempfile
+
+    model_dir = tempfile.mkdtemp()
+    try:
+        for i in range(shards):
+            write_shard(os.path.join(model_dir, f"model-{i + 1:05d}-of-{shards:05d}.safetensors"), shard_mib << 20)
+        record(model_dir)
+        assert prepare([model_dir]), "clean shards must verify"
+        for workers in (1, HASH_WORKERS):
+            verify(model_dir, workers, log=print)
+
+        # One flipped byte -> hash mismatch
+        victim = os.path.join(model_dir, f"model-00002-of-{shards:05d}.safetensors")
+        with open(victim, "r+b") as f:
+            f.seek(1 << 20)
+            byte = f.read(1)
+            f.seek(1 << 20)
+            f.write(bytes([byte[0] ^ 0xFF]))
+        problems = verify(model_dir, log=lambda *_: None)
+        assert len(problems) == 1 and "sha256" in problems[0], problems
+        print(f"--> Corrupted shard detected: {problems[0]}")
+
+        # Cut short -> header check, without hashing
+        with open(victim, "r+b") as f:
+            f.truncate((shard_mib << 20) // 2)
+        problems = verify(model_dir, log=lambda *_: None)
+        assert len(problems) == 1 and "partial download" in problems[0], problems
+        print(f"--> Truncated shard detected: {problems[0]}")
+        print("--> Selftest passed.")
+    finally:
+        shutil.rmtree(model_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Verify and pre-load the model weights.")
+    parser.add_argument("command", choices=["verify", "warm", "record", "selftest"])
+    parser.add_argument("dirs", nargs="*", default=[BASE_MODEL_PATH, ADAPTER_PATH])
+    parser.add_argument("--workers", type=int, default=HASH_WORKERS)
+    args = parser.parse_args()
+
+    if args.command == "selftest":
+        return selftest()
+    if args.command == "record":
+        for model_dir in args.dirs:
+            record(model_dir, args.workers)
+        return 0
+    ok = prepare(args.dirs, do_verify=args.command == "verify", workers=args.workers)
+    if not ok:
+        print("CRITICAL: model files failed verification; re-download them before starting the engine.")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
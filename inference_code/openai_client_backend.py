@@ -0,0 +1,284 @@
+"""
+Client backend for a separately running OpenAI-compatible server (vLLM's
+`vllm serve`), so the batch driver no longer owns the model and several
+drivers can share one GPU server.
+
+Start the server once, with the adapter registered under ADAPTER_NAME:
+    vllm serve /workspace/manual_models/base \
+        --enable-lora --max-lora-rank 64 --max-model-len 32768 \
+        --lora-modules dspace_adapter=/workspace/manual_models/adapter
+
+then set BACKEND = "openai" in run_batch_tests_v14.py.
+
+OpenAIClientEngine has the same generate()/count_tokens() interface as the
+engines in engine_backends.py. Per-case adapters are sent as the request's
+"model" (register each one with --lora-modules name=path and size
+--max-loras to the number that should stay resident). It keeps a pool of keep-alive HTTP connections,
+sends at most max_concurrency requests at a time, streams every completion
+(SSE) and retries connection errors, 429 and 5xx with exponential backoff.
+
+Run this file directly to benchmark it against fake_openai_server.py:
+    python openai_client_backend.py
+"""
+
+import json
+import time
+import functools
+import queue
+import random
+import http.client
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from engine_backends import GenerationResult, apply_monitor, ADAPTER_NAME, MAX_MODEL_LEN
+
+# --- 1. CONFIGURATION ---
+BASE_URL = "http://127.0.0.1:8000"
+API_KEY = "EMPTY"
+MAX_CONCURRENCY = 8
+MAX_RETRIES = 4
+BACKOFF_S = 0.5
+REQUEST_TIMEOUT_S = 1800
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    pass
+
+
+# --- 2. CONNECTION POOL ---
+class ConnectionPool:
+    """A fixed set of keep-alive connections, handed out one request at a time."""
+
+    def __init__(self, base_url, size, timeout):
+        parsed = urlparse(base_url)
+        self.host = parsed.hostname
+        self.port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        self.conn_cls = http.client.HTTPSConnection if parsed.scheme == "https" else http.client.HTTPConnection
+        self.prefix = parsed.path.rstrip("/")
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(None)   # created lazily on first use
+
+    def acquire(self):
+        conn = self._idle.get()
+        return conn or self.conn_cls(self.host, self.port, timeout=self.timeout)
+
+    def release(self, conn, broken=False):
+        if broken:
+            conn.close()
+            conn = None
+        self._idle.put(conn)
+
+    def close(self):
+        while not self._idle.empty():
+            conn = self._idle.get_nowait()
+            if conn:
+                conn.close()
+
+
+# --- 3. ENGINE ---
+class OpenAIClientEngine:
+    def __init__(self, base_url=BASE_URL, model=ADAPTER_NAME, api_key=API_KEY,
+                 max_concurrency=MAX_CONCURRENCY, stream=True, max_retries=MAX_RETRIES,
+                 backoff_s=BACKOFF_S, timeout=REQUEST_TIMEOUT_S):
+        self.model = model
+        self.use_sse = stream
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.headers = {"Content-Type": "application/json", "Authorization": f"Bearer {api_key}"}
+        self.pool = ConnectionPool(base_url, max_concurrency, timeout)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="openai")
+        self.retries = 0
+        self.stop_monitor = None
+        self.aborts_mid_decode = stream   # without SSE the monitor only sees the finished text
+        # The server swaps adapters itself, so any mix is fine within one generate() call
+        self.max_loras = max_concurrency
+        self.max_model_len = self._fetch_max_model_len()
+
+    # -- HTTP helpers --
+    def _request(self, method, path, payload=None, on_response=None):
+        """
+        One HTTP exchange on a pooled connection, retried with backoff.
+        on_response(response) consumes the body; defaults to json.loads.
+        """
+        body = json.dumps(payload) if payload is not None else None
+        for attempt in range(self.max_retries + 1):
+            conn = self.pool.acquire()
+            broken = False
+            try:
+                conn.request(method, self.pool.prefix + path, body=body, headers=self.headers)
+                response = conn.getresponse()
+                if response.status in RETRY_STATUSES:
+                    response.read()
+                    raise RetryableError(f"HTTP {response.status}")
+                if response.status != 200:
+                    detail = response.read().decode("utf-8", errors="replace")
+                    raise RuntimeError(f"{method} {path} failed with HTTP {response.status}: {detail[:500]}")
+                result = on_response(response) if on_response else json.loads(response.read())
+                if response.will_close:
+                    broken = True
+                return result
+            except (RetryableError, ConnectionError, http.client.HTTPException, OSError) as e:
+                # A 429/5xx reply was read in full and leaves the connection usable
+                broken = broken or not isinstance(e, RetryableError)
+                if attempt == self.max_retries:
+                    raise RuntimeError(f"{method} {path} failed after {attempt + 1} attempts: {e}")
+                self.retries += 1
+                time.sleep(self.backoff_s * (2 ** attempt) * (0.5 + random.random()))
+            finally:
+                self.pool.release(conn, broken)
+
+    def _fetch_max_model_len(self):
+        try:
+            models = self._request("GET", "/v1/models")
+            for entry in models.get("data", []):
+                if entry.get("max_model_len"):
+                    return entry["max_model_len"]
+        except RuntimeError as e:
+            print(f"    [WARNING] Could not read max_model_len from server: {e}")
+        return MAX_MODEL_LEN
+
+    # -- Engine interface --
+    def count_tokens(self, text):
+        try:
+            return self._request("POST", "/tokenize", {"model": self.model, "prompt": text})["count"]
+        except (RuntimeError, KeyError):
+            return int(len(text) / 3.0)
+
+    def _payload(self, prompt, sampling, model=None):
+        payload = {"model": model or self.model, "prompt": prompt, "stream": self.use_sse}
+        payload.update(sampling)
+        # A dictionary_grammar mask runs as a Python logits processor, which the server cannot take
+        payload.pop("grammar", None)
+        if self.use_sse:
+            payload["stream_options"] = {"include_usage": True}
+        return payload
+
+    @staticmethod
+    def _results_of(texts, finish_reasons, tokens, stop_reasons=None):
+        """One GenerationResult from per-choice-index pieces (several when n > 1)."""
+        stop_reasons = stop_reasons or {}
+        samples = [GenerationResult("".join(texts.get(i, [])), finish_reasons.get(i) or "stop", tokens.get(i, 0),
+                                    stop_reason=stop_reasons.get(i))
+                   for i in sorted(set(texts) | set(finish_reasons)) or [0]]
+        return GenerationResult.of_samples(samples)
+
+    def _read_stream(self, response, on_delta=None, monitored=False):
+        """monitored: run the stop monitor on the stream (a fresh one per attempt: a retry starts over)."""
+        monitor = self.stop_monitor() if monitored and self.stop_monitor is not None else None
+        texts, finish_reasons, chunks, usage = {}, {}, {}, None
+        for raw_line in response:
+            line = raw_line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            event = json.loads(data)
+            if event.get("usage"):
+                usage = event["usage"]
+            for choice in event.get("choices", []):
+                index = choice.get("index", 0)
+                text = choice.get("text")
+                cut = monitor.feed(text) if monitor is not None and text else None
+                if cut is not None:
+                    text = text[:cut]
+                if text:
+                    texts.setdefault(index, []).append(text)
+                    if on_delta is not None and index == 0:
+                        on_delta(text)
+                    chunks[index] = chunks.get(index, 0) + 1
+                if cut is not None:
+                    # Hang up: vLLM aborts a streamed request when its client disconnects
+                    response.will_close = True
+                    finish_reasons[index] = monitor.finish_reason
+                    return self._results_of(texts, finish_reasons, chunks, {index: getattr(monitor, "reason", None)})
+                if choice.get("finish_reason"):
+                    finish_reasons[index] = choice["finish_reason"]
+        # Drain the end of the chunked body so the connection can be reused
+        response.read()
+        stop_reasons = {}
+        if monitor is None and self.stop_monitor is not None:
+            for index, pieces in texts.items():
+                text, reason, stop_reasons[index] = apply_monitor(self.stop_monitor(), "".join(pieces))
+                texts[index] = [text]
+                finish_reasons[index] = reason or finish_reasons.get(index)
+        # usage is the total over all choices, so it is exact only for n == 1
+        if usage and len(chunks) <= 1:
+            chunks = {index: usage["completion_tokens"] for index in chunks or [0]}
+        return self._results_of(texts, finish_reasons, chunks, stop_reasons)
+
+    def _read_full(self, response):
+        body = json.loads(response.read())
+        choices = body["choices"]
+        texts = {c.get("index", i): [c["text"]] for i, c in enumerate(choices)}
+        finish_reasons = {c.get("index", i): c.get("finish_reason") for i, c in enumerate(choices)}
+        stop_reasons = {}
+        if self.stop_monitor is not None:
+            for index, (text,) in texts.items():
+                text, reason, stop_reasons[index] = apply_monitor(self.stop_monitor(), text)
+                texts[index] = [text]
+                finish_reasons[index] = reason or finish_reasons[index]
+        if len(choices) == 1:
+            tokens = {index: body.get("usage", {}).get("completion_tokens", 0) for index in texts}
+        else:
+            tokens = {index: int(len(text[0]) / 3.0) for index, text in texts.items()}
+        return self._results_of(texts, finish_reasons, tokens, stop_reasons)
+
+    def complete(self, prompt, sampling, adapter=None, on_delta=None):
+        # One stream carries all n samples: only a single sample can be stopped early
+        monitored = sampling.get("n", 1) == 1
+        reader = functools.partial(self._read_stream, on_delta=on_delta, monitored=monitored) if self.use_sse \
+            else self._read_full
+        payload = self._payload(prompt, sampling, adapter.name if adapter is not None else None)
+        return self._request("POST", "/v1/completions", payload, on_response=reader)
+
+    def stream(self, prompt, sampling, on_delta, adapter=None):
+        """One completion with on_delta(text) per SSE chunk (all at once if stream=False)."""
+        result = self.complete(prompt, sampling, adapter, on_delta if self.use_sse else None)
+        if not self.use_sse:
+            on_delta(result.text)
+        return result
+
+    def generate(self, prompts, sampling, adapters=None):
+        """Sends the prompts concurrently (bounded by max_concurrency); results keep prompt order."""
+        if isinstance(sampling, dict):
+            sampling = [sampling] * len(prompts)
+        adapters = adapters or [None] * len(prompts)
+        return list(self.executor.map(self.complete, prompts, sampling, adapters))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.close()
+
+
+# --- 4. BENCHMARK AGAINST THE STAND-IN SERVER ---
+def main():
+    from fake_openai_server import start_fake_server
+    from engine_backends import SAMPLING_DEFAULTS
+
+    server, url = start_fake_server(ttft_s=0.2, per_token_s=0.002, fail_every=5)
+    prompts = [f"### User Input:\ncase {i}\n### Response (XML):\n" for i in range(16)]
+    sampling = dict(SAMPLING_DEFAULTS, max_tokens=200)
+
+    for concurrency in (1, 4, 8):
+        engine = OpenAIClientEngine(url, max_concurrency=concurrency, backoff_s=0.05)
+        t0 = time.perf_counter()
+        results = engine.generate(prompts, sampling)
+        wall = time.perf_counter() - t0
+        engine.close()
+        ok = all(r.text and r.finish_reason for r in results)
+        print(f"--> concurrency={concurrency}: {len(results)} completions in {wall:.2f}s, "
+              f"retries={engine.retries}, all_ok={ok}")
+
+    print(f"--> Server saw {server.stats['requests']} requests on {server.stats['connections']} TCP connections "
+          f"({server.stats['injected_failures']} injected failures).")
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
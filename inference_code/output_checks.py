@@ -0,0 +1,179 @@
+"""
+Structural checks for generated XML, without the dSPACE tooling.
+
+check_output() looks at one runner output (.xml, wrapped) or bare generated
+slots and reports:
+    errors   - not well-formed XML; top-level content is not exactly the
+               Initialization, StepsAndEvaluation and Cleanup slots in that
+               order; a parameter (MainLibrary.Int, ...) without its <value>
+               child or with bare text (the prompt's CRITICAL RULE 2); a
+               block's id disagrees with the dictionary entry of its
+               library-link
+    warnings - library-links that are not in the dictionary (the targets also
+               use a few libraries the dictionary does not cover, e.g. XIL API)
+
+strict=True turns unknown library-links into errors as well, for callers that
+must only accept blocks the dictionary knows (best_of_n.py).
+required_params=True also reports blocks that lack a parameter their
+dictionary entry requires (output_validation.py). An empty <value /> counts as
+filled: the targets leave string parameters such as SetVariable empty.
+
+How to use (from the working directory):
+    python output_checks.py outputs/            # or outputs.zip
+"""
+
+import os
+import sys
+import json
+import zipfile
+import xml.etree.ElementTree as ET
+
+from conversion_steps import unwrap_xml
+
+# --- 1. CONFIGURATION ---
+DICTIONARY_FILE = "cleaned_dictionary_master.json"
+SLOT_TAG = "FrameworkBuilder.ActualOperationSlot"
+SLOT_NAMES = ("Initialization", "StepsAndEvaluation", "Cleanup")
+LINK_TAG = "Standard.LibraryLinkBlock"
+PARAMETER_PREFIX = "MainLibrary."
+TEXT_TAGS = {"value", "description", "library-description"}   # the only elements that hold text
+# Library-links the targets use that the dictionary lacks (51 targets read ODO_VALUE,
+# one sets SET_CHECK_DISPLAY_SETUP_DARK)
+LINK_GAPS = {"TVSM_Library.ODO_VALUE", "TVSM_Library.SET_CHECK_DISPLAY_SETUP_DARK"}
+# Required params the dictionary gets wrong: the targets' READ_ODO blocks carry IP_Val,
+# and "TVSM_Dictionary" is not a parameter at all
+PARAM_GAPS = {
+    "TVSM_Library.READ_ODO": {"ODO_Value"},
+    "TVSM_Library.SET_CHECK_BATT_ON": {"TVSM_Dictionary"},
+}
+
+
+# --- 2. CHECKS ---
+def nesting_problem(element, parent_tag):
+    """
+    The parameter-nesting rules for one complete element (children parsed),
+    or None. Also used on the token stream by xml_stream_check.py.
+    """
+    if element.tag not in TEXT_TAGS:
+        text = (element.text or "").strip() or next(((c.tail or "").strip() for c in element
+                                                     if (c.tail or "").strip()), "")
+        if text:
+            return f"bare text '{text[:40]}' inside <{element.tag}>"
+    if parent_tag == "parameters" and element.tag.startswith(PARAMETER_PREFIX) and element.find("value") is None:
+        return f"<{element.tag} name=\"{element.get('name')}\"> has no <value>"
+    return None
+
+
+def load_dictionary(path=DICTIONARY_FILE):
+    """library_link -> json_snippet, from cleaned_dictionary_master.json or context.txt."""
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        entries = [entries]
+    dictionary = {}
+    for entry in entries:
+        snippet = entry.get("json_snippet", entry)
+        if snippet.get("library_link"):
+            dictionary[snippet["library_link"]] = snippet
+    return dictionary
+
+
+def missing_params(block, entry):
+    """The entry's required params that the block has no parameter element for."""
+    parameters = block.find("parameters")
+    present = {p.get("name") for p in parameters} if parameters is not None else set()
+    skip = PARAM_GAPS.get(entry.get("library_link"), ())
+    return [name for name in entry.get("required_params") or () if name not in present and name not in skip]
+
+
+def check_output(xml_text, dictionary=None, strict=False, required_params=False):
+    """Returns {"ok": bool, "errors": [...], "warnings": [...], "blocks": n}."""
+    errors, warnings = [], []
+    if xml_text.lstrip().startswith("<?xml") or "<Standard.Sequence" in xml_text:
+        try:
+            ET.fromstring(xml_text.encode("utf-8"))
+        except ET.ParseError as e:
+            return {"ok": False, "errors": [f"not well-formed: {e}"], "warnings": [], "blocks": 0}
+        xml_text = unwrap_xml(xml_text)
+
+    try:
+        root = ET.fromstring(f"<root>{xml_text}</root>".encode("utf-8"))
+    except ET.ParseError as e:
+        return {"ok": False, "errors": [f"not well-formed: {e}"], "warnings": [], "blocks": 0}
+
+    names = [child.get("name") if child.tag == SLOT_TAG else child.tag for child in root]
+    if tuple(names) != SLOT_NAMES:
+        errors.append(f"top-level slots are {names}, expected {list(SLOT_NAMES)}")
+    for parent in root.iter():
+        for element in parent:
+            problem = nesting_problem(element, parent.tag)
+            if problem:
+                errors.append(problem)
+
+    blocks = 0
+    for block in root.iter(LINK_TAG):
+        blocks += 1
+        link = block.get("library-link")
+        if not link:
+            errors.append(f"{LINK_TAG} '{block.get('name')}' has no library-link")
+            continue
+        if dictionary is None:
+            continue
+        entry = dictionary.get(link)
+        if entry is None:
+            (errors if strict else warnings).append(f"library-link not in dictionary: {link}")
+            continue
+        if block.get("id") and entry.get("id") and block.get("id") != entry["id"]:
+            errors.append(f"{link}: id {block.get('id')} != dictionary id {entry['id']}")
+        if required_params:
+            for name in missing_params(block, entry):
+                errors.append(f"{link}: required parameter '{name}' missing")
+    return {"ok": not errors, "errors": errors, "warnings": warnings, "blocks": blocks}
+
+
+def iter_outputs(path):
+    """(name, xml_text) for every .xml in a folder or .zip."""
+    if zipfile.is_zipfile(path):
+        with zipfile.ZipFile(path) as zf:
+            for name in sorted(zf.namelist()):
+                if name.lower().endswith(".xml"):
+                    yield os.path.basename(name), zf.read(name).decode("utf-8", errors="replace")
+    elif os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.lower().endswith(".xml"):
+                with open(os.path.join(path, name), "r", encoding="utf-8", errors="replace") as f:
+                    yield name, f.read()
+    else:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            yield os.path.basename(path), f.read()
+
+
+# --- 3. REPORT ---
+def validate_outputs(path, dictionary_path=DICTIONARY_FILE, log=print):
+    dictionary = load_dictionary(dictionary_path) if os.path.exists(dictionary_path) else None
+    if dictionary is None:
+        log(f"    [WARNING] {dictionary_path} not found; skipping library-link checks.")
+    results = {}
+    for name, xml_text in iter_outputs(path):
+        result = check_output(xml_text, dictionary)
+        results[name] = result
+        status = "OK" if result["ok"] else "FAIL"
+        log(f"    [{status}] {name}: {result['blocks']} blocks, {len(result['errors'])} errors, "
+            f"{len(result['warnings'])} warnings")
+        for message in result["errors"]:
+            log(f"        error: {message}")
+        for message in result["warnings"][:5]:
+            log(f"        warning: {message}")
+    passed = sum(1 for r in results.values() if r["ok"])
+    log(f"--> {passed}/{len(results)} outputs passed.")
+    return results
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "outputs"
+    results = validate_outputs(path)
+    return 0 if all(r["ok"] for r in results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,252 @@
+"""
+Validation stage for a finished run: every output is checked in a process
+pool, and the cases that fail go onto a regeneration queue with their reasons,
+so the next run generates only those instead of the whole backlog.
+
+validate_case() checks one output with what dSPACE needs to accept it:
+    xml      - well-formed (the wrapper as written by the runner, and the slots)
+    slots    - exactly Initialization, StepsAndEvaluation, Cleanup, in order
+    nesting  - every MainLibrary.* parameter has its <value> and no bare text
+    block    - every LibraryLinkBlock is a dictionary entry: the id matches the
+               link, and the link is known (block_repair.DictionaryIndex;
+               links into libraries the dictionary does not cover and
+               output_checks.LINK_GAPS are let through)
+    params   - the parameters the entry requires are there
+               (output_checks.missing_params)
+Each file is parsed once (output_checks.check_output with required_params).
+The workers load the dictionary once, in their initializer, and take the files
+in chunks of CHUNK_SIZE; the processes are spawned, not forked, so the stage is
+safe to run from a process that holds a vLLM engine.
+
+The queue (REGENERATE_QUEUE, one JSON line per failing case: case, input_file,
+reasons) is what run_batch_tests_v14.py reads with REGENERATE_FROM. A re-run
+only validates what it generated, so the queue it writes holds the cases that
+failed again.
+
+Running this file with --benchmark copies the targets (and broken variants of
+them) into a folder of thousands of outputs and measures files/s and MB/s per
+worker count, checking that the pool agrees with the serial check.
+
+How to use:
+    VALIDATE_OUTPUTS = True in run_batch_tests_v14.py   # after each run
+    REGENERATE_FROM = "regenerate.jsonl"                 # re-run only the failures
+    python output_validation.py outputs/ [--workers 8] [--queue regenerate.jsonl]
+    python output_validation.py --benchmark [--files 5000]
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from output_checks import load_dictionary, check_output, iter_outputs, DICTIONARY_FILE, SLOT_TAG
+from block_repair import DictionaryIndex, START_TAG, LINK_ATTR, ID_ATTR, NAME_ATTR
+
+# --- 1. CONFIGURATION ---
+REGENERATE_QUEUE = "regenerate.jsonl"
+VALIDATION_WORKERS = os.cpu_count() or 1
+CHUNK_SIZE = 32            # files per task sent to a worker
+# Failure kinds, by the first pattern that matches the check_output error
+KINDS = (
+    ("xml", re.compile(r"^not well-formed")),
+    ("slots", re.compile(r"^top-level slots")),
+    ("params", re.compile(r"required parameter")),
+    ("block", re.compile(r"library-link|dictionary id")),
+    ("nesting", re.compile(r"")),
+)
+
+_state = {}   # per worker process: dictionary and index, set by _init_worker
+
+
+# --- 2. CHECKS ---
+def _init_worker(dictionary_path):
+    if os.path.exists(dictionary_path):
+        _state["dictionary"] = load_dictionary(dictionary_path)
+        _state["index"] = DictionaryIndex(list(_state["dictionary"].values()))
+    else:
+        _state["dictionary"] = _state["index"] = None
+
+
+def validate_case(name, text, dictionary, index):
+    """(name, [(kind, reason), ...], blocks); an empty list means the output is accepted."""
+    result = check_output(text, dictionary, required_params=True)
+    problems = [(next(kind for kind, pattern in KINDS if pattern.search(e)), e) for e in result["errors"]]
+    if index is not None and result["blocks"]:
+        for match in START_TAG.finditer(text):
+            tag = match.group()
+            link, gid, block_name = (m.group(1) if m else None
+                                     for m in (p.search(tag) for p in (LINK_ATTR, ID_ATTR, NAME_ATTR)))
+            _, how = index.resolve(link, gid, block_name)
+            # "id corrected" is check_output's id mismatch, already reported
+            if how == "unknown":
+                problems.append(("block", f"library-link not in dictionary: {link}"))
+            elif how in ("link from id", "link by name"):
+                problems.append(("block", f"{link}: {how} (tc2xml repair fixes this)"))
+    return name, problems, result["blocks"]
+
+
+def _validate_item(item):
+    return validate_case(*item, _state["dictionary"], _state["index"])
+
+
+def validate_items(items, dictionary_path=DICTIONARY_FILE, workers=VALIDATION_WORKERS):
+    """
+    Validates (name, text) pairs, in a process pool when workers > 1.
+    Returns {name: [(kind, reason), ...]} for every item, in input order.
+    """
+    if workers <= 1:
+        _init_worker(dictionary_path)
+        return {name: problems for name, problems, _ in map(_validate_item, items)}
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=_init_worker, initargs=(dictionary_path,)) as pool:
+        return {name: problems for name, problems, _ in pool.map(_validate_item, items, chunksize=CHUNK_SIZE)}
+
+
+# --- 3. REGENERATION QUEUE ---
+def input_file_for(output_name, input_dir="inputs"):
+    """outputs/Test_01.xml -> inputs/Test_01.txt (conversion_steps.output_path_for, backwards)."""
+    return os.path.join(input_dir, os.path.splitext(os.path.basename(output_name))[0] + ".txt")
+
+
+def write_queue(results, queue_path=REGENERATE_QUEUE, input_dir="inputs"):
+    """Writes the failing cases of results to queue_path; returns how many there are."""
+    failed = [(name, problems) for name, problems in results.items() if problems]
+    tmp_path = queue_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for name, problems in failed:
+            f.write(json.dumps({"case": name, "input_file": input_file_for(name, input_dir),
+                                "reasons": [f"{kind}: {reason}" for kind, reason in problems]}) + "\n")
+    os.replace(tmp_path, queue_path)
+    return len(failed)
+
+
+def load_queue(queue_path=REGENERATE_QUEUE):
+    """The input files on the queue, in queue order."""
+    with open(queue_path, "r", encoding="utf-8") as f:
+        return [json.loads(line)["input_file"] for line in f if line.strip()]
+
+
+def report(results, log=print, examples=5):
+    """Summary by failure kind, with the first reasons of a few failing cases."""
+    failed = {name: problems for name, problems in results.items() if problems}
+    kinds = Counter(kind for problems in failed.values() for kind in {k for k, _ in problems})
+    log(f"--> {len(results) - len(failed)}/{len(results)} outputs passed; {len(failed)} to regenerate"
+        + (f" ({', '.join(f'{kind} {n}' for kind, n in kinds.most_common())})" if failed else ""))
+    for name, problems in list(failed.items())[:examples]:
+        log(f"    [FAIL] {name}: " + "; ".join(reason for _, reason in problems[:3])
+            + (f" (+{len(problems) - 3} more)" if len(problems) > 3 else ""))
+
+
+def validate_and_queue(items, queue_path=REGENERATE_QUEUE, dictionary_path=DICTIONARY_FILE,
+                       workers=VALIDATION_WORKERS, input_dir="inputs", log=print):
+    """Validates (name, text) pairs, reports and writes the regeneration queue; returns the results."""
+    if not os.path.exists(dictionary_path):
+        log(f"    [WARNING] {dictionary_path} not found; skipping the block and parameter checks.")
+    t0 = time.perf_counter()
+    results = validate_items(items, dictionary_path, workers)
+    elapsed = time.perf_counter() - t0
+    report(results, log)
+    if queue_path:
+        write_queue(results, queue_path, input_dir)
+        log(f"--> Regeneration queue: {queue_path}")
+    log(f"    [STATS] {len(results)} files in {elapsed:.2f}s with {workers} worker(s)")
+    return results
+
+
+def validate_folder(path, queue_path=REGENERATE_QUEUE, dictionary_path=DICTIONARY_FILE,
+                    workers=VALIDATION_WORKERS, input_dir="inputs", log=print):
+    """validate_and_queue() for every .xml in a folder or .zip."""
+    return validate_and_queue(list(iter_outputs(path)), queue_path, dictionary_path, workers, input_dir, log)
+
+
+# --- 4. BENCHMARK ---
+def _drop_param(text, rng):
+    """Removes one MainLibrary.* parameter element, or returns None if the text has none."""
+    starts = list(re.finditer(r"<(MainLibrary\.\w+) name=", text))
+    if not starts:
+        return None
+    match = rng.choice(starts)
+    end = text.find(f"</{match.group(1)}>", match.start())
+    return text[:match.start()] + text[end + len(match.group(1)) + 3:] if end >= 0 else None
+
+
+def benchmark(args):
+    from token_budget import load_targets, extract_slots, TARGETS_PATH
+    from conversion_steps import wrap_xml
+    from xml_stream_check import corrupt, CORRUPTIONS
+
+    texts = [s for s in (extract_slots(t) for _, t in sorted(load_targets(TARGETS_PATH).items()))
+             if s.count(SLOT_TAG) >= 6]
+    if not texts:
+        print(f"CRITICAL: no targets with slots in {TARGETS_PATH}.")
+        return 1
+    clean = validate_items([(str(i), t) for i, t in enumerate(texts)], args.dictionary, workers=1)
+    kinds = Counter(kind for problems in clean.values() for kind in {k for k, _ in problems})
+    print(f"--> {len(texts)} targets: {sum(not p for p in clean.values())} pass "
+          f"({', '.join(f'{kind} {n}' for kind, n in kinds.most_common()) or 'no failures'})")
+
+    # A run's worth of outputs: the targets over and over, BROKEN_SHARE of them broken
+    rng = random.Random(args.seed)
+    breaks = list(CORRUPTIONS) + ["dropped parameter"]
+    folder = tempfile.mkdtemp(prefix="validation_")
+    broken, size = Counter(), 0
+    for i in range(args.files):
+        text = texts[i % len(texts)]
+        if rng.random() < args.broken_share:
+            kind = rng.choice(breaks)
+            changed = _drop_param(text, rng) if kind == "dropped parameter" else corrupt(text, kind, rng)
+            if changed is not None:
+                text = changed
+                broken[kind] += 1
+        with open(os.path.join(folder, f"Test_{i:05d}.xml"), "w", encoding="utf-8") as f:
+            size += f.write(wrap_xml(text))
+    print(f"--> {args.files} outputs ({size / 1e6:.0f} MB) in {folder}, broken: "
+          + ", ".join(f"{kind} {n}" for kind, n in broken.most_common()))
+
+    counts = sorted({1, *(2 ** k for k in range(1, 8) if 2 ** k <= VALIDATION_WORKERS), VALIDATION_WORKERS})
+    print(f"\n    {'workers':>7} {'seconds':>8} {'files/s':>8} {'MB/s':>6} {'speedup':>8} {'queued':>7}")
+    baseline = serial = None
+    for workers in counts:
+        t0 = time.perf_counter()
+        results = validate_items(list(iter_outputs(folder)), args.dictionary, workers)
+        elapsed = time.perf_counter() - t0
+        baseline = baseline or elapsed
+        serial = serial or results
+        queued = write_queue(results, os.path.join(folder, REGENERATE_QUEUE))
+        print(f"    {workers:>7} {elapsed:>8.2f} {len(results) / elapsed:>8.0f} {size / 1e6 / elapsed:>6.1f} "
+              f"{baseline / elapsed:>7.1f}x {queued:>7}" + ("" if results == serial else "   [MISMATCH]"))
+    if VALIDATION_WORKERS == 1:
+        print("    (one CPU here: the pool cannot be faster than the serial check on this machine)")
+    report(serial, log=print, examples=3)
+    print(f"--> The next run regenerates {queued}/{args.files} cases ({queued / args.files:.0%} of the backlog) "
+          f"instead of all of them.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate generated XML in parallel and queue the failures.")
+    parser.add_argument("path", nargs="?", default="outputs", help="Folder or .zip of outputs.")
+    parser.add_argument("--queue", default=REGENERATE_QUEUE, help="Regeneration queue to write.")
+    parser.add_argument("--inputs", default="inputs", help="Where the queued cases' .txt files are.")
+    parser.add_argument("--dictionary", default=DICTIONARY_FILE)
+    parser.add_argument("--workers", type=int, default=VALIDATION_WORKERS)
+    parser.add_argument("--benchmark", action="store_true", help="Measure throughput on copies of the targets.")
+    parser.add_argument("--files", type=int, default=5000, help="Outputs in the benchmark folder.")
+    parser.add_argument("--broken-share", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        return benchmark(args)
+    results = validate_folder(args.path, args.queue, args.dictionary, args.workers, args.inputs)
+    return 0 if not any(results.values()) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,303 @@
+"""
+Runaway-loop detection while the model decodes: a sequence that has started
+to write the same thing over and over is aborted, instead of decoding the loop
+until max_tokens (minutes of H200 time per case on the 72B model).
+
+repetition_penalty=1.15 does not prevent it: the model still falls into
+writing the same LibraryLinkBlock, or the same few blocks, again and again.
+LoopDetector is a stop monitor (engine_backends) with two checks:
+    - token level: a rolling hash over the last NGRAM tokens (words and
+      punctuation, whitespace ignored) is looked up in a table of where each
+      n-gram was last seen. A repeat proposes a period; the following n-grams
+      are compared with the ones one period back, and a run that covers
+      LOOP_MIN_TOKENS tokens and LOOP_MIN_REPEATS copies is a loop. Catches
+      verbatim loops of any length up to MAX_PERIOD tokens.
+    - block level: every </Standard.LibraryLinkBlock> closes a block, which is
+      reduced to its shape (whitespace, ids, dates and the numbers in
+      attribute values dropped; a <value> keeps its digits) and hashed. The
+      last BLOCK_REPEATS x k shapes being one group of k blocks repeated (k <= BLOCK_MAX_PERIOD) is a loop. Catches the loops that count
+      ("Wait_1", "Wait_2", ... with a fresh GUID each time), which are never
+      verbatim.
+A loop ends the request with finish_reason "abort" and a stop_reason starting
+with "loop"; generate_with_budget() and stream_case() retry it with
+LOOP_RETRY_SAMPLING (a higher temperature and repetition penalty).
+
+The thresholds are set from the targets and the recorded outputs: none of them
+repeats a block shape, or group of shapes, three times in a row, nor a
+200-token span. (Counting digits in values as noise would stop input.xml, which
+alternates two steps with values 0 and 1 as its test case says.)
+
+Running this file checks for false aborts on the targets and the recorded
+outputs, replays the targets with loops spliced in (detection latency, decode
+saved against running to max_tokens, in GPU seconds on the H200 profile),
+measures the CPU cost per token and runs one abort-and-retry end to end.
+
+How to use:
+    REPETITION_GUARD = True in run_batch_tests_v14.py
+    python repetition_guard.py [--samples 3]
+"""
+
+import re
+import time
+import random
+import argparse
+import zipfile
+
+# --- 1. CONFIGURATION ---
+NGRAM = 8                 # tokens per rolling-hash window
+MAX_PERIOD = 4096         # longest verbatim loop (tokens) the token check looks for
+LOOP_MIN_TOKENS = 200     # repeated tokens before a verbatim run counts as a loop ...
+LOOP_MIN_REPEATS = 3      # ... and copies of the repeated span
+BLOCK_END = "</Standard.LibraryLinkBlock>"
+BLOCK_REPEATS = 3         # copies of a group of block shapes that make a loop ...
+BLOCK_MAX_PERIOD = 4      # ... for groups of up to this many blocks
+
+TOKEN = re.compile(r"\w+|[^\w\s]")
+SHAPE_NOISE = re.compile(r'\s+|\b(?:id|creation-date|modification-date)="[^"]*"')
+ATTRIBUTE = re.compile(r'="[^"]*"')
+DIGITS = re.compile(r"\d+")
+HASH_BASE = 1_000_003
+HASH_MOD = (1 << 61) - 1
+
+
+# --- 2. DETECTOR ---
+class LoopDetector:
+    """
+    A stop monitor: feed(delta) returns None, or once the output is looping the
+    number of characters of delta up to the token or block that showed it.
+    """
+
+    finish_reason = "abort"
+
+    def __init__(self):
+        self.reason = None
+        self.done = False
+        self.tokens = 0
+        self._pending = ""          # a word that may go on in the next delta
+        self._window = []           # token hashes of the current n-gram
+        self._hash = 0
+        self._drop = pow(HASH_BASE, NGRAM - 1, HASH_MOD)
+        self._grams = []            # n-gram hash ending at each token (from token NGRAM - 1 on)
+        self._last_seen = {}        # n-gram hash -> index in _grams of its latest occurrence
+        self._period = 0
+        self._run = 0               # consecutive n-grams equal to the one a period back
+        self._block = []            # text of the block being written
+        self._tail = ""             # end of the previous delta, for a BLOCK_END split between deltas
+        self._shapes = []           # hashes of the finished blocks' shapes
+
+    def feed(self, delta):
+        if self.done:
+            return None
+        text = self._pending + delta
+        offset = len(self._pending)
+        tokens = list(TOKEN.finditer(text))
+        self._pending = ""
+        if tokens and tokens[-1].end() == len(text) and text[-1].isalnum():
+            self._pending = tokens.pop().group()
+        for match in tokens:
+            if self._push(match.group()):
+                return self._abort(max(0, match.end() - offset))
+        cut = self._blocks(delta)
+        if cut is not None:
+            return self._abort(cut)
+        return None
+
+    # Token level
+    def _push(self, token):
+        self.tokens += 1
+        value = hash(token) & HASH_MOD
+        self._window.append(value)
+        if len(self._window) > NGRAM:
+            self._hash = (self._hash - self._window.pop(0) * self._drop) % HASH_MOD
+        self._hash = (self._hash * HASH_BASE + value) % HASH_MOD
+        if len(self._window) < NGRAM:
+            return False
+        index = len(self._grams)
+        self._grams.append(self._hash)
+        if self._period and self._grams[index - self._period] == self._hash:
+            self._run += 1
+            copies = 1 + (self._run + NGRAM - 1) / self._period
+            if self._run + NGRAM - 1 >= LOOP_MIN_TOKENS and copies >= LOOP_MIN_REPEATS:
+                self.reason = (f"loop: the last {self._period} tokens repeated {copies:.1f} times "
+                               f"(token {self.tokens})")
+                return True
+        else:
+            previous = self._last_seen.get(self._hash)
+            self._period = index - previous if previous is not None and index - previous <= MAX_PERIOD else 0
+            self._run = 1 if self._period else 0
+        self._last_seen[self._hash] = index
+        return False
+
+    # Block level
+    def _blocks(self, delta):
+        """None, or where in delta the block that completes a loop ends."""
+        text = self._tail + delta
+        offset = len(self._tail)
+        self._block.append(delta)
+        start, cut = 0, None
+        # Several short blocks may end in one delta (a whole text fed at once)
+        while cut is None:
+            end = text.find(BLOCK_END, start)
+            if end < 0:
+                break
+            start = end + len(BLOCK_END)
+            block = "".join(self._block)
+            rest = text[start:]
+            self._block = [rest] if rest else []
+            self._shapes.append(hash(shape(block[:len(block) - len(rest)])))
+            if self._looping():
+                cut = start - offset
+        self._tail = text[max(start, len(text) - len(BLOCK_END) + 1):]
+        return cut
+
+    def _looping(self):
+        shapes = self._shapes
+        for k in range(1, BLOCK_MAX_PERIOD + 1):
+            span = k * BLOCK_REPEATS
+            if len(shapes) >= span and all(shapes[-i] == shapes[-i - k] for i in range(1, span - k + 1)):
+                self.reason = f"loop: a group of {k} block(s) written {BLOCK_REPEATS} times in a row"
+                return True
+        return False
+
+    def _abort(self, cut):
+        self.done = True
+        return cut
+
+
+def shape(block):
+    """A block without whitespace, ids, dates and the numbers in its attribute values."""
+    block = SHAPE_NOISE.sub("", block)
+    return ATTRIBUTE.sub(lambda m: DIGITS.sub("", m.group()), block)
+
+
+def first_loop(text, chars_per_delta=3):
+    """(characters decoded when the detector aborts, reason), or (None, None) if it never does."""
+    detector = LoopDetector()
+    for start in range(0, len(text), chars_per_delta):
+        if detector.feed(text[start:start + chars_per_delta]) is not None:
+            return min(start + chars_per_delta, len(text)), detector.reason
+    return None, None
+
+
+# --- 3. REPLAY HARNESS ---
+GUID = re.compile(r"\{[0-9A-F-]{36}\}")
+NAME = re.compile(r'( name="[^"]*?)(?:_\d+)?"')
+BLOCK = re.compile(r"[ \t]*<Standard\.LibraryLinkBlock\b.*?" + re.escape(BLOCK_END) + r"\n?", re.S)
+
+
+def _count_up(block, i, rng):
+    """The block as the i-th copy of a counting loop: its name numbered i, a fresh GUID."""
+    block = NAME.sub(lambda m: f'{m.group(1)}_{i}"', block, count=1)
+    return GUID.sub(lambda m: "{%08X-0000-0000-0000-%012X}" % (rng.getrandbits(32), rng.getrandbits(48)), block)
+
+
+def spliced_loop(text, kind, max_chars, rng):
+    """
+    The text up to a random block, then that block (or group) looping until
+    max_chars: (text, characters before the loop starts), or None if the text
+    has too few blocks.
+    """
+    blocks = list(BLOCK.finditer(text))
+    k = 3 if kind == "block group" else 1
+    if len(blocks) < k + 1:
+        return None
+    i = rng.randrange(k - 1, len(blocks) - 1)
+    unit_start, end = blocks[i - k + 1].start(), blocks[i].end()
+    unit = text[unit_start:end]
+    out, copies = [text[:end]], 0
+    onset = end
+    while sum(map(len, out)) < max_chars:
+        copies += 1
+        out.append(_count_up(unit, copies, rng) if kind == "counting block" else unit)
+    return "".join(out)[:max_chars], onset
+
+
+def main():
+    from token_budget import load_targets, extract_slots, count_tokens, CHARS_PER_TOKEN, TARGETS_PATH
+    from engine_backends import FIXED_MAX_TOKENS
+    from capacity_planner import load_model_config, plan_profile, throughput, measure_lengths, summarize_lengths, GPUS
+
+    parser = argparse.ArgumentParser(description="Replay targets with loops spliced in through the loop detector.")
+    parser.add_argument("--targets", default=TARGETS_PATH)
+    parser.add_argument("--recordings", default="outputs.zip")
+    parser.add_argument("--samples", type=int, default=3, help="Looping copies per target and kind.")
+    parser.add_argument("--max-tokens", type=int, default=FIXED_MAX_TOKENS, help="Where an undetected loop ends.")
+    parser.add_argument("--gpu", default="H200-141G")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    texts = [extract_slots(t) for _, t in sorted(load_targets(args.targets).items())]
+    with zipfile.ZipFile(args.recordings) as zf:
+        recordings = [zf.read(n).decode("utf-8") for n in zf.namelist() if not n.endswith("/")]
+
+    # 1. Clean outputs: nothing may be aborted; CPU cost per token
+    false_aborts, tokens, t0 = 0, 0, time.perf_counter()
+    for text in texts + recordings:
+        detector = LoopDetector()
+        for start in range(0, len(text), 3):
+            if detector.feed(text[start:start + 3]) is not None:
+                false_aborts += 1
+                print(f"    [FALSE ABORT] {detector.reason}")
+                break
+        tokens += detector.tokens
+    per_token_us = (time.perf_counter() - t0) / tokens * 1e6
+
+    cfg = load_model_config()
+    summary = summarize_lengths(measure_lengths())
+    profile = plan_profile(args.gpu, cfg, summary)
+    step_s = throughput(cfg, GPUS[args.gpu], profile["memory"], summary, 1,
+                        profile["engine_args"]["enforce_eager"])["decode_step_ms"] / 1000
+    print(f"--> {len(texts)} targets + {len(recordings)} recorded outputs: {false_aborts} aborted; "
+          f"{per_token_us:.1f} us per token = {per_token_us / (step_s * 1e6):.3%} of a "
+          f"{step_s * 1000:.1f} ms decode step ({args.gpu} profile)")
+
+    # 2. Loops spliced into the targets
+    rng = random.Random(args.seed)
+    max_chars = int(args.max_tokens * CHARS_PER_TOKEN)
+    print(f"\n    {'loop':<16} {'samples':>7} {'caught':>7} {'tokens into loop':>17} "
+          f"{'saved tokens':>13} {'saved GPU s':>12}")
+    total_saved = total_tokens = 0
+    for kind in ("block", "block group", "counting block"):
+        samples = caught = latency = saved = full = 0
+        for text in texts:
+            for _ in range(args.samples):
+                spliced = spliced_loop(text, kind, max_chars, rng)
+                if spliced is None:
+                    continue
+                looped, onset = spliced
+                samples += 1
+                cut, _ = first_loop(looped)
+                tokens = count_tokens(looped)
+                full += tokens
+                if cut is None or cut < onset:
+                    continue
+                caught += 1
+                latency += count_tokens(looped[onset:cut])
+                saved += tokens - count_tokens(looped[:cut])
+        total_saved += saved
+        total_tokens += full
+        print(f"    {kind:<16} {samples:>7} {caught / max(samples, 1):>7.0%} {latency / max(caught, 1):>17.0f} "
+              f"{saved / max(samples, 1):>13.0f} {saved * step_s / max(samples, 1):>12.1f}")
+    print(f"--> Aborting saves {total_saved / max(total_tokens, 1):.0%} of the decode of looping outputs "
+          f"(max_tokens={args.max_tokens}); the retry starts that much sooner.")
+
+    # 3. End to end: abort the loop, retry with LOOP_RETRY_SAMPLING, keep the clean second attempt
+    from engine_backends import StubEngine, generate_with_budget
+    from async_pipeline import CaseJob
+    from output_checks import check_output
+
+    class LoopsFirstAttempt(StubEngine):
+        def sample_for(self, prompt, full_text, index):
+            self.calls = getattr(self, "calls", 0) + 1
+            return spliced_loop(full_text, "block", max_chars, random.Random(1))[0] if self.calls == 1 else full_text
+
+    engine = LoopsFirstAttempt(text=next(t for t in texts if check_output(t)["ok"] and len(BLOCK.findall(t)) > 3),
+                               prefill_s=0.0)
+    engine.stop_monitor = LoopDetector
+    job = CaseJob(input_file="demo.txt", user_content="demo", prompt="demo prompt")
+    generate_with_budget(engine, [job])
+    print(f"--> Retry check: {engine.calls} attempts, final output valid: {check_output(job.text)['ok']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,218 +1,383 @@
 import os
 import sys
-import re
-import json
-import glob
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-# --- 0. CRITICAL OVERRIDES ---
-os.environ["VLLM_ALLOW_LONG_MAX_MODEL_LEN"] = "1"
-
-from vllm import LLM, SamplingParams
-from vllm.lora.request import LoRARequest
+from token_budget import load_budget_model
+from conversion_steps import filter_context, build_library_index, read_file, build_prompt, wrap_xml, output_path_for, list_input_files
+from async_pipeline import CaseJob, run_pipeline, print_utilization
+from engine_backends import make_engine, generate_with_budget, chain_monitors, ABORT_RETRY_SAMPLING
+from adapter_routing import AdapterRegistry, plan_adapter_batches
+from output_checks import load_dictionary
+from dictionary_grammar import grammar_for, require_v0_engine
+from block_repair import DictionaryIndex, repair_jobs, keep_better
+from output_validation import validate_and_queue, load_queue
+from best_of_n import generate_best_of_n, print_report
+from streaming_output import stream_case, print_latency_report
+from section_split import build_section_jobs, generate_sections
+from windowed_generation import needs_windows, build_window_jobs, generate_windowed
 
 # --- 1. CONFIGURATION ---
 base_model_path = "/workspace/manual_models/base"
 adapter_path = "/workspace/manual_models/adapter"
 adapter_name = "dspace_adapter"
 
+# Several adapters in one engine: list them in adapters.json (see adapter_routing.py).
+# Without that file every case uses adapter_name above.
+ADAPTERS_FILE = "adapters.json"
+MAX_RESIDENT_ADAPTERS = 2
+
 INPUT_DIR = "inputs"
 OUTPUT_DIR = "outputs"
+CONTEXT_FILE = "context.txt"
 
-if not os.path.exists(OUTPUT_DIR):
-    os.makedirs(OUTPUT_DIR)
-
-# Initialize vLLM
-try:
-    print("--> Initializing vLLM Engine...")
-    llm = LLM(
-        model=base_model_path,
-        enable_lora=True,
-        max_lora_rank=64,
-        gpu_memory_utilization=0.92,
-        max_model_len=32768, 
-        kv_cache_dtype="auto", 
-        enforce_eager=True,           
-        enable_chunked_prefill=False, 
-        max_num_seqs=1
-    )
-except Exception as e:
-    print(f"\nINITIALIZATION ERROR: {e}")
-    sys.exit(1)
+# Engine settings from capacity_planner.py ("A100-80G", "H200-141G"; run it once to
+# write engine_profiles.json). "" = engine_backends.ENGINE_ARGS as tuned for v14.
+ENGINE_PROFILE = ""
+
+# Draft tokens per step from vLLM's n-gram prompt lookup (speculative_drafts.py
+# measures what to expect on our targets). 0 = no speculative decoding.
+SPECULATIVE_TOKENS = 0
+
+# End each request once the third ActualOperationSlot closes (structural_stop.py).
+# The model never writes the stop tag in SAMPLING_DEFAULTS and decodes commentary
+# after the Cleanup slot until max_tokens. Saves decode time with the "openai"
+# backend and with the in-process engine on vLLM's V0 engine (vllm<0.10, selected
+# automatically); on newer vLLM the in-process engine can only trim the text afterwards.
+STRUCTURAL_STOP = True
+
+# Abort a request as soon as its XML can no longer be valid (xml_stream_check.py):
+# a mismatched tag, a bare value inside a MainLibrary.* parameter, ... The case is
+# retried ABORT_RETRIES times with ABORT_RETRY_SAMPLING (engine_backends).
+# "auto" = only on engines that can end a request mid-decode ("openai" with streaming,
+# "replay", "vllm" on its V0 engine). On newer vLLM the in-process engine only sees
+# finished outputs: there True means "retry invalid outputs", at the cost of a second
+# full decode for each of them.
+XML_STREAM_CHECK = "auto"
+
+# Abort a request that is writing the same block(s) over and over (repetition_guard.py)
+# and retry it with LOOP_RETRY_SAMPLING, instead of decoding the loop to max_tokens.
+REPETITION_GUARD = True
+
+# Constrain decoding to the dictionary (dictionary_grammar.py, in-process vllm backend
+# only): "dictionary" = any item of DICTIONARY_FILE plus the blocks block_repair lets
+# through (LINK_GAPS, libraries the dictionary does not cover), "" = unconstrained.
+# Rules out invented library-links and GUIDs. Needs vLLM's V0 engine (vllm<0.10).
+CONSTRAINED_DECODING = ""
+
+# Fix wrong or missing block ids and library-links from the dictionary after generation
+# (block_repair.py); only cases with blocks the dictionary does not know are generated
+# again, once, with ABORT_RETRY_SAMPLING, and the better of the two attempts is kept
+# (check_output errors, then unknown blocks). Not applied to STREAM_OUTPUT cases.
+REPAIR_BLOCKS = True
+
+# After the run, check every output it wrote in a process pool (output_validation.py:
+# well-formedness, slots, blocks and required params against DICTIONARY_FILE) and write
+# the failing cases with their reasons to REGENERATE_QUEUE. REGENERATE_FROM = that file
+# converts only the queued cases; "" = all of INPUT_DIR.
+VALIDATE_OUTPUTS = True
+REGENERATE_QUEUE = "regenerate.jsonl"
+REGENERATE_FROM = ""
+
+# Before loading the weights (vllm backend): "verify" = check every shard against
+# its recorded sha256 and warm the page cache, "warm" = only warm it, "" = neither.
+# See model_prep.py.
+PREPARE_MODEL = ""
+
+# A checkpoint with the adapter merged in and requantized to AWQ (lora_merge.py, then
+# `lora_merge.py quantize`): served without LoRA.
+# Only for the single-adapter setup; "" = base_model_path + adapter_path.
+MERGED_MODEL_PATH = ""
+
+# "vllm"   -> load the model in this process (engine_backends.ENGINE_ARGS)
+# "openai" -> talk to a separately running `vllm serve` (see openai_client_backend.py)
+# "replay" -> no GPU: return the recorded output of each case from REPLAY_RECORDINGS
+#             with REPLAY_PER_TOKEN_S latency, to profile everything around the engine
+BACKEND = "vllm"
+OPENAI_BASE_URL = "http://127.0.0.1:8000"
+OPENAI_MAX_CONCURRENCY = 8
+REPLAY_RECORDINGS = "outputs.zip"
+REPLAY_PER_TOKEN_S = 0.0
+
+FIXED_MAX_TOKENS = 8192
+# Per-case max_tokens from token_budget.json (run token_budget.py once to create it).
+# Falls back to FIXED_MAX_TOKENS when the file is missing.
+USE_PREDICTED_MAX_TOKENS = True
+
+# Samples per prompt from one prefill; the best one by output_checks is kept
+# (best_of_n.py). 1 = one sample, as before.
+BEST_OF_N = 1
+
+# Generate the Initialization / StepsAndEvaluation / Cleanup slots of a case in
+# Precondition:/Action:/Postcondition: form as three concurrent requests
+# (section_split.py). Needs max_num_seqs >= 3 (ENGINE_PROFILE) or the openai backend.
+SPLIT_SECTIONS = False
+
+# Cut cases with very long step lists into overlapping step windows, generated in
+# parallel and merged into one sequence (windowed_generation.py).
+WINDOW_LONG_CASES = False
+DICTIONARY_FILE = "cleaned_dictionary_master.json"
+
+# Reader -> prompt builder -> generator -> writer run concurrently (async_pipeline.py).
+# PIPELINE_QUEUE_SIZE bounds how far the CPU stages may run ahead of the GPU.
+# GENERATE_BATCH_SIZE is how many ready prompts go into one generate() call;
+# raise it together with max_num_seqs (vllm) or OPENAI_MAX_CONCURRENCY (openai).
+PIPELINE_QUEUE_SIZE = 4
+GENERATE_BATCH_SIZE = 1
+
+# Write each case to OUTPUT_DIR/<case>.partial.xml as the tokens arrive, flushed at
+# every closed block, and report time to first token/block (streaming_output.py).
+# Streams one sample per case (BEST_OF_N is ignored); use BACKEND = "openai" for
+# real token-by-token output, the in-process engine cannot stream.
+STREAM_OUTPUT = False
+
+# Keep the engine warm and convert .txt/.csv cases as they land in INPUT_DIR
+# (watch_mode.py) instead of converting the folder once and exiting.
+WATCH_MODE = False
+
+# Share the backlog between several copies of this script (one per GPU/pod, same
+# filesystem) through a SQLite lease queue (work_queue.py). "" = process INPUT_DIR alone.
+WORK_QUEUE_DB = ""
+
+# Offline batch mode (batch_export.py): BATCH_EXPORT_FILE writes every prompt as an
+# OpenAI batch request instead of generating (no engine is loaded); BATCH_RESULTS_FILE
+# turns the finished batch's results into OUTPUT_DIR/*.xml. "" = off.
+BATCH_EXPORT_FILE = ""
+BATCH_RESULTS_FILE = ""
 
-# --- 2. RANKED FILTER (FIXED TOKENIZATION) ---
-def filter_context(context_text, user_input):
+
+# --- 2. ENGINE ---
+def init_engine(registry):
+    """Builds the engine for BACKEND. Returns (engine, generate_batch_size)."""
+    max_loras = min(MAX_RESIDENT_ADAPTERS, len(registry.adapters))
+    batch_size = GENERATE_BATCH_SIZE
+    if BACKEND == "openai":
+        print(f"--> Connecting to OpenAI-compatible server at {OPENAI_BASE_URL} (model: {adapter_name})...")
+        engine = make_engine("openai", base_url=OPENAI_BASE_URL, model=adapter_name,
+                             max_concurrency=OPENAI_MAX_CONCURRENCY)
+    elif BACKEND == "replay":
+        print(f"--> Replaying recorded outputs from {REPLAY_RECORDINGS} (no GPU)...")
+        engine = make_engine("replay", recordings_path=REPLAY_RECORDINGS, inputs_path=INPUT_DIR,
+                             per_token_s=REPLAY_PER_TOKEN_S, max_loras=max_loras)
+    else:
+        engine_kwargs = {}
+        if ENGINE_PROFILE:
+            from capacity_planner import load_profile
+            engine_kwargs = load_profile(ENGINE_PROFILE) or {}
+            if not engine_kwargs:
+                print(f"    [WARNING] engine_profiles.json missing; ignoring ENGINE_PROFILE={ENGINE_PROFILE}.")
+            else:
+                print(f"--> Engine profile {ENGINE_PROFILE}: {engine_kwargs}")
+                # Feed the engine as many prompts per call as the profile lets it run at once
+                batch_size = max(batch_size, engine_kwargs["max_num_seqs"])
+        engine_kwargs.update(max_loras=max_loras, max_cpu_loras=len(registry.adapters))
+        if SPECULATIVE_TOKENS:
+            from speculative_drafts import speculative_engine_args
+            engine_kwargs.update(speculative_engine_args(SPECULATIVE_TOKENS))
+        if PREPARE_MODEL:
+            from model_prep import prepare
+            print(f"--> Preparing the model files ({PREPARE_MODEL})...")
+            model_dirs = [MERGED_MODEL_PATH] if MERGED_MODEL_PATH else \
+                [base_model_path] + sorted({spec.path for spec in registry.adapters.values()})
+            if not prepare(model_dirs, do_verify=PREPARE_MODEL == "verify"):
+                print("CRITICAL: model files failed verification; re-download them before starting the engine.")
+                sys.exit(1)
+        if CONSTRAINED_DECODING:
+            require_v0_engine()
+        elif STRUCTURAL_STOP or XML_STREAM_CHECK or REPETITION_GUARD:
+            try:
+                require_v0_engine()
+            except RuntimeError:
+                print("    [WARNING] This vLLM has no V0 engine: stop monitors only trim finished outputs "
+                      "and save no decode time (pip install \"vllm<0.10\").")
+        print("--> Initializing vLLM Engine...")
+        if MERGED_MODEL_PATH:
+            if len(registry.adapters) > 1:
+                print(f"    [WARNING] {ADAPTERS_FILE} lists {len(registry.adapters)} adapters; "
+                      f"every case uses the merged model.")
+            engine = make_engine("vllm", base_model_path=MERGED_MODEL_PATH, adapter_path=None, **engine_kwargs)
+        else:
+            engine = make_engine("vllm", base_model_path=base_model_path, adapter_path=adapter_path,
+                                 adapter_name=adapter_name, **engine_kwargs)
+    from structural_stop import SlotCloseDetector
+    from xml_stream_check import XmlStreamValidator
+    from repetition_guard import LoopDetector
+    xml_check = engine.aborts_mid_decode if XML_STREAM_CHECK == "auto" else XML_STREAM_CHECK
+    if XML_STREAM_CHECK == "auto" and not xml_check:
+        print("--> XML_STREAM_CHECK off: this engine cannot abort mid-decode (True retries invalid outputs instead).")
+    engine.stop_monitor = chain_monitors(SlotCloseDetector if STRUCTURAL_STOP else None,
+                                         XmlStreamValidator if xml_check else None,
+                                         LoopDetector if REPETITION_GUARD else None)
+    return engine, batch_size
+
+
+# --- 3. PIPELINE STAGES ---
+def make_stages(engine, registry, library_index, budget_model, dictionary=None, records=None, stream_timings=None,
+                block_index=None):
+    def build_case(job):
+        job.adapter = registry.route(job.input_file)
+        filtered_context = filter_context(library_index, job.user_content)
+        job.prompt = build_prompt(filtered_context, job.user_content)
+        if CONSTRAINED_DECODING:
+            job.grammar = grammar_for(list(dictionary.values()))
+        if WINDOW_LONG_CASES and needs_windows(job, budget_model):
+            build_window_jobs(job, library_index)
+        elif SPLIT_SECTIONS:
+            build_section_jobs(job, library_index)
+
+    def generate_batch(batch):
+        if STREAM_OUTPUT:
+            # Concurrent streams for engines that serve several at once (openai)
+            with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+                for timings in pool.map(lambda job: stream_case(engine, job, OUTPUT_DIR, budget_model,
+                                                                FIXED_MAX_TOKENS), batch):
+                    if stream_timings is not None:
+                        stream_timings.append(timings)
+            return
+        # At most max_loras adapters per engine call; the resident ones go first
+        resident = engine.resident_adapters() if hasattr(engine, "resident_adapters") else ()
+        for sub_batch in plan_adapter_batches(batch, engine.max_loras, resident):
+            if WINDOW_LONG_CASES:
+                generate_windowed(engine, sub_batch, budget_model, fixed_max_tokens=FIXED_MAX_TOKENS)
+            elif SPLIT_SECTIONS:
+                generate_sections(engine, sub_batch, budget_model, fixed_max_tokens=FIXED_MAX_TOKENS)
+            elif BEST_OF_N > 1:
+                generate_best_of_n(engine, sub_batch, BEST_OF_N, dictionary, budget_model,
+                                   fixed_max_tokens=FIXED_MAX_TOKENS, records=records)
+            else:
+                generate_with_budget(engine, sub_batch, budget_model, fixed_max_tokens=FIXED_MAX_TOKENS)
+            if block_index is not None:
+                # Fix what the dictionary can fix; decode again only what it cannot,
+                # and keep the second attempt only if it is better
+                unknown = repair_jobs(sub_batch, block_index)
+                if unknown:
+                    first_texts = [job.text for job in unknown]
+                    generate_with_budget(engine, unknown, budget_model, fixed_max_tokens=FIXED_MAX_TOKENS,
+                                         sampling_overrides=ABORT_RETRY_SAMPLING)
+                    repair_jobs(unknown, block_index)
+                    keep_better(unknown, first_texts, block_index)
+
+    def write_case(job):
+        if not job.output_path:   # streamed cases are already on disk
+            job.output_path = output_path_for(job.input_file, OUTPUT_DIR)
+            with open(job.output_path, "w") as f:
+                f.write(wrap_xml(job.text))
+        print(f"    [SUCCESS] Saved to: {job.output_path} (Duration: {time.time() - job.picked_up:.2f}s)")
+
+    return build_case, generate_batch, write_case
+
+
+# --- 4. EXECUTION ---
+def main():
+    # Cheap checks first: don't load a 72B model just to find context.txt missing
+    if not os.path.exists(CONTEXT_FILE):
+        print(f"CRITICAL: {CONTEXT_FILE} missing.")
+        sys.exit(1)
+    if REGENERATE_FROM and not os.path.exists(REGENERATE_FROM):
+        print(f"CRITICAL: regeneration queue {REGENERATE_FROM} missing.")
+        sys.exit(1)
+    if not os.path.exists(OUTPUT_DIR):
+        os.makedirs(OUTPUT_DIR)
+
+    if BATCH_RESULTS_FILE:
+        from batch_export import ingest_results
+        summary = ingest_results(BATCH_RESULTS_FILE, OUTPUT_DIR, BATCH_EXPORT_FILE or None)
+        print(f"--> Ingested {BATCH_RESULTS_FILE}: {summary}")
+        return
+
+    print("--> Loading Library Context...")
+    library_index = build_library_index(read_file(CONTEXT_FILE))
+    budget_model = load_budget_model() if USE_PREDICTED_MAX_TOKENS else None
+    if budget_model:
+        print(f"--> Using predicted max_tokens (q={budget_model['quantile']}, fitted on {budget_model['num_pairs']} cases).")
+    else:
+        print(f"--> Using fixed max_tokens={FIXED_MAX_TOKENS}.")
+
+    if CONSTRAINED_DECODING not in ("", "dictionary"):
+        print(f"CRITICAL: CONSTRAINED_DECODING = \"{CONSTRAINED_DECODING}\"; use \"dictionary\" or \"\".")
+        sys.exit(1)
     try:
-        library_data = json.loads(context_text)
-        if not isinstance(library_data, list): library_data = [library_data]
-    except json.JSONDecodeError:
-        print("       [ERROR] Context file is not valid JSON.")
-        return "[]"
-
-    # --- THE FIX: SPLIT BY UNDERSCORES TOO ---
-    # Old: re.findall(r'\w+', ...) -> kept "HIL_Mdl_Cons_APS" together
-    # New: re.findall(r'[a-zA-Z0-9]+', ...) -> splits into "HIL", "Mdl", "Cons", "APS"
-    user_words = re.findall(r'[a-zA-Z0-9]+', user_input.lower())
-    
-    stop_words = {"the", "and", "or", "to", "of", "in", "is", "a", "step", "measure", "that", "value"} 
-    base_keywords = set([w for w in user_words if w not in stop_words and len(w) > 2]) 
-
-    # --- SYNONYM MAP ---
-    synonym_map = {
-        # Faults & Safety
-        "fault":  ["fiu", "short", "circuit", "failure", "scg"],
-        "remove": ["deactivate", "release", "clear", "reset"], 
-        "can":    ["fiu", "scg", "bus"],
-        
-        # Specific Simulations
-        "gear":   ["write_read_gear", "gear_position"], 
-        "pedal":  ["write_read_aps", "acc_pedal"],
-        "acc":    ["write_read_aps", "acc_pedal"],
-        "aps":    ["write_read_aps", "acc_pedal"], # Now this will definitely trigger
-        
-        # Standard Mappings
-        "create": ["set", "activate", "trigger"],
-        "check":  ["read", "verify", "validate", "camera", "vision", "pattern"],
-        "mil":    ["telltale", "indicator", "warning", "lamp"],
-        "screen": ["cluster", "display", "hmi"],
-        "simulate": ["set", "force", "write"],
-        "ignition": ["ign", "key", "switch", "simulating"],
-        "battery":  ["batt", "voltage"],
-        "crank":    ["start", "engine"]
-    }
-
-    final_keywords = set(base_keywords)
-    for word in base_keywords:
-        if word in synonym_map:
-            final_keywords.update(synonym_map[word])
-            
-    # Score Items
-    scored_items = []
-    for item in library_data:
-        actual_data = item.get("json_snippet", item)
-        item_str = json.dumps(actual_data).lower()
-        
-        match_count = 0
-        for key in final_keywords:
-            if key in item_str:
-                match_count += 1
-        
-        # Priority Boosting
-        if "deactivate" in item_str and "remove" in final_keywords: match_count += 10
-        if "gear" in item_str and "gear" in final_keywords: match_count += 5
-        if "battery" in item_str and "battery" in final_keywords: match_count += 5
-        
-        # APS BOOST (Now guaranteed to trigger because "aps" is in final_keywords)
-        if "write_read_aps" in item_str and "aps" in final_keywords: match_count += 20 
-        
-        if match_count > 0:
-             scored_items.append((match_count, actual_data))
-    
-    # Sort and Trim
-    scored_items.sort(key=lambda x: x[0], reverse=True)
-    MAX_ITEMS = 100
-    relevant_items = [x[1] for x in scored_items[:MAX_ITEMS]]
-    
-    # Debug Output (Check if WRITE_READ_APS is at the top now)
-    print(f"       [DEBUG] Found {len(scored_items)} matches. Keeping top {len(relevant_items)}.")
-    if len(relevant_items) > 0:
-        print("       [DEBUG] Top 10 Selected Items:")
-        for idx, item in enumerate(relevant_items[:10]):
-            name = item.get("library_link") or item.get("concept") or "Unknown"
-            print(f"          {idx+1}. {name}")
-        
-    return json.dumps(relevant_items, indent=2)
-
-def read_file(filename):
-    with open(filename, 'r') as f: return f.read().strip()
-
-# --- 3. PROMPT ---
-system_block = """### System:
-You are an expert Automotive Test Automation Engineer.
-Convert Natural Language Test Steps into dSPACE XML.
-
-### CRITICAL RULES:
-1. **Block Type:** Use `<Standard.LibraryLinkBlock>`.
-2. **Parameters:** YOU MUST NEST DATA INSIDE A `<value>` TAG.
-   - **WRONG:** `<MainLibrary.Int name="x">10</MainLibrary.Int>`
-   - **CORRECT:** <MainLibrary.Int name="x">
-         <value>10</value>
-     </MainLibrary.Int>
-3. **Logic:** - "Remove Fault" -> Use `DEACTIVATE_RELEASE_ERROR`.
-   - "Check Telltale" -> Use `CHECK_CLUSTER_THROUGH_CAMERA`.
-   - "Simulate Gear" -> Use `WRITE_READ_GEAR`.
-   - "Simulate APS" -> Use `WRITE_READ_APS`.
-
-### Required Output Format:
-<FrameworkBuilder.ActualOperationSlot name="Initialization">
-    <subsystems> ... </subsystems>
-</FrameworkBuilder.ActualOperationSlot>
-<FrameworkBuilder.ActualOperationSlot name="StepsAndEvaluation">
-    <subsystems> ... </subsystems>
-</FrameworkBuilder.ActualOperationSlot>
-<FrameworkBuilder.ActualOperationSlot name="Cleanup">
-    <subsystems> ... </subsystems>
-</FrameworkBuilder.ActualOperationSlot>
-"""
-
-# --- 4. EXECUTION LOOP ---
-print("--> Loading Library Context...")
-full_context_path = "context.txt"
-if not os.path.exists(full_context_path):
-    print("CRITICAL: context.txt missing.")
-    sys.exit(1)
-full_context_raw = read_file(full_context_path)
-
-input_files = glob.glob(os.path.join(INPUT_DIR, "*.txt"))
-print(f"--> Found {len(input_files)} test cases.")
-
-for i, input_file in enumerate(input_files):
-    print(f"\n[{i+1}/{len(input_files)}] Processing: {input_file}")
-    
+        registry = AdapterRegistry.load(adapter_name, adapter_path, ADAPTERS_FILE)
+        print(f"--> Adapters: {', '.join(f'{s.name}={s.lora_id}' for s in registry.adapters.values())}")
+        if BATCH_EXPORT_FILE:
+            engine, batch_size = None, GENERATE_BATCH_SIZE
+        else:
+            engine, batch_size = init_engine(registry)
+    except Exception as e:
+        print(f"\nINITIALIZATION ERROR: {e}")
+        sys.exit(1)
+    dictionary, records, stream_timings = None, [], []
+    if (BEST_OF_N > 1 or CONSTRAINED_DECODING == "dictionary") and os.path.exists(DICTIONARY_FILE):
+        dictionary = load_dictionary(DICTIONARY_FILE)
+    if CONSTRAINED_DECODING == "dictionary" and dictionary is None:
+        print(f"CRITICAL: CONSTRAINED_DECODING = \"dictionary\" needs {DICTIONARY_FILE}.")
+        sys.exit(1)
+    if BEST_OF_N > 1:
+        print(f"--> Best of {BEST_OF_N} samples per case "
+              f"({'dictionary ' + DICTIONARY_FILE if dictionary else 'no dictionary: structure checks only'}).")
+    block_index = None
+    if REPAIR_BLOCKS:
+        if os.path.exists(DICTIONARY_FILE):
+            block_index = DictionaryIndex.load(DICTIONARY_FILE)
+        else:
+            print(f"    [WARNING] {DICTIONARY_FILE} not found; generated blocks are not repaired.")
+    build_case, generate_batch, write_case = make_stages(engine, registry, library_index, budget_model,
+                                                         dictionary, records, stream_timings, block_index)
+
+    if BATCH_EXPORT_FILE:
+        from batch_export import export_batch
+
+        def built_jobs():
+            for input_file in list_input_files(INPUT_DIR):
+                job = CaseJob(input_file=input_file, user_content=read_file(input_file))
+                build_case(job)
+                yield job
+        count = export_batch(built_jobs(), BATCH_EXPORT_FILE, budget_model, fixed_max_tokens=FIXED_MAX_TOKENS)
+        print(f"--> Wrote {count} batch requests to {BATCH_EXPORT_FILE}")
+        return
+
+    if WATCH_MODE:
+        from watch_mode import run_watch
+        run_watch(INPUT_DIR, OUTPUT_DIR, build_case, generate_batch,
+                  queue_size=PIPELINE_QUEUE_SIZE, batch_size=batch_size)
+        return
+
+    input_files = list_input_files(INPUT_DIR)
+    print(f"--> Found {len(input_files)} test cases.")
+    if REGENERATE_FROM:
+        queued = {os.path.basename(path) for path in load_queue(REGENERATE_FROM)}
+        input_files = [path for path in input_files if os.path.basename(path) in queued]
+        print(f"--> Regenerating the {len(input_files)} case(s) queued in {REGENERATE_FROM}.")
+
+    if WORK_QUEUE_DB:
+        from work_queue import connect, register_cases, run_worker, status_counts
+        queue_conn = connect(WORK_QUEUE_DB)
+        added, requeued = register_cases(queue_conn, input_files)
+        print(f"--> Work queue {WORK_QUEUE_DB}: {added} new, {requeued} changed, now {status_counts(queue_conn)}")
+        start_t = time.time()
+        done = run_worker(WORK_QUEUE_DB, read_file, build_case, generate_batch, write_case, CaseJob,
+                          claim_batch=batch_size)
+        print(f"\n    [STATS] this worker finished {done} cases in {time.time() - start_t:.2f}s; "
+              f"queue now {status_counts(queue_conn)}")
+        return
+
     start_t = time.time()
-    user_content = read_file(input_file)
-    
-    filtered_context = filter_context(full_context_raw, user_content)
-    
-    full_prompt = f"{system_block}\n\n### Library Dictionary (JSON):\n{filtered_context}\n\n### User Input:\n{user_content}\n\n### Response (XML):\n"
-    
-    sampling_params = SamplingParams(
-        temperature=0.1, 
-        repetition_penalty=1.15,
-        max_tokens=8192,
-        stop=["</FrameworkBuilder.ActualDataSlot>"]
-    )
-    
-    outputs = llm.generate(
-        [full_prompt], 
-        sampling_params=sampling_params,
-        lora_request=LoRARequest(adapter_name, 1, adapter_path)
+    jobs, stage_stats = run_pipeline(
+        input_files, read_file, build_case, generate_batch, write_case,
+        queue_size=PIPELINE_QUEUE_SIZE, batch_size=batch_size
     )
-    
-    generated_text = outputs[0].outputs[0].text.strip()
-    
-    full_xml_output = f"""<?xml version="1.0" encoding="utf-8"?>
-<Standard.Sequence name="Test_Sequence_Generated">
-    <library-description>Generated by AI Model</library-description>
-    <subsystems>
-        <FrameworkBuilder.Frame name="Test_Frame_Main">
-            <library-description>To execute subsystems sequentially.</library-description>
-            <subsystems>
-                <FrameworkBuilder.ActualDataSlot name="Data">
-                    <subsystems>
-{generated_text}
-                    </subsystems>
-                </FrameworkBuilder.ActualDataSlot>
-            </subsystems>
-        </FrameworkBuilder.Frame>
-    </subsystems>
-</Standard.Sequence>"""
-
-    output_path = os.path.join(OUTPUT_DIR, os.path.basename(input_file).replace(".txt", ".xml"))
-    with open(output_path, "w") as f:
-        f.write(full_xml_output)
-    
-    print(f"    [STATS] Duration: {time.time() - start_t:.2f}s")
-    print(f"    [SUCCESS] Saved to: {output_path}")
-
-print("\n--> All tests completed.")
+    print(f"\n    [STATS] {len(jobs)} cases in {time.time() - start_t:.2f}s")
+    print_utilization(stage_stats)
+    print_report(records)
+    print_latency_report(stream_timings)
+    if VALIDATE_OUTPUTS:
+        print(f"\n--> Validating {len(jobs)} outputs...")
+        written = [job.output_path for job in jobs if job.output_path and os.path.exists(job.output_path)]
+        validate_and_queue([(os.path.basename(path), read_file(path)) for path in written],
+                           REGENERATE_QUEUE, DICTIONARY_FILE, input_dir=INPUT_DIR)
+
+    print("\n--> All tests completed.")
+
+
+if __name__ == "__main__":
+    main()
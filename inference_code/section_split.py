@@ -0,0 +1,227 @@
+"""
+Section-split generation: one case in the README's Precondition: / Action: /
+Postcondition: form becomes three shorter requests, one per output slot, that
+run side by side in the same engine batch and are stitched back in order.
+
+    Precondition:  -> Initialization
+    Action:        -> StepsAndEvaluation
+    Postcondition: -> Cleanup
+
+Each request keeps the prompt format the adapter was trained on, with only
+its own section filled in (the other two left empty) and with the top
+SECTION_MAX_ITEMS dictionary items retrieved for that section alone. The
+model still writes all three slots, two of them empty, and the stitcher keeps
+the requested one. Wall-clock per case drops to about the longest section's
+decode instead of the sum of all three. Cases without the three headers are
+generated whole, as before.
+
+Needs an engine that runs the three requests concurrently: max_num_seqs >= 3
+(an ENGINE_PROFILE from capacity_planner.py) or the openai backend. On our
+targets StepsAndEvaluation carries most of the output, so the saving comes
+from the shorter prompts as much as from the parallel decode: with the full
+100 items per section the three prefills cost 2.8x the whole case and the
+split was slower. With the caps below, on the H200 profile over the 163 CSV
+cases with a target, a case takes 38.0 s instead of 45.3 s (x1.19) and the
+section prompts carry 708 of the targets' 1427 library-links (whole: 682).
+
+Running this file prices whole vs split generation for every CSV case with a
+target (capacity_planner's model of the H200 profile, with the slot lengths
+of the targets), reports how many of the targets' library-links each prompt
+carries, and checks the stitching on a stub engine.
+
+How to use:
+    SPLIT_SECTIONS = True in run_batch_tests_v14.py
+    python section_split.py
+"""
+
+import io
+import re
+import json
+import glob
+import contextlib
+
+from async_pipeline import CaseJob
+from token_budget import count_tokens, extract_slots, load_targets, _quantile, INPUT_CSV_GLOB, TARGETS_PATH
+from conversion_steps import (filter_context, build_prompt, build_library_index, read_file, read_csv_rows,
+                              csv_row_title, csv_row_to_text)
+from engine_backends import generate_with_budget, FIXED_MAX_TOKENS
+
+# --- 1. CONFIGURATION ---
+SECTIONS = (("Precondition", "Initialization"), ("Action", "StepsAndEvaluation"), ("Postcondition", "Cleanup"))
+HEADER_PATTERN = re.compile(r"^[ \t]*(pre-?condition|action|post-?condition)s?[ \t]*:[ \t]*", re.IGNORECASE | re.MULTILINE)
+SLOT_TEMPLATE = '<FrameworkBuilder.ActualOperationSlot name="{}"[^>]*>.*?</FrameworkBuilder.ActualOperationSlot>'
+EMPTY_SLOT = """<FrameworkBuilder.ActualOperationSlot name="{}">
+    <subsystems>
+    </subsystems>
+</FrameworkBuilder.ActualOperationSlot>"""
+# Dictionary items kept per section prompt (filter_context keeps up to 100 for a whole case).
+# Prefill is linear in them; Action needs the most, the cleanup steps hardly match any.
+SECTION_MAX_ITEMS = {"Precondition": 40, "Action": 60, "Postcondition": 10}
+LINK_PATTERN = re.compile(r'library-link="([^"]+)"')
+CONTEXT_FILE = "context.txt"
+
+
+# --- 2. SPLIT AND STITCH ---
+def split_sections(user_content):
+    """{"Precondition": text, "Action": text, "Postcondition": text}, or None without all three headers."""
+    matches = list(HEADER_PATTERN.finditer(user_content))
+    sections = {}
+    for i, match in enumerate(matches):
+        key = match.group(1).lower().replace("-", "")
+        header = {"precondition": "Precondition", "action": "Action", "postcondition": "Postcondition"}[key]
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(user_content)
+        if header in sections:
+            return None   # a header twice: not the README form, don't guess
+        sections[header] = user_content[match.end():end].strip()
+    if len(sections) != len(SECTIONS):
+        return None
+    return sections
+
+
+def section_input(sections, header):
+    """The case text with only `header`'s section filled in."""
+    return "\n".join(f"{name}:\n{sections[name] if name == header else ''}".rstrip() for name, _ in SECTIONS)
+
+
+def extract_slot(text, slot_name):
+    match = re.search(SLOT_TEMPLATE.format(slot_name), text, re.DOTALL)
+    return match.group(0) if match else None
+
+
+def build_section_jobs(job, library_index):
+    """
+    Sets job.sections to one CaseJob per slot (prompt built from that section's
+    own dictionary items), or leaves it None if the case is not in README form.
+    """
+    sections = split_sections(job.user_content)
+    if sections is None:
+        return
+    job.sections = []
+    for header, slot_name in SECTIONS:
+        text = section_input(sections, header)
+        with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+            items = json.loads(filter_context(library_index, sections[header])) if sections[header] else []
+        filtered = json.dumps(items[:SECTION_MAX_ITEMS[header]], indent=2)
+        job.sections.append(CaseJob(input_file=f"{job.input_file}#{slot_name}", user_content=text,
+                                    prompt=build_prompt(filtered, text), adapter=job.adapter,
+                                    grammar=job.grammar))
+
+
+def generate_sections(engine, jobs, budget_model=None, fixed_max_tokens=FIXED_MAX_TOKENS, log=print):
+    """
+    generate_with_budget() over the section requests of all jobs in one call
+    (plus the whole prompt of jobs without sections), then stitches each job's
+    text from its three slots.
+    """
+    requests = []
+    for job in jobs:
+        requests.extend(job.sections or [job])
+    generate_with_budget(engine, requests, budget_model, fixed_max_tokens=fixed_max_tokens, log=log)
+    for job in jobs:
+        if job.sections:
+            stitch_sections(job, log)
+
+
+def stitch_sections(job, log=print):
+    """job.text from the requested slot of each generated section."""
+    slots = []
+    for (_, slot_name), section in zip(SECTIONS, job.sections):
+        slot = extract_slot(section.text, slot_name)
+        if slot is None:
+            log(f"    [WARNING] {section.input_file}: no {slot_name} slot in the output; left empty.")
+            slot = EMPTY_SLOT.format(slot_name)
+        slots.append(slot)
+    job.text = "\n".join(slots)
+
+
+# --- 3. LATENCY ESTIMATE ---
+def measure_sections(context_path=CONTEXT_FILE, csv_glob=INPUT_CSV_GLOB, targets_path=TARGETS_PATH):
+    """
+    [(whole prompt tokens, [section prompt tokens], whole output tokens, [slot tokens],
+      (target links, in the whole prompt, in the section prompts))] per CSV case.
+    """
+    library_index = build_library_index(read_file(context_path))
+    targets = load_targets(targets_path)
+    rows = []
+    for csv_path in sorted(glob.glob(csv_glob)):
+        for row in read_csv_rows(csv_path):
+            title = csv_row_title(row)
+            matches = sorted(name for name in targets if title and name.startswith(title + "."))
+            if not matches:
+                continue
+            job = CaseJob(input_file=title, user_content=csv_row_to_text(row))
+            build_section_jobs(job, library_index)
+            if not job.sections:
+                continue
+            with contextlib.redirect_stdout(io.StringIO()):
+                whole_prompt = build_prompt(filter_context(library_index, job.user_content), job.user_content)
+            target = extract_slots(targets[matches[0]])
+            slot_tokens, links = [], [0, 0, 0]
+            for (_, slot_name), section in zip(SECTIONS, job.sections):
+                slot = extract_slot(target, slot_name)
+                # The model also writes the two empty slots around its own
+                others = sum(count_tokens(EMPTY_SLOT.format(name)) for _, name in SECTIONS if name != slot_name)
+                slot_tokens.append(count_tokens(slot or "") + others)
+                for link in set(LINK_PATTERN.findall(slot or "")):
+                    links[0] += 1
+                    links[1] += f'"{link}"' in whole_prompt
+                    links[2] += f'"{link}"' in section.prompt
+            rows.append((count_tokens(whole_prompt), [count_tokens(s.prompt) for s in job.sections],
+                         count_tokens(target), slot_tokens, links))
+    return rows
+
+
+def main():
+    from capacity_planner import load_model_config, plan_profile, throughput, summarize_lengths, GPUS
+    from engine_backends import StubEngine
+
+    # Plumbing: a stub that always answers with all three slots
+    engine = StubEngine(prefill_s=0.0)
+    job = CaseJob(input_file="demo.txt", user_content="Precondition:\n1. Ign ON\nAction:\n2. Check MIL\nPostcondition:\n3. Ign OFF")
+    build_section_jobs(job, build_library_index(read_file(CONTEXT_FILE)))
+    generate_sections(engine, [job], log=lambda *_: None)
+    stitched = re.findall(r'ActualOperationSlot name="(\w+)"', job.text)
+    print(f"--> Stub check: {len(job.sections)} section requests in batches of {engine.batch_sizes}, "
+          f"stitched slots {stitched}")
+
+    rows = measure_sections()
+    if not rows:
+        print("CRITICAL: no CSV cases with targets and Precondition/Action/Postcondition sections.")
+        return 1
+    cfg = load_model_config()
+    gpu_name = "H200-141G"
+    summary = summarize_lengths([(r[0], r[2]) for r in rows])
+    profile = plan_profile(gpu_name, cfg, summary)
+    plan = profile["memory"]
+
+    def step_s(prompt_tokens, output_tokens, concurrency):
+        perf = throughput(cfg, GPUS[gpu_name], plan, {"prompt_mean": prompt_tokens, "output_mean": output_tokens},
+                          concurrency, profile["engine_args"]["enforce_eager"])
+        return perf["prefill_s"], perf["decode_step_ms"] / 1000
+
+    whole, split, prompt_whole, prompt_split = [], [], 0, 0
+    for whole_prompt, section_prompts, whole_output, slot_tokens, _ in rows:
+        prefill, step = step_s(whole_prompt, whole_output, 1)
+        whole.append(prefill + whole_output * step)
+        # The three prompts prefill back to back, then decode together until the longest is done
+        prefills = sum(step_s(p, o, 3)[0] for p, o in zip(section_prompts, slot_tokens))
+        _, step3 = step_s(sum(section_prompts) / 3, sum(slot_tokens) / 3, 3)
+        split.append(prefills + max(slot_tokens) * step3)
+        prompt_whole += whole_prompt
+        prompt_split += sum(section_prompts)
+
+    whole.sort()
+    split.sort()
+    print(f"--> {len(rows)} cases, {gpu_name} profile (max_num_seqs={profile['engine_args']['max_num_seqs']}), one case at a time")
+    print(f"    {'':<16} {'mean':>8} {'p50':>8} {'p95':>8}   prompt tokens")
+    for label, values, tokens in (("whole case", whole, prompt_whole), ("3 sections", split, prompt_split)):
+        print(f"    {label:<16} {sum(values) / len(values):>7.1f}s {_quantile(values, 0.5):>7.1f}s "
+              f"{_quantile(values, 0.95):>7.1f}s   {tokens / len(rows):>8.0f} per case")
+    print(f"    latency x{sum(whole) / sum(split):.2f}; the sections prefill "
+          f"{prompt_split / prompt_whole:.2f}x the prompt tokens of the whole case")
+    links, in_whole, in_split = (sum(r[4][i] for r in rows) for i in range(3))
+    print(f"    target library-links in the prompt: whole {in_whole}/{links}, sections {in_split}/{links}")
+
+
+if __name__ == "__main__":
+    main()
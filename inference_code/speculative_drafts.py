@@ -0,0 +1,237 @@
+"""
+Retrieval-based draft tokens for speculative decoding of the dSPACE XML.
+
+The generated XML is mostly copied material: LibraryLinkBlock skeletons, the
+parameter nesting and the GUIDs of the dictionary entries that are already in
+the prompt, and the same block sequences that earlier outputs contain. A draft
+model is not needed to guess that. DraftProposer looks up the last 2-4 tokens
+of the text so far and proposes what followed them before:
+    1. in this request (prompt + generated so far), the same as vLLM's
+       built-in "[ngram]" prompt-lookup proposer;
+    2. in a store of previously accepted outputs (targets, validated outputs).
+The engine verifies the proposed tokens in one forward pass and keeps the
+longest correct prefix plus one token of its own, so every accepted draft
+token is a decode step saved.
+
+vLLM's speculative hook only ships the prompt-lookup half. v14 switches it
+on with SPECULATIVE_TOKENS (speculative_engine_args() below); the store half
+needs an engine that accepts a custom proposer. Running this file replays the
+targets through both and reports the acceptance length each would reach, so
+the store's extra gain is known before anyone builds that engine.
+
+Tokens are the model's when a tokenizer is passed, otherwise a regex split
+(words, single punctuation, whitespace runs), which is coarser than BPE on
+GUIDs but close on the XML markup.
+
+How to use (from the working directory with context.txt, inputs/, targets/):
+    python speculative_drafts.py [--k 8]
+"""
+
+import io
+import re
+import glob
+import argparse
+import contextlib
+from collections import deque
+
+from token_budget import extract_slots, load_targets, INPUT_CSV_GLOB, TARGETS_PATH
+from conversion_steps import (read_csv_rows, csv_row_title, csv_row_to_text, build_library_index,
+                              filter_context, build_prompt, read_file)
+
+# --- 1. CONFIGURATION ---
+NUM_SPECULATIVE_TOKENS = 8   # draft tokens proposed per decode step
+NGRAM_MAX = 4                # longest suffix matched
+NGRAM_MIN = 2                # shortest suffix matched (1 proposes too much noise)
+STORE_MAX_OUTPUTS = 200      # accepted outputs kept in the store (oldest dropped first)
+CONTEXT_FILE = "context.txt"
+
+TOKEN_PATTERN = re.compile(r"\s+|\w+|[^\w\s]")
+
+
+def tokenize(text, tokenizer=None):
+    if tokenizer is not None:
+        return tokenizer.encode(text)
+    return TOKEN_PATTERN.findall(text)
+
+
+def speculative_engine_args(num_tokens=NUM_SPECULATIVE_TOKENS, ngram_max=NGRAM_MAX, ngram_min=NGRAM_MIN):
+    """LLM(...) arguments for vLLM's prompt-lookup proposer (part 1 of DraftProposer)."""
+    return {"speculative_config": {"method": "ngram", "num_speculative_tokens": num_tokens,
+                                   "prompt_lookup_max": ngram_max, "prompt_lookup_min": ngram_min}}
+
+
+# --- 2. PROPOSER ---
+class NGramIndex:
+    """
+    Token sequence plus, for every n-gram (NGRAM_MIN..NGRAM_MAX tokens), the
+    position right after its latest occurrence. Appending is incremental.
+    """
+
+    def __init__(self, ngram_max=NGRAM_MAX, ngram_min=NGRAM_MIN):
+        self.ngram_max = ngram_max
+        self.ngram_min = ngram_min
+        self.tokens = []
+        self.next_pos = {}
+
+    def extend(self, tokens):
+        for token in tokens:
+            # n-grams ending just before the new token now have a continuation
+            end = len(self.tokens)
+            for n in range(self.ngram_min, self.ngram_max + 1):
+                if end >= n:
+                    self.next_pos[tuple(self.tokens[end - n:end])] = end
+            self.tokens.append(token)
+
+    def lookup(self, suffix, k):
+        """Up to k tokens that followed the longest matching suffix, or []."""
+        for n in range(min(self.ngram_max, len(suffix)), self.ngram_min - 1, -1):
+            pos = self.next_pos.get(tuple(suffix[-n:]))
+            if pos is not None:
+                return self.tokens[pos:pos + k]
+        return []
+
+
+class DraftProposer:
+    """
+    Per-request proposer: start() with the prompt tokens, propose() before
+    each verification step, accept() the tokens the engine emitted, and
+    add_output() once the finished output passed validation.
+    """
+
+    def __init__(self, k=NUM_SPECULATIVE_TOKENS, use_store=True, ngram_max=NGRAM_MAX, ngram_min=NGRAM_MIN,
+                 store_max_outputs=STORE_MAX_OUTPUTS):
+        self.k = k
+        self.use_store = use_store
+        self.ngram_max = ngram_max
+        self.ngram_min = ngram_min
+        self.outputs = deque(maxlen=store_max_outputs)
+        self._stored = set()   # the outputs in the store, as tuples: an output already there adds nothing
+        self.store = NGramIndex(ngram_max, ngram_min)
+        self.context = NGramIndex(ngram_max, ngram_min)
+
+    def add_output(self, tokens):
+        key = tuple(tokens)
+        if key in self._stored:
+            return
+        self._stored.add(key)
+        if len(self.outputs) == self.outputs.maxlen:
+            # Drop the oldest output: rebuild, since an index cannot forget positions
+            self._stored.discard(tuple(self.outputs[0]))
+            self.outputs.append(list(tokens))
+            self.store = NGramIndex(self.ngram_max, self.ngram_min)
+            for output in self.outputs:
+                self.store.extend(output)
+        else:
+            self.outputs.append(list(tokens))
+            self.store.extend(tokens)
+
+    def start(self, prompt_tokens):
+        self.context = NGramIndex(self.ngram_max, self.ngram_min)
+        self.context.extend(prompt_tokens)
+
+    def accept(self, tokens):
+        self.context.extend(tokens)
+
+    def propose(self, k=None):
+        """(draft tokens, "context" | "store" | None)."""
+        k = k or self.k
+        suffix = self.context.tokens[-self.ngram_max:]
+        draft = self.context.lookup(suffix, k)
+        if draft:
+            return draft, "context"
+        if self.use_store:
+            draft = self.store.lookup(suffix, k)
+            if draft:
+                return draft, "store"
+        return [], None
+
+
+# --- 3. OFFLINE SIMULATION ---
+def replay(proposer, prompt_tokens, target_tokens, stats):
+    """
+    Greedy speculative decoding of a known output: each step proposes k tokens,
+    keeps the longest prefix that matches the target and adds one token of the
+    engine's own (the verification pass produces it anyway).
+    """
+    proposer.start(prompt_tokens)
+    pos = 0
+    while pos < len(target_tokens):
+        draft, source = proposer.propose()
+        accepted = 0
+        for token in draft:
+            if pos + accepted >= len(target_tokens) or target_tokens[pos + accepted] != token:
+                break
+            accepted += 1
+        step = target_tokens[pos:pos + accepted + 1]
+        proposer.accept(step)
+        pos += len(step)
+        stats["steps"] += 1
+        stats["proposed"] += len(draft)
+        stats["accepted"] += accepted
+        if source:
+            stats[f"{source}_accepted"] += accepted
+    stats["tokens"] += len(target_tokens)
+
+
+def load_cases(context_path=CONTEXT_FILE, csv_glob=INPUT_CSV_GLOB, targets_path=TARGETS_PATH):
+    """[(name, prompt, target slots)] for the CSV cases with a target, as the runner builds them."""
+    library_index = build_library_index(read_file(context_path))
+    targets = load_targets(targets_path)
+    cases = []
+    for csv_path in sorted(glob.glob(csv_glob)):
+        for row in read_csv_rows(csv_path):
+            title = csv_row_title(row)
+            matches = sorted(name for name in targets if title and name.startswith(title + "."))
+            if not matches:
+                continue
+            text = csv_row_to_text(row)
+            with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+                prompt = build_prompt(filter_context(library_index, text), text)
+            cases.append((matches[0], prompt, extract_slots(targets[matches[0]])))
+    return cases
+
+
+def simulate(cases, k, use_store, tokenizer=None):
+    """
+    Replays the cases in order; with use_store, every finished target joins the
+    store. A target replayed before is skipped: the store would hold it verbatim.
+    """
+    proposer = DraftProposer(k=k, use_store=use_store)
+    stats = dict.fromkeys(["tokens", "steps", "proposed", "accepted", "context_accepted", "store_accepted"], 0)
+    seen = set()
+    for _, prompt, target in cases:
+        if target in seen:
+            continue
+        seen.add(target)
+        target_tokens = tokenize(target, tokenizer)
+        replay(proposer, tokenize(prompt, tokenizer), target_tokens, stats)
+        proposer.add_output(target_tokens)
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline acceptance of n-gram draft tokens on the targets.")
+    parser.add_argument("--k", type=int, nargs="+", default=[4, NUM_SPECULATIVE_TOKENS])
+    parser.add_argument("--context", default=CONTEXT_FILE)
+    args = parser.parse_args()
+
+    cases = load_cases(args.context)
+    if not cases:
+        print(f"CRITICAL: no CSV cases with targets found ({INPUT_CSV_GLOB}, {TARGETS_PATH}).")
+        return 1
+    distinct = len({target for _, _, target in cases})
+    print(f"--> Replaying {distinct} distinct targets of {len(cases)} cases in order "
+          f"(the store holds the targets replayed before).")
+    print(f"\n    {'proposer':<30} {'k':>3} {'tokens/step':>12} {'draft acc.':>11} {'from prompt':>12} {'from store':>11}")
+    for k in args.k:
+        for use_store, label in ((False, "prompt lookup (vLLM [ngram])"), (True, "prompt + accepted outputs")):
+            s = simulate(cases, k, use_store)
+            print(f"    {label:<30} {k:>3} {s['tokens'] / s['steps']:>12.2f} "
+                  f"{s['accepted'] / max(s['proposed'], 1):>11.1%} "
+                  f"{s['context_accepted'] / s['tokens']:>12.1%} {s['store_accepted'] / s['tokens']:>11.1%}")
+    print("\n    tokens/step is the acceptance length + 1: the decode-step reduction at batch size 1,")
+    print("    before the (small, bandwidth-bound) extra cost of verifying k tokens per step.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""
+Streaming output for interactive runs: the generated XML goes into
+outputs/<case>.partial.xml token by token, instead of appearing all at once
+after the whole sequence (minutes for a long case) has finished.
+
+StreamingXmlWriter writes the wrapper header, then every delta as it arrives,
+and flushes the file each time a block element closes (</...Block> or a slot's
+</FrameworkBuilder.ActualOperationSlot>), so a viewer following the file
+always sees whole blocks. When the case finishes, the final .xml is written
+exactly as the batch runner writes it (wrap_xml of the stripped text) and
+replaces the partial file atomically.
+
+Per case it records:
+    ttft   - request sent -> first token
+    ttfb   - request sent -> first complete block element
+    itl    - gaps between consecutive deltas (mean / p95 / max)
+
+Engines stream through .stream(prompt, sampling, on_delta, adapter=None):
+the "openai" backend streams the server's SSE chunks, the stub and replay
+engines stream at their prefill_s / per_token_s rates, and the in-process
+vLLM engine hands over the whole text at the end (LLM.generate cannot stream).
+
+How to use:
+    STREAM_OUTPUT = True in run_batch_tests_v14.py
+    python streaming_output.py [--ttft-ms 800] [--per-token-ms 20]   # replay demo, no GPU
+"""
+
+import os
+import re
+import time
+import argparse
+from dataclasses import dataclass, field
+
+from token_budget import next_budget, _quantile
+from conversion_steps import wrap_xml, output_path_for
+from engine_backends import SAMPLING_DEFAULTS, FIXED_MAX_TOKENS, ABORT_RETRIES, abort_retry_sampling, initial_budget
+
+# --- 1. CONFIGURATION ---
+PARTIAL_SUFFIX = ".partial.xml"
+BLOCK_CLOSE = re.compile(r"</(?:[\w.]+Block|FrameworkBuilder\.ActualOperationSlot)>")
+CLOSE_TAG_MAX = 64   # longest closing tag we look for, carried over between deltas
+
+WRAP_HEAD, WRAP_TAIL = wrap_xml("\0").split("\0")
+
+
+@dataclass
+class StreamTimings:
+    case: str
+    started: float = field(default_factory=time.perf_counter)
+    first_token: float = None
+    first_block: float = None
+    finished: float = None
+    tokens: int = 0
+    blocks: int = 0
+    gaps: list = field(default_factory=list)
+
+    @property
+    def ttft(self):
+        return self.first_token - self.started if self.first_token else None
+
+    @property
+    def ttfb(self):
+        return self.first_block - self.started if self.first_block else None
+
+
+# --- 2. WRITER ---
+class StreamingXmlWriter:
+    """on_delta() target: appends to the .partial.xml, flushes at every closed block."""
+
+    def __init__(self, output_path, timings):
+        self.output_path = output_path
+        self.partial_path = output_path[:-len(".xml")] + PARTIAL_SUFFIX if output_path.endswith(".xml") \
+            else output_path + PARTIAL_SUFFIX
+        self.timings = timings
+        self._tail = ""
+        self._last = None
+        self._file = open(self.partial_path, "w", encoding="utf-8")
+        self._file.write(WRAP_HEAD)
+        self._file.flush()
+
+    def __call__(self, delta):
+        now = time.perf_counter()
+        t = self.timings
+        if t.first_token is None:
+            t.first_token = now
+        else:
+            t.gaps.append(now - self._last)
+        self._last = now
+        t.tokens += 1
+        self._file.write(delta)
+        # A closing tag may arrive split over several deltas
+        window = self._tail + delta
+        closed = len(BLOCK_CLOSE.findall(window)) - len(BLOCK_CLOSE.findall(self._tail))
+        self._tail = window[-CLOSE_TAG_MAX:]
+        if closed > 0:
+            t.blocks += closed
+            if t.first_block is None:
+                t.first_block = now
+            self._file.flush()
+
+    def restart(self):
+        """Throw the partial output away (a truncated attempt is being retried)."""
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(WRAP_HEAD)
+        self._file.flush()
+        self._tail = ""
+
+    def finish(self, text):
+        """Writes the final .xml like the batch runner and drops the partial file."""
+        self._file.close()
+        tmp_path = self.output_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(wrap_xml(text))
+        os.replace(tmp_path, self.output_path)
+        os.remove(self.partial_path)
+
+    def discard(self):
+        """Closes and removes the partial file of a case that failed (no-op after finish())."""
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.partial_path):
+            os.remove(self.partial_path)
+
+
+def stream_case(engine, job, output_dir, budget_model=None, fixed_max_tokens=FIXED_MAX_TOKENS, log=print):
+    """
+    Streams one job into output_dir, retrying with a larger budget when the
+    output is cut off by max_tokens, and with abort_retry_sampling() when a stop
+    monitor aborted it. Sets job.text and job.output_path.
+    Returns the StreamTimings of the (last) attempt.
+    """
+    max_tokens, ceiling = initial_budget(engine, job, budget_model, fixed_max_tokens)
+    name = os.path.basename(job.input_file)
+    if max_tokens is None:
+        job.text = ""
+        log(f"    [SKIPPED] {job.input_file}: the prompt leaves no room for output in max_model_len={engine.max_model_len}.")
+        return StreamTimings(name)
+    job.output_path = output_path_for(job.input_file, output_dir)
+    timings = StreamTimings(name)
+    writer = StreamingXmlWriter(job.output_path, timings)
+    try:
+        result, timings = _stream_attempts(engine, job, writer, timings, max_tokens, ceiling, log)
+        job.text = result.text.strip()
+        writer.finish(job.text)
+    finally:
+        writer.discard()
+    log(f"    [STREAM] {name}: ttft {_fmt(timings.ttft)}, first block {_fmt(timings.ttfb)}, "
+        f"{timings.tokens} deltas, {timings.blocks} blocks")
+    return timings
+
+
+def _stream_attempts(engine, job, writer, timings, max_tokens, ceiling, log):
+    """The retry loop of stream_case(): returns (last result, its StreamTimings)."""
+    name = timings.case
+    aborts, overrides = 0, {}
+    while True:
+        sampling = dict(SAMPLING_DEFAULTS, **overrides, max_tokens=max_tokens, grammar=getattr(job, "grammar", None))
+        result = engine.stream(job.prompt, sampling, writer, getattr(job, "adapter", None))
+        timings.finished = time.perf_counter()
+        if result.finish_reason == "abort" and aborts < ABORT_RETRIES:
+            aborts += 1
+            overrides = abort_retry_sampling(result.stop_reason)
+            log(f"    [RETRY] {job.input_file}: aborted ({result.stop_reason}), restreaming with {overrides}")
+            timings = writer.timings = StreamTimings(name, started=timings.started)
+            writer.restart()
+            continue
+        if result.finish_reason != "length":
+            break
+        new_budget = next_budget(max_tokens, ceiling)
+        if new_budget is None:
+            log(f"    [WARNING] {job.input_file}: output truncated at the context window limit.")
+            break
+        log(f"    [RETRY] {job.input_file}: output truncated, restreaming with max_tokens={new_budget}")
+        max_tokens = new_budget
+        timings = writer.timings = StreamTimings(name, started=timings.started)
+        writer.restart()
+    return result, timings
+
+
+def _fmt(seconds):
+    return f"{seconds:.2f}s" if seconds is not None else "-"
+
+
+def print_latency_report(all_timings, log=print):
+    if not all_timings:
+        return
+    gaps = sorted(g for t in all_timings for g in t.gaps)
+    ttfts = sorted(t.ttft for t in all_timings if t.ttft is not None)
+    ttfbs = sorted(t.ttfb for t in all_timings if t.ttfb is not None)
+    log(f"\n--> Streaming latency over {len(all_timings)} cases")
+    for label, values in (("time to first token", ttfts), ("time to first block", ttfbs)):
+        if values:
+            log(f"    {label:<22} p50 {_quantile(values, 0.5):6.2f}s   p95 {_quantile(values, 0.95):6.2f}s   "
+                f"max {values[-1]:6.2f}s")
+    if gaps:
+        log(f"    {'inter-token latency':<22} mean {sum(gaps) / len(gaps) * 1000:5.1f}ms  "
+            f"p95 {_quantile(gaps, 0.95) * 1000:5.1f}ms  max {gaps[-1] * 1000:5.1f}ms")
+    total = [t.finished - t.started for t in all_timings if t.finished]
+    if total and ttfbs:
+        log(f"    first block after {sum(ttfbs) / len(ttfbs):.2f}s on average instead of the full "
+            f"{sum(total) / len(total):.2f}s a blocking run makes the user wait")
+
+
+# --- 3. DEMO WITHOUT A GPU ---
+def main():
+    import io
+    import contextlib
+    import tempfile
+    from async_pipeline import CaseJob
+    from engine_backends import ReplayEngine
+    from conversion_steps import build_library_index, filter_context, build_prompt, read_file, list_input_files
+
+    parser = argparse.ArgumentParser(description="Stream the recorded outputs at a given rate.")
+    parser.add_argument("--recordings", default="outputs.zip")
+    parser.add_argument("--inputs", default="inputs")
+    parser.add_argument("--context", default="context.txt")
+    parser.add_argument("--ttft-ms", type=float, default=800.0, help="Prefill time before the first token.")
+    parser.add_argument("--per-token-ms", type=float, default=20.0)
+    parser.add_argument("--outputs", default=None, help="Default: a temporary folder.")
+    args = parser.parse_args()
+
+    engine = ReplayEngine(args.recordings, args.inputs, prefill_s=args.ttft_ms / 1000,
+                          per_token_s=args.per_token_ms / 1000)
+    output_dir = args.outputs or tempfile.mkdtemp()
+    os.makedirs(output_dir, exist_ok=True)
+    library_index = build_library_index(read_file(args.context))
+    all_timings = []
+    for input_file in sorted(list_input_files(args.inputs)):
+        job = CaseJob(input_file=input_file, user_content=read_file(input_file))
+        with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+            job.prompt = build_prompt(filter_context(library_index, job.user_content), job.user_content)
+        all_timings.append(stream_case(engine, job, output_dir))
+    print_latency_report(all_timings)
+    print(f"--> Outputs in {output_dir}")
+
+
+if __name__ == "__main__":
+    main()
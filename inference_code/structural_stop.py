@@ -0,0 +1,177 @@
+"""
+Structural stop: end a request as soon as the model has written the three
+FrameworkBuilder.ActualOperationSlot elements it is asked for.
+
+SAMPLING_DEFAULTS stops on </FrameworkBuilder.ActualDataSlot>, but that tag
+belongs to our own wrapper (wrap_xml) and the model never writes it. After the
+Cleanup slot it goes on with commentary ("### Comments: ...", a markdown
+recap, sometimes the whole XML a second time) until max_tokens. Both recorded
+outputs in outputs.zip do that.
+
+SlotCloseDetector follows the output delta by delta. It counts
+ActualOperationSlot open and close tags (a tag may be split over several
+deltas) and, when the third slot closes at top level, says where in the delta
+to cut. The engines take it as their stop_monitor:
+    - openai backend: the client hangs up the SSE stream, which makes vLLM
+      abort the request; the decode is saved.
+    - stub / replay engines: they stop emitting and count only the kept tokens.
+    - in-process vLLM, V0 engine: a MonitorLogitsProcessor runs the monitor
+      on each sequence and forces EOS on the step after the cut.
+    - in-process vLLM, V1 engine (vllm >= 0.10): LLM.generate returns
+      finished sequences only, so the text is trimmed afterwards and no
+      decode time is saved.
+A trimmed output is what the runner writes anyway (the first three slots).
+
+Running this file replays the recordings, reports the decode tokens saved per
+case and their GPU time on the H200 profile (capacity_planner's model), and
+checks the stop end to end through the replay engine, the vLLM logits
+processor (on a proxy tokenizer) and the fake server.
+
+How to use:
+    STRUCTURAL_STOP = True in run_batch_tests_v14.py
+    python structural_stop.py [--recordings outputs.zip --inputs inputs.zip]
+"""
+
+import re
+import argparse
+
+# --- 1. CONFIGURATION ---
+SLOT_COUNT = 3
+SLOT_TAG = re.compile(r"<(/?)FrameworkBuilder\.ActualOperationSlot\b[^<>]*?(/?)>")
+
+
+# --- 2. DETECTOR ---
+class SlotCloseDetector:
+    """
+    A stop monitor (see engine_backends): feed(delta) returns None, or the
+    number of characters of delta up to and including the closing tag of the
+    SLOT_COUNT-th top-level slot.
+    """
+
+    finish_reason = "stop"
+
+    def __init__(self, slot_count=SLOT_COUNT):
+        self.slot_count = slot_count
+        self.depth = 0
+        self.closed = 0
+        self._pending = ""   # an unfinished "<..." from the end of the previous delta
+
+    def feed(self, delta):
+        if self.closed >= self.slot_count:
+            return 0
+        text = self._pending + delta
+        offset = len(self._pending)
+        for match in SLOT_TAG.finditer(text):
+            closing, self_closing = match.group(1), match.group(2)
+            if not closing:
+                self.depth += 1
+            if closing or self_closing:
+                self.depth = max(0, self.depth - 1)
+                if self.depth == 0:
+                    self.closed += 1
+                    if self.closed == self.slot_count:
+                        self._pending = ""
+                        return match.end() - offset
+        # Keep a trailing tag that has not seen its ">" yet
+        start = text.rfind("<")
+        self._pending = text[start:] if start >= 0 and ">" not in text[start:] else ""
+        return None
+
+
+def trim_after_slots(text, slot_count=SLOT_COUNT):
+    """The text up to the end of the slot_count-th top-level slot (whole text if it never closes)."""
+    cut = SlotCloseDetector(slot_count).feed(text)
+    return text if cut is None else text[:cut]
+
+
+# --- 3. REPLAY BENCHMARK ---
+def main():
+    import time
+    from engine_backends import ReplayEngine, SAMPLING_DEFAULTS
+    from token_budget import count_tokens
+    from capacity_planner import load_model_config, plan_profile, throughput, measure_lengths, summarize_lengths, GPUS
+
+    parser = argparse.ArgumentParser(description="Decode tokens saved by stopping after the third slot.")
+    parser.add_argument("--recordings", default="outputs.zip")
+    parser.add_argument("--inputs", default="inputs.zip")
+    parser.add_argument("--gpu", default="H200-141G")
+    args = parser.parse_args()
+
+    engine = ReplayEngine(args.recordings, args.inputs, prefill_s=0.0)
+    rows = []
+    for recorded in engine.recordings:
+        kept = trim_after_slots(recorded)
+        # Chunked like a stream (2-char deltas split most closing tags): must cut at the same place
+        detector = SlotCloseDetector()
+        streamed = ""
+        for i in range(0, len(recorded), 2):
+            cut = detector.feed(recorded[i:i + 2])
+            streamed += recorded[i:i + 2] if cut is None else recorded[i:i + 2][:cut]
+            if cut is not None:
+                break
+        assert streamed == kept, "chunked and whole-text detection disagree"
+        rows.append((count_tokens(recorded), count_tokens(kept)))
+
+    cfg = load_model_config()
+    summary = summarize_lengths(measure_lengths())   # our CSV cases and targets, as capacity_planner sizes them
+    profile = plan_profile(args.gpu, cfg, summary)
+    perf = throughput(cfg, GPUS[args.gpu], profile["memory"], summary, 1, profile["engine_args"]["enforce_eager"])
+    step_s = perf["decode_step_ms"] / 1000
+
+    print(f"--> {len(rows)} recorded outputs from {args.recordings}; decode step {perf['decode_step_ms']:.1f} ms "
+          f"({args.gpu} profile, one sequence)")
+    print(f"    {'case':<6} {'tokens':>8} {'to 3rd slot':>12} {'saved':>8} {'saved GPU s':>12}")
+    for i, (full, kept) in enumerate(rows):
+        print(f"    {i + 1:<6} {full:>8} {kept:>12} {full - kept:>8} {(full - kept) * step_s:>12.1f}")
+    full_total, kept_total = sum(r[0] for r in rows), sum(r[1] for r in rows)
+    print(f"    total  {full_total:>8} {kept_total:>12} {full_total - kept_total:>8} "
+          f"{(full_total - kept_total) * step_s:>12.1f}   ({1 - kept_total / full_total:.0%} of the decode)")
+    print("    A case that never closes its Cleanup slot still runs to max_tokens: "
+          "0 saved, same output as before.")
+
+    # End to end: the replay engine stops streaming at the cut
+    engine.stop_monitor = SlotCloseDetector
+    sampling = dict(SAMPLING_DEFAULTS, max_tokens=20000)
+    pieces = []
+    result = engine.stream("no recorded prompt", sampling, pieces.append)
+    assert "".join(pieces) == result.text == trim_after_slots(engine.output_for("no recorded prompt"))
+    print(f"--> Replay engine: streamed {result.num_output_tokens} tokens, finish_reason={result.finish_reason}, "
+          f"text ends with the Cleanup slot: {result.text.rstrip().endswith('ActualOperationSlot>')}")
+
+    # The in-process (V0) engine: the logits processor sees the sampled tokens and forces EOS after the cut
+    from engine_backends import MonitorLogitsProcessor
+    from dictionary_grammar import proxy_vocabulary, greedy_tokens
+    recorded = engine.recordings[0]
+    vocab = proxy_vocabulary([recorded])
+    token_ids = greedy_tokens(recorded, vocab)
+    processor = MonitorLogitsProcessor(SlotCloseDetector, vocab.strings, vocab.free)
+    eos_at = next(n for n in range(len(token_ids) + 1) if processor.stopped(token_ids[:n]))
+    assert trim_after_slots("".join(vocab.strings[t] for t in token_ids[:eos_at])) == trim_after_slots(recorded)
+    print(f"--> vLLM logits processor: EOS forced after token {eos_at} of {len(token_ids)} (proxy tokenizer)")
+
+    # ... and the openai client hangs up on the server, which counts the aborted stream
+    from fake_openai_server import start_fake_server
+    from openai_client_backend import OpenAIClientEngine
+    filler = "\n\n### Comments:\n" + "All steps were converted to their corresponding XML blocks. " * 40
+    server, url = start_fake_server(ttft_s=0.0, per_token_s=0.001, text=engine.recordings[0] + filler)
+    client = OpenAIClientEngine(url, max_concurrency=2)
+    timings = []
+    for monitor in (None, SlotCloseDetector):
+        client.stop_monitor = monitor
+        t0 = time.perf_counter()
+        result = client.generate(["p"], sampling)[0]
+        timings.append((time.perf_counter() - t0, result))
+    client.close()
+    (t_full, full), (t_stop, stopped) = timings
+    assert stopped.text == trim_after_slots(full.text)
+    deadline = time.time() + 1.0
+    while not server.stats["aborted"] and time.time() < deadline:
+        time.sleep(0.01)   # the server notices the hang-up at its next write
+    print(f"--> Fake server: {full.num_output_tokens} -> {stopped.num_output_tokens} streamed chunks, "
+          f"{t_full:.2f}s -> {t_stop:.2f}s, server saw {server.stats['aborted']} aborted stream(s)")
+    server.shutdown()
+    server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""
+One command line for the whole test-case -> dSPACE XML workflow, replacing the
+run_batch_tests.py / _v8 ... _v13 copies (v14 remains as the engine-loading
+script that `generate` drives).
+
+    python tc2xml.py retrieve inputs/Test_01.txt      # filtered dictionary for one case
+    python tc2xml.py build-prompts --out prompts.jsonl
+    python tc2xml.py generate [--backend vllm|openai|replay] [--profile H200-141G]
+    python tc2xml.py export-batch [--out batch_requests.jsonl]   # OpenAI batch format
+    python tc2xml.py ingest-batch batch_results.jsonl
+    python tc2xml.py validate outputs/ [--workers 8]      # failures -> regenerate.jsonl
+    python tc2xml.py repair outputs/ [--write]          # fix block ids/links against the dictionary
+    python tc2xml.py prepare-model [--warm-only]     # verify shard hashes, warm the page cache
+    python tc2xml.py merge-lora          # adapter into base_bf16 -> merged_bf16
+    python tc2xml.py quantize-merged     # merged_bf16 -> merged (AWQ 4-bit; needs autoawq)
+    python tc2xml.py dataset --excel cases.xlsm --targets targets/   # needs pandas
+    python tc2xml.py dictionary --csv "Dictionary_Inputs 1.csv"      # needs pandas
+    python tc2xml.py bench-startup
+
+Each subcommand imports its modules only when it runs, so vLLM/torch are only
+loaded by `generate` (and only for the vllm backend), pandas only by
+`dataset` and `dictionary`. Everything else starts in a fraction of a second.
+`bench-startup` measures that for every subcommand in a fresh interpreter.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Modules each subcommand imports when it runs (used by bench-startup)
+COMMAND_IMPORTS = {
+    "retrieve": ["conversion_steps"],
+    "build-prompts": ["conversion_steps"],
+    "generate": ["run_batch_tests_v14"],
+    "validate": ["output_validation"],
+    "repair": ["block_repair"],
+    "prepare-model": ["model_prep"],
+    "merge-lora": ["lora_merge"],
+    "quantize-merged": ["lora_merge"],
+    "export-batch": ["run_batch_tests_v14", "batch_export"],
+    "ingest-batch": ["run_batch_tests_v14", "batch_export"],
+    "dataset": ["pandas"],
+    "dictionary": ["pandas"],
+}
+
+
+def _load_script(filename):
+    """Imports one of the repo-root data scripts (they are not on sys.path)."""
+    import importlib.util
+    for folder in (os.getcwd(), HERE, os.path.dirname(HERE)):
+        path = os.path.join(folder, filename)
+        if os.path.exists(path):
+            spec = importlib.util.spec_from_file_location(os.path.splitext(filename)[0], path)
+            module = importlib.util.module_from_spec(spec)
+            try:
+                spec.loader.exec_module(module)
+            except ImportError as e:
+                print(f"CRITICAL: {filename} needs {e.name} (pip install {e.name}).")
+                sys.exit(1)
+            return module
+    raise FileNotFoundError(f"{filename} not found in the working directory or next to tc2xml.py")
+
+
+# --- 1. SUBCOMMANDS ---
+def cmd_retrieve(args):
+    from conversion_steps import build_library_index, filter_context, read_file, load_cases
+
+    library_index = build_library_index(read_file(args.context))
+    for name, text in load_cases(args.case):
+        print(f"--> {name}")
+        print(filter_context(library_index, text))
+
+
+def cmd_build_prompts(args):
+    import io
+    import glob
+    import contextlib
+    from conversion_steps import build_library_index, filter_context, read_file, load_cases, build_prompt
+
+    library_index = build_library_index(read_file(args.context))
+    paths = sorted(glob.glob(os.path.join(args.inputs, "*.txt")) + glob.glob(os.path.join(args.inputs, "*.csv")))
+    count = 0
+    with open(args.out, "w", encoding="utf-8") as f:
+        for path in paths:
+            for name, text in load_cases(path):
+                with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+                    prompt = build_prompt(filter_context(library_index, text), text)
+                f.write(json.dumps({"name": name, "prompt": prompt}) + "\n")
+                count += 1
+    print(f"--> Wrote {count} prompts from {len(paths)} files to {args.out}")
+
+
+def cmd_generate(args):
+    import run_batch_tests_v14 as runner
+
+    overrides = {"BACKEND": args.backend, "INPUT_DIR": args.inputs, "OUTPUT_DIR": args.outputs,
+                 "CONTEXT_FILE": args.context, "ENGINE_PROFILE": args.profile,
+                 "GENERATE_BATCH_SIZE": args.batch, "WATCH_MODE": args.watch,
+                 "WORK_QUEUE_DB": args.queue_db, "OPENAI_BASE_URL": args.openai_url,
+                 "REPLAY_RECORDINGS": args.recordings, "BEST_OF_N": args.best_of,
+                 "STREAM_OUTPUT": args.stream, "SPLIT_SECTIONS": args.split_sections,
+                 "WINDOW_LONG_CASES": args.windows}
+    for name, value in overrides.items():
+        if value is not None:
+            setattr(runner, name, value)
+    runner.main()
+
+
+def cmd_export_batch(args):
+    import run_batch_tests_v14 as runner
+
+    runner.BATCH_EXPORT_FILE = args.out
+    for name, value in (("INPUT_DIR", args.inputs), ("CONTEXT_FILE", args.context)):
+        if value is not None:
+            setattr(runner, name, value)
+    runner.main()
+
+
+def cmd_ingest_batch(args):
+    import run_batch_tests_v14 as runner
+
+    runner.BATCH_RESULTS_FILE = args.results
+    runner.BATCH_EXPORT_FILE = args.requests
+    if args.outputs is not None:
+        runner.OUTPUT_DIR = args.outputs
+    runner.main()
+
+
+def cmd_validate(args):
+    from output_validation import validate_folder
+
+    results = validate_folder(args.path, args.queue, args.dictionary, args.workers, args.inputs)
+    return 0 if not any(results.values()) else 1
+
+
+def cmd_repair(args):
+    from block_repair import DictionaryIndex, repair_folder
+
+    regenerate = repair_folder(args.path, DictionaryIndex.load(args.dictionary), write=args.write)
+    if args.regenerate_list:
+        with open(args.regenerate_list, "w") as f:
+            f.writelines(name + "\n" for name in regenerate)
+    return 1 if regenerate else 0
+
+
+def cmd_prepare_model(args):
+    import model_prep
+
+    if args.record:
+        for model_dir in args.dirs:
+            model_prep.record(model_dir, args.workers)
+        return 0
+    ok = model_prep.prepare(args.dirs, do_verify=not args.warm_only, workers=args.workers)
+    return 0 if ok else 1
+
+
+def cmd_merge_lora(args):
+    from lora_merge import merge_checkpoint
+
+    merge_checkpoint(args.base, args.adapter, args.out, args.backend)
+
+
+def cmd_quantize_merged(args):
+    from lora_merge import quantize_checkpoint
+
+    try:
+        quantize_checkpoint(args.merged, args.out)
+    except ImportError as e:
+        print(f"CRITICAL: quantize-merged needs {e.name} (pip install autoawq).")
+        return 1
+
+
+def cmd_dataset(args):
+    script = _load_script("create_jsonl_data_from_test_cases.py")
+    script.EXCEL_FILE = args.excel
+    script.TARGET_FOLDER = args.targets
+    script.DICTIONARY_FILE = args.dictionary
+    script.OUTPUT_FILE = args.out
+    script.main()
+
+
+def cmd_dictionary(args):
+    script = _load_script("clean_excel_dictionary_v2.py")
+    script.FILE_PATH = args.csv
+    script.clean_csv_data()
+
+
+def cmd_bench_startup(args):
+    """Time from interpreter start to 'subcommand ready', in a fresh process each time."""
+    print(f"--> Startup time per subcommand (median of {args.runs} fresh interpreters)")
+    for command, modules in COMMAND_IMPORTS.items():
+        code = (f"import sys; sys.path.insert(0, {HERE!r}); import tc2xml; "
+                + "".join(f"import {m}; " for m in modules))
+        times = []
+        error = None
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            proc = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=os.getcwd())
+            times.append(time.perf_counter() - t0)
+            if proc.returncode != 0:
+                error = proc.stderr.strip().splitlines()[-1]
+                break
+        median = sorted(times)[len(times) // 2]
+        status = f"FAILED ({error})" if error else f"{median * 1000:7.0f} ms"
+        print(f"    {command:<14} {status}   imports: {', '.join(modules)}")
+    # What every old run_batch_tests copy paid before doing anything else
+    proc = subprocess.run([sys.executable, "-c", "import vllm"], capture_output=True, text=True)
+    if proc.returncode == 0:
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import vllm"], capture_output=True)
+        print(f"    (for reference: `import vllm` alone takes {(time.perf_counter() - t0) * 1000:.0f} ms)")
+    else:
+        print("    (vllm is not installed here; the old scripts could not even start)")
+
+
+# --- 2. ARGUMENT PARSING ---
+def build_parser():
+    parser = argparse.ArgumentParser(prog="tc2xml", description="English test cases -> dSPACE XML.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("retrieve", help="Print the filtered library dictionary for a case file (.txt/.csv).")
+    p.add_argument("case")
+    p.add_argument("--context", default="context.txt")
+    p.set_defaults(func=cmd_retrieve)
+
+    p = sub.add_parser("build-prompts", help="Write the prompt of every case to a JSONL file.")
+    p.add_argument("--inputs", default="inputs")
+    p.add_argument("--context", default="context.txt")
+    p.add_argument("--out", default="prompts.jsonl")
+    p.set_defaults(func=cmd_build_prompts)
+
+    p = sub.add_parser("generate", help="Convert the cases with run_batch_tests_v14 (defaults from its config).")
+    p.add_argument("--backend", choices=["vllm", "openai", "replay"])
+    p.add_argument("--inputs")
+    p.add_argument("--outputs")
+    p.add_argument("--context")
+    p.add_argument("--profile", help="Engine profile from engine_profiles.json (capacity_planner.py).")
+    p.add_argument("--batch", type=int)
+    p.add_argument("--watch", action="store_true", default=None)
+    p.add_argument("--queue-db", help="Join the SQLite work queue (work_queue.py).")
+    p.add_argument("--openai-url")
+    p.add_argument("--recordings", help="Recorded outputs for --backend replay.")
+    p.add_argument("--stream", action="store_true", default=None,
+                   help="Write outputs as they are generated and report TTFT (streaming_output.py).")
+    p.add_argument("--split-sections", action="store_true", default=None,
+                   help="One concurrent request per output slot (section_split.py).")
+    p.add_argument("--windows", action="store_true", default=None,
+                   help="Generate very long cases in overlapping step windows (windowed_generation.py).")
+    p.add_argument("--best-of", type=int, help="Samples per case; the best valid one is kept (best_of_n.py).")
+    p.set_defaults(func=cmd_generate)
+
+    p = sub.add_parser("export-batch", help="Write every prompt as an OpenAI batch request (no engine).")
+    p.add_argument("--inputs")
+    p.add_argument("--context")
+    p.add_argument("--out", default="batch_requests.jsonl")
+    p.set_defaults(func=cmd_export_batch)
+
+    p = sub.add_parser("ingest-batch", help="Turn a batch results JSONL into wrapped .xml outputs.")
+    p.add_argument("results")
+    p.add_argument("--requests", default="batch_requests.jsonl", help="For retrying truncated outputs.")
+    p.add_argument("--outputs")
+    p.set_defaults(func=cmd_ingest_batch)
+
+    p = sub.add_parser("validate", help="Check generated XML files (folder, .zip or single file) in parallel.")
+    p.add_argument("path", nargs="?", default="outputs")
+    p.add_argument("--dictionary", default="cleaned_dictionary_master.json")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--queue", default="regenerate.jsonl",
+                   help="Failing cases and their reasons, for REGENERATE_FROM in v14 ('' = don't write).")
+    p.add_argument("--inputs", default="inputs", help="Where the queued cases' .txt files are.")
+    p.set_defaults(func=cmd_validate)
+
+    p = sub.add_parser("repair", help="Repair library block ids/links against the dictionary.")
+    p.add_argument("path", nargs="?", default="outputs")
+    p.add_argument("--write", action="store_true", help="Save the repairs (default: dry run).")
+    p.add_argument("--regenerate-list", help="Write the cases that still need regeneration here.")
+    p.add_argument("--dictionary", default="cleaned_dictionary_master.json")
+    p.set_defaults(func=cmd_repair)
+
+    p = sub.add_parser("prepare-model", help="Verify the weight shards against their hashes and warm the page cache.")
+    p.add_argument("dirs", nargs="*", default=["/workspace/manual_models/base", "/workspace/manual_models/adapter"])
+    p.add_argument("--warm-only", action="store_true", help="Skip the hashes (verified on this machine before).")
+    p.add_argument("--record", action="store_true", help="Write sha256sums.json for the shards as they are now.")
+    p.add_argument("--workers", type=int, default=8)
+    p.set_defaults(func=cmd_prepare_model)
+
+    p = sub.add_parser("merge-lora", help="Write a checkpoint with the adapter merged into the bf16 base weights.")
+    p.add_argument("--base", default="/workspace/manual_models/base_bf16", help="Unquantized base (not the AWQ one).")
+    p.add_argument("--adapter", default="/workspace/manual_models/adapter")
+    p.add_argument("--out", default="/workspace/manual_models/merged_bf16")
+    p.add_argument("--backend", choices=["auto", "torch", "python"], default="auto")
+    p.set_defaults(func=cmd_merge_lora)
+
+    p = sub.add_parser("quantize-merged", help="Quantize a merged bf16 checkpoint to AWQ 4-bit for serving (autoawq).")
+    p.add_argument("merged", nargs="?", default="/workspace/manual_models/merged_bf16")
+    p.add_argument("--out", default="/workspace/manual_models/merged")
+    p.set_defaults(func=cmd_quantize_merged)
+
+    p = sub.add_parser("dataset", help="Build fine_tuning_data.jsonl from an Excel sheet + targets (pandas).")
+    p.add_argument("--excel", required=True)
+    p.add_argument("--targets", default="targets")
+    p.add_argument("--dictionary", default="cleaned_dictionary_master.json")
+    p.add_argument("--out", default="fine_tuning_data.jsonl")
+    p.set_defaults(func=cmd_dataset)
+
+    p = sub.add_parser("dictionary", help="Build cleaned_dictionary_master.json from the dictionary CSV (pandas).")
+    p.add_argument("--csv", default="Dictionary_Inputs 1.csv")
+    p.set_defaults(func=cmd_dictionary)
+
+    p = sub.add_parser("bench-startup", help="Measure the startup time of every subcommand.")
+    p.add_argument("--runs", type=int, default=5)
+    p.set_defaults(func=cmd_bench_startup)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
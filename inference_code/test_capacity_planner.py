@@ -0,0 +1,87 @@
+"""
+Unit tests for capacity_planner.py on the built-in Qwen2.5-72B-AWQ config.
+
+How to use (from inference_code/):
+    python -m pytest test_capacity_planner.py
+"""
+
+import pytest
+
+from capacity_planner import (memory_plan, max_concurrency, plan_profile, kv_bytes_per_token, weight_bytes,
+                              QWEN25_72B_CONFIG, GPUS, GIB, KV_BLOCK_TOKENS, MAX_NUM_SEQS_CAP)
+from engine_backends import ENGINE_ARGS
+
+CFG = dict(QWEN25_72B_CONFIG)
+
+
+def summary(prompt=11000, output=3000, total_max=20000, exact=True):
+    return {"cases": 1, "prompt_mean": prompt, "prompt_p95": prompt, "output_mean": output, "output_p95": output,
+            "total_mean": prompt + output, "total_p95": prompt + output, "total_max": total_max, "exact": exact}
+
+
+def test_awq_weights_and_kv_per_token():
+    # 72.7B parameters at 4 bits plus fp16 embeddings: about 38.6 GiB
+    assert 37 < weight_bytes(CFG) / GIB < 40
+    # 80 layers x 8 KV heads x 128 dims x (K and V) x 2 bytes
+    assert kv_bytes_per_token(CFG) == 80 * 8 * 128 * 2 * 2
+    assert kv_bytes_per_token(CFG, "fp8") == kv_bytes_per_token(CFG) // 2
+
+
+@pytest.mark.parametrize("gpu_name", sorted(GPUS))
+def test_memory_plan_adds_up(gpu_name):
+    plan = memory_plan(CFG, GPUS[gpu_name], {})
+    used = (plan["weights_gib"] + plan["lora_gib"] + plan["activations_gib"] + plan["cuda_graphs_gib"]
+            + plan["kv_cache_gib"])
+    assert used <= plan["budget_gib"]
+    assert plan["budget_gib"] == pytest.approx(GPUS[gpu_name]["memory_gib"] * ENGINE_ARGS["gpu_memory_utilization"])
+    assert plan["kv_tokens"] % KV_BLOCK_TOKENS == 0
+    assert plan["kv_tokens"] * plan["kv_bytes_per_token"] <= plan["kv_cache_gib"] * GIB
+    assert plan["fits"]
+
+
+def test_memory_plan_fp8_kv_holds_twice_the_tokens():
+    auto = memory_plan(CFG, GPUS["A100-80G"], {"kv_cache_dtype": "auto"})
+    fp8 = memory_plan(CFG, GPUS["A100-80G"], {"kv_cache_dtype": "fp8"})
+    assert fp8["kv_tokens"] == pytest.approx(2 * auto["kv_tokens"], abs=2 * KV_BLOCK_TOKENS)
+
+
+def test_memory_plan_does_not_fit_a_small_gpu():
+    plan = memory_plan(CFG, dict(memory_gib=40.0, hbm_tb_s=1.0, tflops=100.0), {})
+    assert plan["kv_tokens"] == 0
+    assert not plan["fits"]
+
+
+def test_max_concurrency_counts_whole_blocks():
+    # 1000 blocks; 14000 tokens = 875 blocks at p95, 10000 tokens = 625 blocks at the mean
+    s = dict(summary(), total_p95=14000, total_mean=10000)
+    assert max_concurrency(1000 * KV_BLOCK_TOKENS, s) == {"p95": 1, "mean": 1}
+    assert max_concurrency(2000 * KV_BLOCK_TOKENS, s) == {"p95": 2, "mean": 3}
+    # A partial block still takes a whole one
+    s = dict(summary(), total_p95=KV_BLOCK_TOKENS + 1, total_mean=KV_BLOCK_TOKENS)
+    assert max_concurrency(10 * KV_BLOCK_TOKENS, s) == {"p95": 5, "mean": 10}
+
+
+@pytest.mark.parametrize("gpu_name", sorted(GPUS))
+def test_plan_profile_is_consistent(gpu_name):
+    s = summary()
+    profile = plan_profile(gpu_name, CFG, s)
+    args, plan = profile["engine_args"], profile["memory"]
+    assert args["max_model_len"] % 4096 == 0
+    assert s["total_max"] * 1.1 <= args["max_model_len"] <= CFG["max_position_embeddings"]
+    assert plan["fits"]
+    # max_num_seqs never admits more p95 sequences than the KV cache holds
+    assert 1 <= args["max_num_seqs"] <= min(MAX_NUM_SEQS_CAP, max_concurrency(plan["kv_tokens"], s)["p95"])
+    assert profile["throughput"]["cases_per_hour"] > 0
+
+
+def test_plan_profile_h200_runs_more_sequences_than_a100():
+    s = summary()
+    a100 = plan_profile("A100-80G", CFG, s)["engine_args"]["max_num_seqs"]
+    h200 = plan_profile("H200-141G", CFG, s)["engine_args"]["max_num_seqs"]
+    assert h200 > a100 >= 2
+
+
+def test_plan_profile_keeps_v14_window_for_estimated_lengths():
+    assert plan_profile("A100-80G", CFG, summary(exact=True))["engine_args"]["max_model_len"] == 24576
+    estimated = plan_profile("A100-80G", CFG, summary(exact=False))["engine_args"]["max_model_len"]
+    assert estimated == min(ENGINE_ARGS["max_model_len"], CFG["max_position_embeddings"])
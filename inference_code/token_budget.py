@@ -0,0 +1,265 @@
+"""
+Per-case max_tokens prediction for the batch runner.
+
+Instead of reserving a fixed max_tokens=8192 for every request, we fit a tiny
+linear model offline on (English step count -> target XML token length) pairs
+taken from the test case CSVs in inputs/ and their matching .blkx files in
+targets/. Each request then reserves a calibrated upper quantile of the
+predicted length, and the runner retries with a larger budget if an output
+is truncated (finish_reason == "length").
+
+How to use:
+1) Run from the working directory (the one holding inputs/ and targets/):
+   python token_budget.py
+2) This writes token_budget.json and prints the budget report.
+3) run_batch_tests_v14.py picks token_budget.json up automatically.
+"""
+
+import os
+import re
+import glob
+import json
+import math
+import zipfile
+
+from conversion_steps import read_csv_rows, csv_row_title, csv_row_to_text
+
+# --- 1. CONFIGURATION ---
+INPUT_CSV_GLOB = os.path.join("inputs", "*.csv")
+TARGETS_PATH = os.path.join("targets", "targets.zip")   # folder or .zip of .blkx files
+MODEL_FILE = "token_budget.json"
+
+QUANTILE = 0.95            # Upper quantile of the residuals we reserve on top of the fit
+FIXED_MAX_TOKENS = 8192    # What v14 reserved for every request
+MIN_MAX_TOKENS = 512       # Never ask for less than this
+RETRY_GROWTH = 2.0         # Budget multiplier when an output gets truncated
+
+# Only used when no tokenizer is passed in (e.g. on a laptop without the base model)
+CHARS_PER_TOKEN = 3.0
+
+# Report assumptions (A100 80GB, 72B AWQ, gpu_memory_utilization=0.92, fp16 KV)
+REPORT_KV_CACHE_TOKENS = 98304
+REPORT_PROMPT_TOKENS = 20000
+
+SLOT_PATTERN = re.compile(
+    r'<FrameworkBuilder\.ActualOperationSlot name="(?:Initialization|StepsAndEvaluation|Cleanup)".*?</FrameworkBuilder\.ActualOperationSlot>',
+    re.DOTALL,
+)
+STEP_PATTERN = re.compile(r'^\s*\d+[a-zA-Z]?\s*[.)]', re.MULTILINE)
+
+
+# --- 2. FEATURES ---
+def count_steps(text):
+    """
+    Counts numbered steps ("1. ...", "3a. ...", "7) ...") in an English test case.
+    Falls back to the number of non-empty lines for unnumbered inputs.
+    """
+    steps = len(STEP_PATTERN.findall(text))
+    if steps == 0:
+        steps = len([line for line in text.splitlines() if line.strip()])
+    return steps
+
+
+def count_tokens(text, tokenizer=None):
+    if tokenizer is not None:
+        return len(tokenizer.encode(text))
+    return int(math.ceil(len(text) / CHARS_PER_TOKEN))
+
+
+def extract_slots(xml_text):
+    """Returns the three ActualOperationSlot sections, i.e. what the model is asked to emit."""
+    slots = SLOT_PATTERN.findall(xml_text)
+    return "\n".join(slots) if slots else xml_text
+
+
+def load_targets(targets_path):
+    """Maps target file name -> XML text, reading either a folder or a .zip archive."""
+    targets = {}
+    if zipfile.is_zipfile(targets_path):
+        with zipfile.ZipFile(targets_path) as zf:
+            for name in zf.namelist():
+                if name.lower().endswith(".blkx"):
+                    targets[os.path.basename(name)] = zf.read(name).decode("utf-8", errors="ignore")
+    elif os.path.isdir(targets_path):
+        for path in glob.glob(os.path.join(targets_path, "*.blkx")):
+            with open(path, "r", encoding="utf-8", errors="ignore") as f:
+                targets[os.path.basename(path)] = f.read()
+    return targets
+
+
+def load_training_pairs(csv_glob=INPUT_CSV_GLOB, targets_path=TARGETS_PATH, tokenizer=None):
+    """
+    Builds (step_count, target_tokens) pairs by matching each CSV row title to a
+    target file that starts with it (same rule as create_jsonl_data_from_test_cases.py).
+    """
+    targets = load_targets(targets_path)
+    pairs = []
+    for csv_path in sorted(glob.glob(csv_glob)):
+        for row in read_csv_rows(csv_path):
+            title = csv_row_title(row)
+            if not title:
+                continue
+            matches = sorted(name for name in targets if name.startswith(title + "."))
+            if not matches:
+                continue
+            steps = count_steps(csv_row_to_text(row))
+            tokens = count_tokens(extract_slots(targets[matches[0]]), tokenizer)
+            pairs.append((steps, tokens))
+    return pairs
+
+
+# --- 3. MODEL ---
+def _quantile(values, q):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    pos = min(len(ordered) - 1, max(0, int(math.ceil(q * len(ordered))) - 1))
+    return ordered[pos]
+
+
+def fit_budget_model(pairs, quantile=QUANTILE):
+    """
+    Ordinary least squares of target tokens on step count, plus the empirical
+    residual quantile so that `quantile` of the training cases fit in the budget.
+    """
+    if len(pairs) < 2:
+        raise ValueError(f"Need at least 2 training pairs, got {len(pairs)}")
+
+    n = len(pairs)
+    mean_x = sum(x for x, _ in pairs) / n
+    mean_y = sum(y for _, y in pairs) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in pairs)
+    cov_xy = sum((x - mean_x) * (y - mean_y) for x, y in pairs)
+    slope = cov_xy / var_x if var_x else 0.0
+    intercept = mean_y - slope * mean_x
+
+    residuals = [y - (intercept + slope * x) for x, y in pairs]
+    return {
+        "intercept": intercept,
+        "slope": slope,
+        "residual_quantile": _quantile(residuals, quantile),
+        "quantile": quantile,
+        "num_pairs": n,
+        "tokenizer": "chars/%.1f" % CHARS_PER_TOKEN,
+    }
+
+
+def save_budget_model(model, path=MODEL_FILE):
+    with open(path, "w") as f:
+        json.dump(model, f, indent=2)
+
+
+def load_budget_model(path=MODEL_FILE):
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def predict_max_tokens(model, user_text, ceiling=FIXED_MAX_TOKENS):
+    """Calibrated max_tokens for one test case, clamped to [MIN_MAX_TOKENS, ceiling]."""
+    steps = count_steps(user_text)
+    budget = model["intercept"] + model["slope"] * steps + model["residual_quantile"]
+    return int(max(MIN_MAX_TOKENS, min(ceiling, math.ceil(budget))))
+
+
+def next_budget(current, ceiling):
+    """Budget for the retry after a truncated output, or None if we are already at the ceiling."""
+    if current >= ceiling:
+        return None
+    return int(min(ceiling, math.ceil(current * RETRY_GROWTH)))
+
+
+# --- 4. REPORT ---
+def simulate_budget(model, pairs, ceiling=FIXED_MAX_TOKENS):
+    """
+    Replays the training pairs through predict + retry and returns per-case
+    (first_budget, tokens_reserved_total, retries). Tokens reserved counts every
+    attempt, because a truncated attempt still burned its whole budget.
+    """
+    results = []
+    for steps, actual in pairs:
+        budget = model["intercept"] + model["slope"] * steps + model["residual_quantile"]
+        budget = int(max(MIN_MAX_TOKENS, min(ceiling, math.ceil(budget))))
+        first, reserved, retries = budget, 0, 0
+        while True:
+            if actual <= budget:
+                reserved += budget
+                break
+            reserved += budget
+            budget = next_budget(budget, ceiling)
+            if budget is None:
+                break
+            retries += 1
+        results.append((first, reserved, retries))
+    return results
+
+
+def budget_report(model, pairs, kv_cache_tokens=REPORT_KV_CACHE_TOKENS,
+                  prompt_tokens=REPORT_PROMPT_TOKENS, fixed_max_tokens=FIXED_MAX_TOKENS):
+    actual = [y for _, y in pairs]
+    sim = simulate_budget(model, pairs, ceiling=fixed_max_tokens)
+    first = [r[0] for r in sim]
+    n = len(pairs)
+
+    def concurrency(max_tokens):
+        return kv_cache_tokens // (prompt_tokens + max_tokens)
+
+    fixed_waste = sum(max(0, fixed_max_tokens - y) for y in actual)
+    # Waste under the predicted budget: unused reservation on the final attempt
+    # plus every token burned by truncated attempts that had to be retried.
+    predicted_waste = sum(reserved - min(y, reserved) for (_, reserved, _), y in zip(sim, actual))
+
+    return {
+        "cases": n,
+        "mean_actual_tokens": sum(actual) / n,
+        "p95_actual_tokens": _quantile(actual, 0.95),
+        "max_actual_tokens": max(actual),
+        "fixed_max_tokens": fixed_max_tokens,
+        "mean_predicted_max_tokens": sum(first) / n,
+        "truncated_first_attempt": sum(1 for r in sim if r[2] > 0),
+        "total_retries": sum(r[2] for r in sim),
+        "fixed_concurrency": concurrency(fixed_max_tokens),
+        "predicted_concurrency": sum(concurrency(b) for b in first) / n,
+        "fixed_wasted_tokens_per_case": fixed_waste / n,
+        "predicted_wasted_tokens_per_case": predicted_waste / n,
+    }
+
+
+def print_report(report):
+    print("--> Token Budget Report")
+    print(f"    Cases:                        {report['cases']}")
+    print(f"    Target tokens mean/p95/max:   {report['mean_actual_tokens']:.0f} / "
+          f"{report['p95_actual_tokens']} / {report['max_actual_tokens']}")
+    print(f"    max_tokens fixed vs predicted: {report['fixed_max_tokens']} vs "
+          f"{report['mean_predicted_max_tokens']:.0f} (mean)")
+    print(f"    Truncated on 1st attempt:     {report['truncated_first_attempt']} "
+          f"({report['total_retries']} retries)")
+    print(f"    Admission concurrency:        {report['fixed_concurrency']} (fixed) vs "
+          f"{report['predicted_concurrency']:.2f} (predicted)")
+    print(f"    Wasted tokens per case:       {report['fixed_wasted_tokens_per_case']:.0f} (fixed) vs "
+          f"{report['predicted_wasted_tokens_per_case']:.0f} (predicted)")
+
+
+def main():
+    tokenizer = None
+    try:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained("/workspace/manual_models/base")
+        print("--> Counting tokens with the base model tokenizer.")
+    except Exception:
+        print(f"--> Tokenizer not available, estimating tokens as chars/{CHARS_PER_TOKEN}.")
+
+    pairs = load_training_pairs(tokenizer=tokenizer)
+    print(f"--> Matched {len(pairs)} test cases to target files.")
+    model = fit_budget_model(pairs)
+    if tokenizer is not None:
+        model["tokenizer"] = "base"
+    save_budget_model(model)
+    print(f"--> Saved: {MODEL_FILE}  (tokens ~= {model['intercept']:.1f} + "
+          f"{model['slope']:.1f} * steps + {model['residual_quantile']:.1f})")
+    print_report(budget_report(model, pairs))
+
+
+if __name__ == "__main__":
+    main()
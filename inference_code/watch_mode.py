@@ -0,0 +1,346 @@
+"""
+Watch-folder mode for the batch runner: keeps the engine warm and converts
+test cases as they land in inputs/.
+
+- New or modified .txt / .csv files are detected with inotify (Linux, through
+  ctypes) or, where that is unavailable, by polling mtimes and sizes.
+- A file is only picked up once it has been quiet for DEBOUNCE_S and its size
+  and mtime stopped changing, so half-copied files are not converted.
+- Only cases whose text changed since the last conversion are enqueued. For a
+  CSV that means only the edited rows. Content hashes are kept in
+  outputs/.watch_state.json, so a restart does not redo finished work.
+- A CSV row is keyed by its file and row number, not its title: titles repeat
+  across CSVs and may contain "/". Its output is
+  <csv name>_row<N>_<title as a file name>.xml.
+- A case that fails to convert or write is logged and skipped; the watcher
+  carries on with the next batch.
+- Every batch of picked-up cases goes through the same async pipeline as the
+  batch run, so outputs are written as each case finishes.
+- Pickup-to-output latency (first filesystem event -> XML written) is reported
+  after every batch and as a summary on Ctrl+C.
+"""
+
+import os
+import json
+import time
+import queue
+import ctypes
+import select
+import struct
+import hashlib
+import threading
+import ctypes.util
+
+from conversion_steps import load_cases, wrap_xml, read_csv_rows, csv_row_title, csv_row_to_text, safe_file_name
+from async_pipeline import run_pipeline, print_utilization
+
+# --- 1. CONFIGURATION ---
+WATCH_EXTENSIONS = (".txt", ".csv")
+DEBOUNCE_S = 1.0
+POLL_INTERVAL_S = 1.0
+STATE_FILE_NAME = ".watch_state.json"
+
+# inotify flags (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+_EVENT_HEADER = struct.Struct("iIII")
+
+
+# --- 2. FILE WATCHERS ---
+class _Debouncer:
+    """Tracks candidate paths until they have been quiet and stable for DEBOUNCE_S."""
+
+    def __init__(self, debounce_s):
+        self.debounce_s = debounce_s
+        self.pending = {}   # path -> [first_seen, last_event, (size, mtime)]
+
+    @staticmethod
+    def _signature(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def touch(self, path, now):
+        entry = self.pending.get(path)
+        if entry is None:
+            self.pending[path] = [now, now, self._signature(path)]
+        else:
+            entry[1] = now
+            entry[2] = self._signature(path)
+
+    def settled(self, now):
+        ready = []
+        for path, entry in list(self.pending.items()):
+            if now - entry[1] < self.debounce_s:
+                continue
+            signature = self._signature(path)
+            if signature is None:
+                del self.pending[path]
+                continue
+            if entry[2] != signature:
+                # Still being written without events (e.g. polling): wait another quiet period
+                entry[2] = signature
+                entry[1] = now
+                continue
+            ready.append((path, entry[0]))
+            del self.pending[path]
+        return ready
+
+
+def _is_watched(name):
+    return name.lower().endswith(WATCH_EXTENSIONS) and not name.startswith(".")
+
+
+class PollingWatcher:
+    def __init__(self, directory, poll_s=POLL_INTERVAL_S):
+        self.directory = directory
+        self.poll_s = poll_s
+        self.snapshot = {}
+
+    def events(self):
+        """Paths whose size or mtime changed since the last call."""
+        changed = []
+        current = {}
+        for name in os.listdir(self.directory):
+            if not _is_watched(name):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            current[path] = (st.st_size, st.st_mtime_ns)
+            if self.snapshot.get(path) != current[path]:
+                changed.append(path)
+        self.snapshot = current
+        return changed
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.poll_s))
+        return self.events()
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    def __init__(self, directory):
+        libc_name = ctypes.util.find_library("c")
+        if not libc_name:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.directory = directory
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        changed, offset = [], 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            _, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8", errors="replace")
+            offset += length
+            if _is_watched(name):
+                changed.append(os.path.join(self.directory, name))
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def make_watcher(directory):
+    try:
+        watcher = InotifyWatcher(directory)
+        print(f"--> Watching {directory} with inotify.")
+    except (OSError, AttributeError) as e:
+        watcher = PollingWatcher(directory)
+        print(f"--> inotify unavailable ({e}); polling {directory} every {POLL_INTERVAL_S}s.")
+    return watcher
+
+
+class FolderMonitor:
+    """Background thread that turns raw events into settled (path, first_seen) pairs."""
+
+    def __init__(self, directory, debounce_s=DEBOUNCE_S):
+        self.watcher = make_watcher(directory)
+        self.debouncer = _Debouncer(debounce_s)
+        self.ready = queue.Queue()
+        self._stop = threading.Event()
+        # Everything already in the folder counts as seen now; the state file
+        # decides which of those cases actually need converting.
+        now = time.time()
+        for name in sorted(os.listdir(directory)):
+            if _is_watched(name):
+                self.debouncer.touch(os.path.join(directory, name), now)
+        if isinstance(self.watcher, PollingWatcher):
+            self.watcher.events()
+        self._thread = threading.Thread(target=self._run, name="folder-monitor", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        tick = min(0.2, self.debouncer.debounce_s / 2)
+        while not self._stop.is_set():
+            paths = self.watcher.wait(tick)
+            now = time.time()
+            for path in paths:
+                self.debouncer.touch(path, now)
+            for item in self.debouncer.settled(now):
+                self.ready.put(item)
+
+    def take(self, timeout=None):
+        """Blocks for the first settled file, then grabs whatever else is ready."""
+        items = []
+        try:
+            items.append(self.ready.get(timeout=timeout))
+        except queue.Empty:
+            return items
+        while True:
+            try:
+                items.append(self.ready.get_nowait())
+            except queue.Empty:
+                return items
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.watcher.close()
+
+
+# --- 3. CHANGE TRACKING ---
+def _digest(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def load_state(path):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def watch_cases(path):
+    """[(key, output file name, test case text)] for one input file."""
+    if not path.lower().endswith(".csv"):
+        return [(name, name + ".xml", text) for name, text in load_cases(path)]
+    csv_name = os.path.basename(path)
+    stem = os.path.splitext(csv_name)[0]
+    cases = []
+    for row_index, row in enumerate(read_csv_rows(path)):
+        title = csv_row_title(row)
+        if title:
+            cases.append((f"{csv_name}#{row_index}", f"{stem}_row{row_index}_{safe_file_name(title)}.xml",
+                          csv_row_to_text(row)))
+    return cases
+
+
+def save_state(state, path):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, path)
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+def print_latency_report(latencies, label):
+    if not latencies:
+        return
+    print(f"    [LATENCY] {label}: {len(latencies)} cases, pickup->output "
+          f"p50={_percentile(latencies, 0.5):.2f}s p95={_percentile(latencies, 0.95):.2f}s "
+          f"max={max(latencies):.2f}s")
+
+
+# --- 4. WATCH LOOP ---
+def run_watch(input_dir, output_dir, build_fn, generate_fn, queue_size=4, batch_size=1,
+              debounce_s=DEBOUNCE_S, stop_event=None):
+    """
+    build_fn(job) and generate_fn([job]) are the runner's pipeline stages.
+    Returns the list of pickup-to-output latencies once stop_event is set
+    (or on Ctrl+C).
+    """
+    state_path = os.path.join(output_dir, STATE_FILE_NAME)
+    state = load_state(state_path)
+    state_lock = threading.Lock()
+    monitor = FolderMonitor(input_dir, debounce_s)
+    all_latencies = []
+    print(f"--> Watch mode: drop .txt/.csv test cases into {input_dir}/ (Ctrl+C to stop).")
+
+    try:
+        while stop_event is None or not stop_event.is_set():
+            settled = monitor.take(timeout=0.5)
+            if not settled:
+                continue
+
+            texts, output_names, first_seen = {}, {}, {}
+            for path, seen_at in settled:
+                try:
+                    cases = watch_cases(path)
+                except (OSError, UnicodeDecodeError) as e:
+                    print(f"    [WARNING] Could not read {path}: {e}")
+                    continue
+                for key, output_name, text in cases:
+                    if state.get(key) == _digest(text):
+                        continue
+                    texts[key] = text
+                    output_names[key] = output_name
+                    first_seen[key] = seen_at
+            if not texts:
+                continue
+            print(f"\n--> Picked up {len(texts)} new/changed case(s) from {len(settled)} file(s).")
+
+            latencies = []
+
+            def write_fn(job):
+                output_path = os.path.join(output_dir, output_names[job.input_file])
+                tmp = output_path + ".part"
+                try:
+                    with open(tmp, "w") as f:
+                        f.write(wrap_xml(job.text))
+                    os.replace(tmp, output_path)
+                except (OSError, TypeError) as e:   # TypeError: no text was generated
+                    print(f"    [ERROR] {job.input_file}: could not write {output_path}: {e}")
+                    return
+                job.output_path = output_path
+                latency = time.time() - first_seen[job.input_file]
+                latencies.append(latency)
+                with state_lock:
+                    state[job.input_file] = _digest(texts[job.input_file])
+                    save_state(state, state_path)
+                print(f"    [SUCCESS] Saved to: {output_path} (pickup->output {latency:.2f}s)")
+
+            try:
+                _, stats = run_pipeline(sorted(texts), texts.__getitem__, build_fn, generate_fn, write_fn,
+                                        queue_size=queue_size, batch_size=batch_size)
+            except Exception as e:
+                # The cases of this batch keep their old digests and are retried when their file changes
+                print(f"    [ERROR] Batch of {len(texts)} case(s) failed: {type(e).__name__}: {e}")
+                continue
+            print_latency_report(latencies, "batch")
+            print_utilization(stats)
+            all_latencies.extend(latencies)
+    except KeyboardInterrupt:
+        print("\n--> Stopping watch mode.")
+    finally:
+        monitor.stop()
+        print_latency_report(all_latencies, "session")
+    return all_latencies
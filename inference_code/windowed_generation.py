@@ -0,0 +1,262 @@
+"""
+Windowed generation for very long test cases (the IdleController and
+TurnSignalLamp suites have 30+ numbered lines): the Action step list is cut
+into overlapping windows that are generated in parallel and merged back into
+one sequence.
+
+    window 1: Precondition + steps 1-4    -> Initialization + its steps' blocks
+    window 2: state summary + steps 4-7   -> its steps' blocks
+    ...
+    window n: state summary + steps ..-N + Postcondition -> its blocks + Cleanup
+
+A step is a numbered Action line with its sub-lines ("3." with "3.1", "3.2").
+Each window keeps the trained Precondition:/Action:/Postcondition: prompt
+format and gets its own retrieval (filter_context on the window's text). Windows
+after the first replace the precondition with a short summary of the state so
+far: the precondition steps and how far the step list got.
+
+Merging keeps the first window's Initialization slot, the last window's
+Cleanup slot and the StepsAndEvaluation blocks of every window in order.
+Consecutive windows share OVERLAP_STEPS steps, so the start of each window
+repeats blocks from the end of the previous one. The longest run of blocks
+that ends window k and starts window k+1 (compared without their name
+attribute) is dropped from window k+1. If no run matches, both copies are
+kept: a duplicated block is easier to spot than a missing one.
+
+How to use:
+    WINDOW_LONG_CASES = True in run_batch_tests_v14.py
+    python windowed_generation.py      # long-case report + merge check on the targets
+"""
+
+import io
+import re
+import copy
+import contextlib
+import xml.etree.ElementTree as ET
+
+from async_pipeline import CaseJob
+from token_budget import count_steps, count_tokens, predict_max_tokens
+from conversion_steps import filter_context, build_prompt
+from engine_backends import generate_with_budget, FIXED_MAX_TOKENS, MAX_MODEL_LEN
+from section_split import split_sections, extract_slot, stitch_sections, EMPTY_SLOT
+
+# --- 1. CONFIGURATION ---
+WINDOW_STEPS = 4              # top-level Action steps (with their sub-steps) per window
+OVERLAP_STEPS = 1             # steps each window repeats from the previous one
+WINDOW_THRESHOLD_STEPS = 24   # cases with more numbered lines (token_budget.count_steps) are windowed
+STATE_SUMMARY_CHARS = 400
+SLOT_TAG = "FrameworkBuilder.ActualOperationSlot"
+STEP_START = re.compile(r"^\s*\d+[a-zA-Z]?\s*[.)](?!\d)")
+
+
+# --- 2. SPLITTING ---
+def split_steps(action_text):
+    """Top-level numbered steps, each with its sub-lines ("3.1 ...") attached."""
+    steps = []
+    for line in action_text.splitlines():
+        if not line.strip():
+            continue
+        if STEP_START.match(line) or not steps:
+            steps.append(line.rstrip())
+        else:
+            steps[-1] += "\n" + line.rstrip()
+    return steps
+
+
+def make_windows(steps, window_steps=WINDOW_STEPS, overlap=OVERLAP_STEPS):
+    """[(first index, steps)] covering all steps, consecutive windows sharing `overlap` steps."""
+    stride = max(1, window_steps - overlap)
+    windows = []
+    start = 0
+    while True:
+        windows.append((start, steps[start:start + window_steps]))
+        if start + window_steps >= len(steps):
+            return windows
+        start += stride
+
+
+def state_summary(precondition, steps_done, last_step):
+    """Short stand-in for the precondition of a later window."""
+    setup = "; ".join(re.sub(r"^\s*\d+[a-zA-Z]?\s*[.)]\s*", "", line).strip()
+                      for line in precondition.splitlines() if line.strip())
+    first_line = re.sub(r"^\s*\d+[a-zA-Z]?\s*[.)]\s*", "", last_step.splitlines()[0]).strip()
+    summary = f"State so far: {setup}. Steps 1-{steps_done} done (last: {first_line})."
+    return summary[:STATE_SUMMARY_CHARS]
+
+
+def needs_windows(job, budget_model=None, max_model_len=MAX_MODEL_LEN, threshold=WINDOW_THRESHOLD_STEPS):
+    """Long step list, or prompt + expected output would not fit the context window."""
+    sections = split_sections(job.user_content)
+    if sections is None:
+        return False
+    if count_steps(job.user_content) > threshold and len(split_steps(sections["Action"])) > WINDOW_STEPS:
+        return True
+    expected = predict_max_tokens(budget_model, job.user_content, ceiling=max_model_len) if budget_model \
+        else FIXED_MAX_TOKENS
+    return count_tokens(job.prompt) + expected > max_model_len
+
+
+def build_window_jobs(job, library_index, window_steps=WINDOW_STEPS, overlap=OVERLAP_STEPS):
+    """Sets job.windows to one CaseJob per window (own retrieval, own prompt)."""
+    sections = split_sections(job.user_content)
+    steps = split_steps(sections["Action"])
+    windows = make_windows(steps, window_steps, overlap)
+    job.windows = []
+    for i, (start, window) in enumerate(windows):
+        if i == 0:
+            precondition = sections["Precondition"]
+        else:
+            precondition = state_summary(sections["Precondition"], start, steps[start - 1])
+        postcondition = sections["Postcondition"] if i == len(windows) - 1 else ""
+        action = "\n".join(window)
+        text = f"Precondition:\n{precondition}\nAction:\n{action}\nPostcondition:\n{postcondition}".rstrip()
+        with contextlib.redirect_stdout(io.StringIO()):   # filter_context's [DEBUG] lines
+            filtered = filter_context(library_index, action if i else f"{precondition}\n{action}")
+        job.windows.append(CaseJob(input_file=f"{job.input_file}#w{i + 1}", user_content=text,
+                                   prompt=build_prompt(filtered, text), adapter=job.adapter,
+                                   grammar=job.grammar))
+
+
+# --- 3. MERGING ---
+def _blocks(slot_text):
+    """Child blocks of a slot's <subsystems>, or None if the slot does not parse."""
+    try:
+        slot = ET.fromstring(slot_text)
+    except ET.ParseError:
+        return None
+    subsystems = slot.find("subsystems")
+    return list(subsystems) if subsystems is not None else []
+
+
+def block_key(block):
+    """A block without its name (models number names per window) and whitespace."""
+    block = copy.deepcopy(block)
+    block.attrib.pop("name", None)
+    for element in block.iter():
+        element.text = (element.text or "").strip()
+        element.tail = None
+    return ET.tostring(block, encoding="unicode")
+
+
+def overlap_length(previous, following, max_blocks):
+    """Longest n <= max_blocks with previous[-n:] == following[:n] (by block_key)."""
+    prev_keys = [block_key(b) for b in previous[-max_blocks:]]
+    next_keys = [block_key(b) for b in following[:max_blocks]]
+    for n in range(min(len(prev_keys), len(next_keys)), 0, -1):
+        if prev_keys[-n:] == next_keys[:n]:
+            return n
+    return 0
+
+
+def merge_blocks(window_blocks, max_overlap_blocks):
+    """Concatenates the windows' block lists, dropping the repeated run at each boundary."""
+    merged = list(window_blocks[0])
+    dropped = []
+    for blocks in window_blocks[1:]:
+        n = overlap_length(merged, blocks, max_overlap_blocks)
+        dropped.append(n)
+        merged.extend(blocks[n:])
+    return merged, dropped
+
+
+def _slot_xml(slot_name, blocks):
+    slot = ET.Element(SLOT_TAG, {"name": slot_name})
+    subsystems = ET.SubElement(slot, "subsystems")
+    subsystems.extend(blocks)
+    ET.indent(slot, space="    ")
+    return ET.tostring(slot, encoding="unicode")
+
+
+def stitch_windows(job, max_overlap_blocks=None, log=print):
+    """job.text from the generated windows: first Initialization, merged steps, last Cleanup."""
+    windows = job.windows
+    initialization = extract_slot(windows[0].text, "Initialization") or EMPTY_SLOT.format("Initialization")
+    cleanup = extract_slot(windows[-1].text, "Cleanup") or EMPTY_SLOT.format("Cleanup")
+    window_blocks = []
+    for window in windows:
+        blocks = _blocks(extract_slot(window.text, "StepsAndEvaluation") or "")
+        if blocks is None:
+            log(f"    [WARNING] {window.input_file}: StepsAndEvaluation does not parse; its steps are missing.")
+            blocks = []
+        window_blocks.append(blocks)
+    if max_overlap_blocks is None:
+        # Blocks per step, measured on this case, times the overlap (+1 for slack)
+        total = sum(len(b) for b in window_blocks)
+        steps = sum(len(split_steps(w.user_content.split("\nAction:\n", 1)[1].split("\nPostcondition:", 1)[0]))
+                    for w in windows)
+        max_overlap_blocks = max(1, round(total / max(steps, 1) * OVERLAP_STEPS) + 1)
+    merged, dropped = merge_blocks(window_blocks, max_overlap_blocks)
+    if 0 in dropped:
+        log(f"    [WARNING] {job.input_file}: no repeated blocks at {dropped.count(0)} window boundaries; kept both sides.")
+    log(f"    [WINDOWS] {job.input_file}: {len(windows)} windows, {len(merged)} blocks, "
+        f"dropped {dropped} repeated at the boundaries")
+    job.text = "\n".join([initialization, _slot_xml("StepsAndEvaluation", merged), cleanup])
+
+
+def generate_windowed(engine, jobs, budget_model=None, fixed_max_tokens=FIXED_MAX_TOKENS, log=print):
+    """
+    One generate_with_budget() call over every window of every job (sections
+    or the whole prompt for the others), then merges each job.
+    """
+    requests = []
+    for job in jobs:
+        requests.extend(job.windows or job.sections or [job])
+    generate_with_budget(engine, requests, budget_model, fixed_max_tokens=fixed_max_tokens, log=log)
+    for job in jobs:
+        if job.windows:
+            stitch_windows(job, log=log)
+        elif job.sections:
+            stitch_sections(job, log)
+
+
+# --- 4. REPORT ---
+def main():
+    import glob
+    from token_budget import load_targets, extract_slots, INPUT_CSV_GLOB, TARGETS_PATH
+    from conversion_steps import build_library_index, read_file, read_csv_rows, csv_row_title, csv_row_to_text
+
+    library_index = build_library_index(read_file("context.txt"))
+    targets = load_targets(TARGETS_PATH)
+    long_cases, checked, exact = [], 0, 0
+    for csv_path in sorted(glob.glob(INPUT_CSV_GLOB)):
+        for row in read_csv_rows(csv_path):
+            title = csv_row_title(row)
+            if not title:
+                continue
+            job = CaseJob(input_file=title, user_content=csv_row_to_text(row))
+            with contextlib.redirect_stdout(io.StringIO()):
+                job.prompt = build_prompt(filter_context(library_index, job.user_content), job.user_content)
+            if not needs_windows(job):
+                continue
+            build_window_jobs(job, library_index)
+            matches = sorted(name for name in targets if name.startswith(title + "."))
+            target = extract_slots(targets[matches[0]]) if matches else ""
+            long_cases.append((title, count_steps(job.user_content), count_tokens(job.prompt), count_tokens(target),
+                               len(job.windows), max(count_tokens(w.prompt) for w in job.windows)))
+            if not matches:
+                continue
+            # Merge check: cut the target's blocks like the windows cut the steps, then merge back
+            blocks = _blocks(extract_slot(target, "StepsAndEvaluation") or "")
+            if not blocks:
+                continue
+            steps = len(split_steps(split_sections(job.user_content)["Action"]))
+            per_step = len(blocks) / steps
+            cuts = [(round(start * per_step), round((start + len(w)) * per_step))
+                    for start, w in make_windows(list(range(steps)))]
+            window_blocks = [blocks[a:b] for a, b in cuts]
+            merged, _ = merge_blocks(window_blocks, round(per_step * OVERLAP_STEPS) + 1)
+            checked += 1
+            exact += [block_key(b) for b in merged] == [block_key(b) for b in blocks]
+
+    print(f"--> {len(long_cases)} cases need windows (> {WINDOW_THRESHOLD_STEPS} numbered lines or over "
+          f"max_model_len={MAX_MODEL_LEN}); windows of {WINDOW_STEPS} steps, {OVERLAP_STEPS} overlapping")
+    print(f"    {'case':<58} {'steps':>5} {'prompt':>7} {'target':>7} {'windows':>7} {'max window prompt':>18}")
+    for title, steps, prompt, target, windows, window_prompt in sorted(long_cases, key=lambda c: -c[1])[:15]:
+        print(f"    {title[:58]:<58} {steps:>5} {prompt:>7} {target:>7} {windows:>7} {window_prompt:>18}")
+    if checked:
+        print(f"--> Merge check on {checked} targets cut into overlapping windows: "
+              f"{exact}/{checked} merged back block for block")
+
+
+if __name__ == "__main__":
+    main()
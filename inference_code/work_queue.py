@@ -0,0 +1,386 @@
+"""
+SQLite lease queue for sharding the backlog across worker processes, GPUs and
+machines that share a filesystem.
+
+Every test case is a row in work_queue.db. A worker claims a few pending cases
+at a time with a lease (LEASE_S). A heartbeat thread extends the lease while
+the cases are being generated. The worker then marks each case done, or failed
+with a backoff before the next attempt. A worker that crashes stops
+heartbeating, so its leases expire and other workers pick the cases up again.
+After MAX_ATTEMPTS failed attempts a case stays "failed" until it is reset.
+
+The database uses the rollback journal rather than WAL, because WAL needs
+shared memory and does not work across machines on NFS/CIFS. Each claim is one
+short BEGIN IMMEDIATE transaction, so workers never hold the lock while the GPU
+is busy.
+
+How to use (from the working directory):
+    python work_queue.py register            # add/refresh inputs/*.txt
+    python work_queue.py status
+    python work_queue.py reset-failed
+    python work_queue.py selftest            # crash-reclaim + scaling test, stub engine
+then set WORK_QUEUE_DB = "work_queue.db" in run_batch_tests_v14.py and start
+it once per GPU/pod.
+"""
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+import hashlib
+import argparse
+import tempfile
+import threading
+
+# --- 1. CONFIGURATION ---
+DB_PATH = "work_queue.db"
+LEASE_S = 600.0            # a case is reclaimed this long after its worker's last heartbeat
+HEARTBEAT_S = 60.0
+MAX_ATTEMPTS = 3
+BACKOFF_S = 30.0           # wait before retry n is BACKOFF_S * 2**(n-1)
+CLAIM_BATCH = 1
+BUSY_TIMEOUT_S = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cases (
+    name            TEXT PRIMARY KEY,
+    path            TEXT NOT NULL,
+    digest          TEXT NOT NULL,
+    status          TEXT NOT NULL DEFAULT 'pending',   -- pending | leased | done | failed
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    lease_owner     TEXT,
+    lease_expires   REAL,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    error           TEXT,
+    output_path     TEXT,
+    duration_s      REAL,
+    finished_at     REAL
+);
+CREATE INDEX IF NOT EXISTS cases_claim ON cases (status, next_attempt_at);
+"""
+
+
+def connect(db_path=DB_PATH):
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_S, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _digest_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+# --- 2. QUEUE OPERATIONS ---
+def register_cases(conn, input_files):
+    """
+    Adds new cases and requeues cases whose input file changed since it was
+    registered. Returns (added, requeued).
+    """
+    added = requeued = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for path in sorted(input_files):
+            name = os.path.basename(path)
+            digest = _digest_file(path)
+            row = conn.execute("SELECT digest FROM cases WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                conn.execute("INSERT INTO cases (name, path, digest) VALUES (?, ?, ?)", (name, path, digest))
+                added += 1
+            elif row[0] != digest:
+                conn.execute(
+                    "UPDATE cases SET path = ?, digest = ?, status = 'pending', attempts = 0, "
+                    "next_attempt_at = 0, error = NULL, lease_owner = NULL, lease_expires = NULL WHERE name = ?",
+                    (path, digest, name))
+                requeued += 1
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return added, requeued
+
+
+def claim(conn, owner, limit=CLAIM_BATCH, lease_s=LEASE_S, now=None):
+    """
+    Leases up to `limit` runnable cases to `owner`: pending ones whose backoff
+    has elapsed, and leased ones whose lease expired (crashed worker).
+    Returns [(name, path, attempt, reclaimed)].
+    """
+    now = time.time() if now is None else now
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute(
+            "SELECT name, path, attempts, status FROM cases "
+            "WHERE (status = 'pending' AND next_attempt_at <= ?) OR (status = 'leased' AND lease_expires < ?) "
+            "ORDER BY attempts, name LIMIT ?", (now, now, limit)).fetchall()
+        claimed = []
+        for name, path, attempts, status in rows:
+            if status == "leased" and attempts >= MAX_ATTEMPTS:
+                # Crashed on its last attempt: give up instead of leasing it again
+                conn.execute("UPDATE cases SET status = 'failed', error = 'lease expired', lease_owner = NULL "
+                             "WHERE name = ?", (name,))
+                continue
+            conn.execute("UPDATE cases SET status = 'leased', attempts = attempts + 1, lease_owner = ?, "
+                         "lease_expires = ? WHERE name = ?", (owner, now + lease_s, name))
+            claimed.append((name, path, attempts + 1, status == "leased"))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return claimed
+
+
+def heartbeat(conn, owner, names, lease_s=LEASE_S):
+    """Extends owner's leases on names. Returns the names another worker has taken over."""
+    if not names:
+        return []
+    marks = ",".join("?" * len(names))
+    conn.execute(f"UPDATE cases SET lease_expires = ? WHERE lease_owner = ? AND status = 'leased' "
+                 f"AND name IN ({marks})", (time.time() + lease_s, owner, *names))
+    rows = conn.execute(f"SELECT name FROM cases WHERE status = 'leased' AND lease_owner != ? "
+                        f"AND name IN ({marks})", (owner, *names)).fetchall()
+    return [row[0] for row in rows]
+
+
+def complete(conn, owner, name, output_path, duration_s):
+    cur = conn.execute("UPDATE cases SET status = 'done', output_path = ?, duration_s = ?, finished_at = ?, "
+                       "error = NULL, lease_owner = NULL, lease_expires = NULL "
+                       "WHERE name = ? AND lease_owner = ?", (output_path, duration_s, time.time(), name, owner))
+    return cur.rowcount == 1
+
+
+def fail(conn, owner, name, error, max_attempts=MAX_ATTEMPTS, backoff_s=BACKOFF_S):
+    """Requeues the case with exponential backoff, or marks it failed after max_attempts."""
+    row = conn.execute("SELECT attempts FROM cases WHERE name = ? AND lease_owner = ?", (name, owner)).fetchone()
+    if row is None:
+        return None   # lease was lost; whoever holds it now decides
+    attempts = row[0]
+    if attempts >= max_attempts:
+        conn.execute("UPDATE cases SET status = 'failed', error = ?, lease_owner = NULL, lease_expires = NULL "
+                     "WHERE name = ?", (error, name))
+        return "failed"
+    conn.execute("UPDATE cases SET status = 'pending', error = ?, next_attempt_at = ?, lease_owner = NULL, "
+                 "lease_expires = NULL WHERE name = ?",
+                 (error, time.time() + backoff_s * 2 ** (attempts - 1), name))
+    return "retry"
+
+
+def reset_failed(conn):
+    return conn.execute("UPDATE cases SET status = 'pending', attempts = 0, next_attempt_at = 0 "
+                        "WHERE status = 'failed'").rowcount
+
+
+def status_counts(conn):
+    return dict(conn.execute("SELECT status, COUNT(*) FROM cases GROUP BY status").fetchall())
+
+
+def next_wakeup(conn):
+    """Seconds until the earliest backed-off or leased case may become claimable (None if none)."""
+    row = conn.execute("SELECT MIN(CASE WHEN status = 'pending' THEN next_attempt_at ELSE lease_expires END) "
+                       "FROM cases WHERE status IN ('pending', 'leased')").fetchone()
+    return None if row[0] is None else max(0.0, row[0] - time.time())
+
+
+# --- 3. WORKER ---
+class LeaseHeartbeat:
+    """Background thread that keeps extending the leases of the cases in `names`."""
+
+    def __init__(self, db_path, owner, interval_s=HEARTBEAT_S, lease_s=LEASE_S):
+        self.db_path = db_path
+        self.owner = owner
+        self.interval_s = interval_s
+        self.lease_s = lease_s
+        self.names = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        conn = connect(self.db_path)
+        while not self._stop.wait(self.interval_s):
+            lost = heartbeat(conn, self.owner, list(self.names), self.lease_s)
+            if lost:
+                print(f"    [WARNING] {self.owner}: lease lost on {', '.join(lost)}; results will be discarded.")
+        conn.close()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(db_path, read_fn, build_fn, generate_fn, write_fn, job_cls, claim_batch=CLAIM_BATCH,
+               lease_s=LEASE_S, heartbeat_s=HEARTBEAT_S, max_attempts=MAX_ATTEMPTS, backoff_s=BACKOFF_S,
+               owner=None, log=print):
+    """
+    Claims and converts cases until nothing is pending or leased. The stage
+    functions are the runner's pipeline stages; job_cls builds a job from
+    (input_file, user_content). Returns the number of cases this worker finished.
+    """
+    owner = owner or worker_id()
+    conn = connect(db_path)
+    beat = LeaseHeartbeat(db_path, owner, heartbeat_s, lease_s)
+    done = 0
+    try:
+        while True:
+            claimed = claim(conn, owner, claim_batch, lease_s)
+            if not claimed:
+                wait = next_wakeup(conn)
+                if wait is None:
+                    break
+                time.sleep(min(wait, heartbeat_s, 5.0) + 0.05)
+                continue
+
+            jobs = []
+            for name, path, attempt, reclaimed in claimed:
+                if reclaimed:
+                    log(f"    [RECLAIM] {name}: lease expired, attempt {attempt}")
+                try:
+                    job = job_cls(input_file=path, user_content=read_fn(path))
+                    build_fn(job)
+                    jobs.append((name, job))
+                except Exception as e:
+                    fail(conn, owner, name, f"{type(e).__name__}: {e}", max_attempts, backoff_s)
+            beat.names = [name for name, _ in jobs]
+
+            try:
+                if jobs:
+                    generate_fn([job for _, job in jobs])
+            except Exception as e:
+                for name, _ in jobs:
+                    outcome = fail(conn, owner, name, f"{type(e).__name__}: {e}", max_attempts, backoff_s)
+                    log(f"    [ERROR] {name}: {e} ({outcome})")
+                jobs = []
+
+            for name, job in jobs:
+                try:
+                    write_fn(job)
+                except Exception as e:
+                    fail(conn, owner, name, f"{type(e).__name__}: {e}", max_attempts, backoff_s)
+                    continue
+                if complete(conn, owner, name, job.output_path, time.time() - job.picked_up):
+                    done += 1
+            beat.names = []
+    finally:
+        beat.stop()
+        conn.close()
+    return done
+
+
+# --- 4. SELF-TEST ---
+def _selftest_worker(db_path, output_dir, generate_s, crash, result_q, start):
+    from async_pipeline import CaseJob
+    from engine_backends import StubEngine, generate_with_budget
+
+    engine = StubEngine(prefill_s=generate_s)
+    owner = worker_id()
+
+    def build_fn(job):
+        job.prompt = "### User Input:\n" + job.user_content
+
+    def generate_fn(batch):
+        if crash:
+            os._exit(1)   # simulates a pod killed mid-generation
+        generate_with_budget(engine, batch, log=lambda *a: None)
+
+    def write_fn(job):
+        job.output_path = os.path.join(output_dir, os.path.basename(job.input_file).replace(".txt", ".xml"))
+        with open(job.output_path, "w") as f:
+            f.write(job.text)
+
+    def read_fn(path):
+        with open(path, "r") as f:
+            return f.read()
+
+    start.wait()
+    done = run_worker(db_path, read_fn, build_fn, generate_fn, write_fn, CaseJob, lease_s=1.0,
+                      heartbeat_s=0.3, owner=owner, log=lambda *a: None)
+    result_q.put((owner, done))
+
+
+def selftest(num_cases=96, generate_s=0.2, worker_counts=(1, 2, 4, 8)):
+    import multiprocessing
+
+    base = tempfile.mkdtemp()
+    input_dir = os.path.join(base, "inputs")
+    os.makedirs(input_dir)
+    for i in range(num_cases):
+        with open(os.path.join(input_dir, f"Test_{i:03d}.txt"), "w") as f:
+            f.write(f"Precondition:\n1. Set Battery Voltage to 13.5V\nAction:\n2. case {i}\n")
+    input_files = [os.path.join(input_dir, n) for n in os.listdir(input_dir)]
+    ctx = multiprocessing.get_context("spawn")
+
+    def run(workers, crashers=0):
+        db_path = os.path.join(base, f"queue_{workers}_{crashers}.db")
+        output_dir = os.path.join(base, f"outputs_{workers}_{crashers}")
+        os.makedirs(output_dir)
+        conn = connect(db_path)
+        register_cases(conn, input_files)
+        result_q = ctx.Queue()
+        start = ctx.Event()
+        start.set()
+        procs = [ctx.Process(target=_selftest_worker, args=(db_path, output_dir, generate_s, True, result_q, start))
+                 for _ in range(crashers)]
+        for p in procs: p.start()
+        for p in procs: p.join()
+        # Workers import and build their engine first; the clock starts once all are ready
+        start = ctx.Event()
+        procs = [ctx.Process(target=_selftest_worker, args=(db_path, output_dir, generate_s, False, result_q, start))
+                 for _ in range(workers)]
+        for p in procs: p.start()
+        time.sleep(1.5)
+        t0 = time.perf_counter()
+        start.set()
+        for p in procs: p.join()
+        wall = time.perf_counter() - t0
+        per_worker = [result_q.get()[1] for _ in range(workers)]
+        counts = status_counts(conn)
+        conn.close()
+        return wall, per_worker, counts, len(os.listdir(output_dir))
+
+    print("--> Crash test: 2 workers die holding a lease, 1 healthy worker follows.")
+    wall, per_worker, counts, outputs = run(1, crashers=2)
+    print(f"    status={counts} outputs={outputs}/{num_cases} ({wall:.2f}s incl. waiting out the 1s leases)")
+
+    print(f"--> Scaling: {num_cases} cases, {generate_s:.2f}s per engine call (one engine per worker)")
+    base_rate = None
+    for workers in worker_counts:
+        wall, per_worker, counts, outputs = run(workers)
+        rate = num_cases / wall
+        base_rate = base_rate or rate
+        print(f"    workers={workers}: {wall:.2f}s, {rate:.1f} cases/s, speedup {rate / base_rate:.2f}x, "
+              f"per worker {sorted(per_worker)}, done={counts.get('done', 0)} outputs={outputs}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SQLite lease queue for the conversion backlog.")
+    parser.add_argument("command", choices=["register", "status", "reset-failed", "selftest"])
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--inputs", default="inputs")
+    args = parser.parse_args()
+
+    if args.command == "selftest":
+        return selftest()
+
+    conn = connect(args.db)
+    if args.command == "register":
+        from conversion_steps import list_input_files
+        added, requeued = register_cases(conn, list_input_files(args.inputs))
+        print(f"--> Registered {added} new case(s), requeued {requeued} changed case(s).")
+    elif args.command == "reset-failed":
+        print(f"--> Requeued {reset_failed(conn)} failed case(s).")
+    counts = status_counts(conn)
+    print(f"--> {args.db}: " + ", ".join(f"{k}={v}" for k, v in sorted(counts.items())))
+    for name, attempts, error in conn.execute(
+            "SELECT name, attempts, error FROM cases WHERE status = 'failed' ORDER BY name"):
+        print(f"    [FAILED] {name} (attempts={attempts}): {error}")
+    conn.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())